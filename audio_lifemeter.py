@@ -0,0 +1,547 @@
+import argparse
+import collections
+import heapq
+import itertools
+import math
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+NOTA_ON = 0x90
+NOTA_OFF = 0x80
+CONTROLLO = 0xB0
+PITCH_BEND = 0xE0
+
+
+def accordo_per_percentuale(percentuale):
+    """Accordo maggiore (fondamentale, terza maggiore, quinta): più verde = accordo più acuto"""
+    # Nota base da C3 = 60 verso l'alto, limitata al range 36-96
+    base_note = int(60 + (percentuale / 100) * 48)
+    base_note = max(36, min(base_note, 96))
+    return [base_note, base_note + 4, base_note + 7]
+
+
+def frequenza_per_percentuale(percentuale):
+    """Frequenza del beep: da 500 Hz a 2500 Hz, nel range valido per winsound.Beep (37-32767 Hz)"""
+    return max(37, min(int(500 + (percentuale / 100) * 2000), 32767))
+
+
+def _pygame_midi():
+    """Importa e inizializza pygame.midi al primo uso"""
+    import pygame.midi
+    if not pygame.midi.get_init():
+        pygame.midi.init()
+    return pygame.midi
+
+
+def chiudi_pygame_midi():
+    """Termina pygame.midi se è stato inizializzato; da chiamare dopo aver chiuso i pianificatori"""
+    midi = sys.modules.get('pygame.midi')
+    if midi is not None and midi.get_init():
+        midi.quit()
+
+
+def dispositivi_midi():
+    """Elenco (id, nome) dei dispositivi MIDI di output"""
+    midi = _pygame_midi()
+    dispositivi = []
+    for i in range(midi.get_count()):
+        info = midi.get_device_info(i)
+        if info[3] == 1:
+            dispositivi.append((i, info[1].decode()))
+    return dispositivi
+
+
+class BackendNullo:
+    """Non suona nulla ma conserva i messaggi ricevuti, come (istante, (stato, nota, velocità)): per test e server"""
+    usa_timestamp = False
+
+    def __init__(self):
+        self.messaggi = []
+
+    def apri(self):
+        pass
+
+    def scrivi(self, messaggi):
+        self.messaggi.extend(messaggi)
+
+    def chiudi(self):
+        pass
+
+
+class BackendFileMidi:
+    """Registra i messaggi in un file MIDI standard (formato 0) con i loro istanti; il file è scritto alla chiusura"""
+    usa_timestamp = False
+    # 500 tick per semiminima a 120 bpm: un tick per millisecondo
+    TICK_PER_SEMIMINIMA = 500
+
+    def __init__(self, percorso):
+        self.percorso = percorso
+        self._messaggi = []
+
+    def apri(self):
+        pass
+
+    def scrivi(self, messaggi):
+        self._messaggi.extend(messaggi)
+
+    @staticmethod
+    def _vlq(valore):
+        # Quantità a lunghezza variabile: 7 bit per byte, il bit alto indica che ne segue un altro
+        byte = [valore & 0x7F]
+        valore >>= 7
+        while valore:
+            byte.append(0x80 | (valore & 0x7F))
+            valore >>= 7
+        return bytes(reversed(byte))
+
+    def chiudi(self):
+        if not self._messaggi:
+            return
+        traccia = bytearray(b'\x00\xff\x51\x03' + (500000).to_bytes(3, 'big'))  # tempo: 120 bpm
+        inizio = self._messaggi[0][0]
+        precedente = 0
+        for istante, messaggio in self._messaggi:
+            tick = max(precedente, round((istante - inizio) * 1000))
+            traccia += self._vlq(tick - precedente) + bytes(messaggio)
+            precedente = tick
+        traccia += b'\x00\xff\x2f\x00'
+        with open(self.percorso, 'wb') as f:
+            f.write(b'MThd' + struct.pack('>IHHH', 6, 0, 1, self.TICK_PER_SEMIMINIMA))
+            f.write(b'MTrk' + struct.pack('>I', len(traccia)) + traccia)
+        self._messaggi = []
+
+
+class BackendPygameMidi:
+    """Uscita MIDI di pygame, con i messaggi scritti in anticipo e marcati con l'istante di esecuzione.
+
+    Con latenza_ms > 0 PortMidi rispetta i timestamp di write(): il pianificatore può inviare gli
+    eventi prima del momento previsto senza che il ritmo dipenda dai risvegli del thread.
+    """
+    usa_timestamp = True
+
+    def __init__(self, device_id=None, latenza_ms=1):
+        self.device_id = device_id
+        self.latenza_ms = latenza_ms
+        self._output = None
+        self._differenza_ms = 0
+
+    def apri(self):
+        midi = _pygame_midi()
+        device_id = self.device_id if self.device_id is not None else midi.get_default_output_id()
+        if device_id < 0:
+            raise OSError("Nessun dispositivo MIDI di output disponibile")
+        self._output = midi.Output(device_id, latency=self.latenza_ms)
+        # Orologio di PortMidi (millisecondi dall'inizializzazione) rispetto a time.monotonic
+        self._differenza_ms = midi.time() - time.monotonic() * 1000
+
+    def scrivi(self, messaggi):
+        # write accetta al massimo 1024 eventi per chiamata
+        eventi = [[list(messaggio), max(0, int(istante * 1000 + self._differenza_ms))] for istante, messaggio in messaggi]
+        for i in range(0, len(eventi), 1024):
+            self._output.write(eventi[i:i + 1024])
+
+    def chiudi(self):
+        if self._output is not None:
+            self._output.close()
+            self._output = None
+
+
+class PianificatoreAudio:
+    """Un solo thread che suona accordi MIDI e beep all'istante previsto, da una coda di eventi ordinata per tempo.
+
+    I metodi si possono chiamare da qualsiasi thread e non bloccano. Un nuovo accordo sostituisce
+    quelli precedenti: le loro note non ancora inviate vengono scartate e quelle accese spente,
+    così analisi ravvicinate non accumulano thread né note bloccate. L'uscita del backend resta
+    aperta tra un accordo e l'altro; se una scrittura fallisce viene chiusa e riaperta al
+    successivo. Tutte le chiamate al backend avvengono nel thread del pianificatore.
+    """
+    # Con i backend che usano i timestamp, gli eventi vengono inviati con questo anticipo (secondi)
+    ANTICIPO = 0.02
+
+    def __init__(self, backend=None, beep=None):
+        self.backend = backend if backend is not None else BackendNullo()
+        self._beep = beep
+        self._eventi = []  # heap di (istante, numero, tipo, dati)
+        self._numero = itertools.count()
+        self._condizione = threading.Condition()
+        self._chiuso = False
+        self._aperto = False
+        self._note_accese = set()  # usate solo dal thread del pianificatore
+        self._ultimo_inviato = 0.0  # istante dell'ultimo evento già passato al backend
+        self._thread = threading.Thread(target=self._esegui, name='pianificatore-audio', daemon=True)
+        self._thread.start()
+
+    def _aggiungi(self, istante, tipo, dati=None):
+        # Da chiamare con la condizione acquisita
+        heapq.heappush(self._eventi, (istante, next(self._numero), tipo, dati))
+
+    def _scarta(self, tipi):
+        eventi = [evento for evento in self._eventi if evento[2] not in tipi]
+        if len(eventi) != len(self._eventi):
+            heapq.heapify(eventi)
+            self._eventi = eventi
+
+    def suona_accordo(self, note, velocita=100, durata=1.0, sfasamento=0.01, sostituisci=True):
+        """Accende le note (a sfasamento secondi l'una dall'altra) e le spegne dopo durata secondi"""
+        with self._condizione:
+            if self._chiuso:
+                return
+            # Mai prima di eventi già inviati in anticipo: le note nuove seguono sempre gli spegnimenti
+            inizio = max(time.monotonic(), self._ultimo_inviato)
+            if sostituisci:
+                self._scarta(('midi',))
+                self._aggiungi(inizio, 'spegni')
+            for i, nota in enumerate(note):
+                self._aggiungi(inizio + i * sfasamento, 'midi', (NOTA_ON, nota, velocita))
+                self._aggiungi(inizio + durata + i * sfasamento, 'midi', (NOTA_OFF, nota, 0))
+            self._condizione.notify()
+
+    def suona_beep(self, frequenza, durata_ms=1000):
+        """Beep (bloccante, es. winsound.Beep) nel thread del pianificatore; sostituisce un beep in attesa"""
+        with self._condizione:
+            if self._chiuso:
+                return
+            self._scarta(('beep',))
+            self._aggiungi(time.monotonic(), 'beep', (frequenza, durata_ms))
+            self._condizione.notify()
+
+    def silenzio(self):
+        """Scarta i suoni in attesa e spegne le note accese"""
+        with self._condizione:
+            if self._chiuso:
+                return
+            self._scarta(('midi', 'beep', 'spegni'))
+            self._aggiungi(max(time.monotonic(), self._ultimo_inviato), 'spegni')
+            self._condizione.notify()
+
+    def genera(self, funzione, istante=None):
+        """All'istante indicato (default: subito) chiama funzione(istante) nel thread del pianificatore
+        e invia i messaggi MIDI (stato, dato1, dato2) che restituisce"""
+        with self._condizione:
+            if self._chiuso:
+                return
+            self._aggiungi(time.monotonic() if istante is None else istante, 'genera', funzione)
+            self._condizione.notify()
+
+    def esegui(self, funzione, *argomenti):
+        """Esegue funzione nel thread del pianificatore (es. per usare pygame.midi da un solo thread); restituisce un Future"""
+        futuro = Future()
+        with self._condizione:
+            if self._chiuso:
+                futuro.set_exception(RuntimeError("Pianificatore audio chiuso"))
+                return futuro
+            self._aggiungi(time.monotonic(), 'funzione', (futuro, funzione, argomenti))
+            self._condizione.notify()
+        return futuro
+
+    def cambia_backend(self, backend):
+        """Sostituisce il backend: le note accese vengono spente e la vecchia uscita chiusa"""
+        with self._condizione:
+            if self._chiuso:
+                return
+            self._scarta(('midi', 'beep', 'spegni'))
+            self._aggiungi(max(time.monotonic(), self._ultimo_inviato), 'backend', backend)
+            self._condizione.notify()
+
+    def chiudi(self, attesa=2.0):
+        """Spegne le note accese, chiude il backend e termina il thread"""
+        with self._condizione:
+            if self._chiuso:
+                return
+            self._chiuso = True
+            for _, _, tipo, dati in self._eventi:
+                if tipo == 'funzione':
+                    dati[0].cancel()
+            self._eventi = []
+            self._aggiungi(max(time.monotonic(), self._ultimo_inviato), 'fine')
+            self._condizione.notify()
+        self._thread.join(attesa)
+
+    def _prossimi_eventi(self):
+        """Attende e restituisce gli eventi da eseguire ora (o, per i backend con timestamp, entro ANTICIPO)"""
+        with self._condizione:
+            while True:
+                anticipo = self.ANTICIPO if self.backend.usa_timestamp else 0
+                if self._eventi:
+                    attesa = self._eventi[0][0] - anticipo - time.monotonic()
+                    if attesa <= 0:
+                        break
+                    self._condizione.wait(attesa)
+                else:
+                    self._condizione.wait()
+            limite = time.monotonic() + anticipo
+            dovuti = []
+            while self._eventi and self._eventi[0][0] <= limite:
+                dovuti.append(heapq.heappop(self._eventi))
+            self._ultimo_inviato = max(self._ultimo_inviato, dovuti[-1][0])
+            return dovuti
+
+    def _esegui(self):
+        while True:
+            messaggi = []
+            for istante, _, tipo, dati in self._prossimi_eventi():
+                if tipo == 'midi':
+                    messaggi.append((istante, dati))
+                    continue
+                if tipo == 'genera':
+                    try:
+                        messaggi.extend((istante, messaggio) for messaggio in dati(istante))
+                    except Exception as e:
+                        print(f"Errore durante la generazione dei messaggi MIDI: {e}")
+                    continue
+                # Gli eventi non MIDI vanno eseguiti dopo i messaggi che li precedono
+                self._scrivi(messaggi)
+                messaggi = []
+                if tipo == 'spegni':
+                    self._scrivi([(istante, (NOTA_OFF, nota, 0)) for nota in sorted(self._note_accese)])
+                elif tipo == 'beep':
+                    self._suona_beep(*dati)
+                elif tipo == 'funzione':
+                    self._chiama(*dati)
+                elif tipo == 'backend':
+                    self._scrivi([(istante, (NOTA_OFF, nota, 0)) for nota in sorted(self._note_accese)])
+                    self._chiudi_backend()
+                    self.backend = dati
+                elif tipo == 'fine':
+                    self._scrivi([(istante, (NOTA_OFF, nota, 0)) for nota in sorted(self._note_accese)])
+                    self._chiudi_backend()
+                    return
+            self._scrivi(messaggi)
+
+    def _scrivi(self, messaggi):
+        if not messaggi:
+            return
+        try:
+            if not self._aperto:
+                self.backend.apri()
+                self._aperto = True
+            self.backend.scrivi(messaggi)
+        except Exception as e:
+            print(f"Errore durante l'invio MIDI: {e}")
+            # L'uscita viene riaperta al prossimo invio; le note accese non si possono più spegnere
+            self._chiudi_backend()
+            return
+        for _, (stato, nota, velocita) in messaggi:
+            if stato == NOTA_ON and velocita > 0:
+                self._note_accese.add(nota)
+            elif stato in (NOTA_ON, NOTA_OFF):
+                self._note_accese.discard(nota)
+
+    def _chiudi_backend(self):
+        self._note_accese.clear()
+        if self._aperto:
+            self._aperto = False
+            try:
+                self.backend.chiudi()
+            except Exception as e:
+                print(f"Errore durante la chiusura dell'uscita audio: {e}")
+
+    def _suona_beep(self, frequenza, durata_ms):
+        beep = self._beep
+        if beep is None:
+            try:
+                import winsound
+            except ImportError:
+                return  # Fuori da Windows non c'è un beep a frequenza variabile
+            beep = winsound.Beep
+        try:
+            beep(frequenza, durata_ms)
+        except Exception as e:
+            print(f"Errore durante la riproduzione del beep: {e}")
+
+    @staticmethod
+    def _chiama(futuro, funzione, argomenti):
+        if not futuro.set_running_or_notify_cancel():
+            return
+        try:
+            futuro.set_result(funzione(*argomenti))
+        except BaseException as e:
+            futuro.set_exception(e)
+
+
+class Sonificazione:
+    """Suono continuo che segue la percentuale di verde di una serie di risultati (fotogrammi, aree, ...).
+
+    La percentuale determina l'altezza di una nota tenuta, resa continua con il pitch bend, e la sua
+    intensità (velocità e controller 11, expression); la nota viene ribattuta solo quando l'altezza
+    esce dall'estensione del pitch bend. L'altezza segue il valore con un filtro esponenziale di
+    costante_tempo secondi, per variazioni morbide. Si invia al massimo un aggiornamento ogni
+    intervallo_minimo secondi: i risultati che arrivano nel frattempo si fondono e conta solo il più
+    recente, così il suono non resta mai indietro rispetto all'analisi. I messaggi vengono calcolati
+    nel thread del pianificatore al momento dell'invio; statistiche() riporta le latenze tra
+    l'arrivo di un risultato e l'istante del messaggio MIDI, confrontate con latenza_obiettivo.
+    Il pianificatore non va usato insieme per accordi, che spegnerebbero la nota tenuta.
+    """
+
+    def __init__(self, pianificatore, nota_min=48, nota_max=84, intervallo_minimo=0.01, costante_tempo=0.1,
+                 estensione_bend=2, latenza_obiettivo=0.02):
+        self.pianificatore = pianificatore
+        self.nota_min = nota_min
+        self.nota_max = nota_max
+        self.intervallo_minimo = intervallo_minimo
+        self.costante_tempo = costante_tempo
+        self.estensione_bend = estensione_bend
+        self.latenza_obiettivo = latenza_obiettivo
+        self.aggiornamenti = 0
+        self.fusi = 0
+        self.latenze = collections.deque(maxlen=10000)
+        self._lock = threading.Lock()
+        self._ultimo = None  # (percentuale, istante di arrivo) non ancora suonato
+        self._in_attesa = False
+        self._ultimo_invio = 0.0
+        # Stato del suono, usato solo nel thread del pianificatore
+        self._percentuale = None
+        self._altezza = None
+        self._nota = None
+        self._istante_altezza = None
+
+    def aggiorna(self, percentuale):
+        """Nuovo valore da seguire; non blocca e si può chiamare da qualsiasi thread"""
+        adesso = time.monotonic()
+        with self._lock:
+            self.aggiornamenti += 1
+            if self._ultimo is not None:
+                self.fusi += 1
+            self._ultimo = (percentuale, adesso)
+            if self._in_attesa:
+                return
+            self._in_attesa = True
+            istante = max(adesso, self._ultimo_invio + self.intervallo_minimo)
+        self.pianificatore.genera(self._emetti, istante)
+
+    def ferma(self):
+        """Spegne la nota tenuta; un aggiornamento successivo la riaccende"""
+        self.pianificatore.genera(self._messaggi_fine)
+
+    def _emetti(self, istante):
+        adesso = time.monotonic()
+        with self._lock:
+            if self._ultimo is not None:
+                self._percentuale, arrivo = self._ultimo
+                self._ultimo = None
+                self.latenze.append(max(adesso, istante) - arrivo)
+            self._in_attesa = False
+            self._ultimo_invio = max(adesso, istante)
+        if self._percentuale is None:
+            return []
+
+        obiettivo = self.nota_min + max(0.0, min(self._percentuale, 100.0)) / 100 * (self.nota_max - self.nota_min)
+        if self._altezza is None or self.costante_tempo <= 0:
+            self._altezza = obiettivo
+        else:
+            alfa = 1 - math.exp(-(istante - self._istante_altezza) / self.costante_tempo)
+            self._altezza += alfa * (obiettivo - self._altezza)
+        self._istante_altezza = istante
+
+        intensita = round(40 + max(0.0, min(self._percentuale, 100.0)) * 0.87)
+        nota_precedente = self._nota
+        if self._nota is None or abs(self._altezza - self._nota) > self.estensione_bend:
+            self._nota = round(self._altezza)
+        bend = round(8192 + (self._altezza - self._nota) / self.estensione_bend * 8192)
+        bend = max(0, min(bend, 16383))
+        messaggi = [(PITCH_BEND, bend & 0x7F, bend >> 7), (CONTROLLO, 11, intensita)]
+        if self._nota != nota_precedente:
+            # Legato: la nota nuova parte prima che la precedente venga spenta
+            messaggi.append((NOTA_ON, self._nota, intensita))
+            if nota_precedente is not None:
+                messaggi.append((NOTA_OFF, nota_precedente, 0))
+
+        if abs(obiettivo - self._altezza) > 0.02:
+            # Il filtro non ha ancora raggiunto il valore: il glissando prosegue anche senza nuovi risultati
+            with self._lock:
+                if not self._in_attesa:
+                    self._in_attesa = True
+                    self.pianificatore.genera(self._emetti, istante + self.intervallo_minimo)
+        return messaggi
+
+    def _messaggi_fine(self, istante):
+        with self._lock:
+            self._ultimo = None
+        messaggi = [(PITCH_BEND, 0, 64), (CONTROLLO, 11, 127)]
+        if self._nota is not None:
+            messaggi.insert(0, (NOTA_OFF, self._nota, 0))
+        self._percentuale = self._altezza = self._nota = None
+        return messaggi
+
+    def statistiche(self):
+        """Aggiornamenti ricevuti e fusi, latenze (secondi) tra risultato e messaggio MIDI"""
+        latenze = sorted(self.latenze)
+        if not latenze:
+            return {'aggiornamenti': self.aggiornamenti, 'fusi': self.fusi, 'inviati': 0}
+        return {
+            'aggiornamenti': self.aggiornamenti,
+            'fusi': self.fusi,
+            'inviati': len(latenze),
+            'latenza_mediana': latenze[len(latenze) // 2],
+            'latenza_p95': latenze[min(len(latenze) - 1, int(len(latenze) * 0.95))],
+            'latenza_massima': latenze[-1],
+            'entro_obiettivo': sum(l <= self.latenza_obiettivo for l in latenze) / len(latenze),
+        }
+
+    def riepilogo(self):
+        """Statistiche in una riga"""
+        dati = self.statistiche()
+        testo = f"Sonificazione: {dati['aggiornamenti']} aggiornamenti, {dati['fusi']} fusi"
+        if dati['inviati']:
+            testo += (f", latenza mediana {dati['latenza_mediana'] * 1000:.1f} ms, "
+                      f"p95 {dati['latenza_p95'] * 1000:.1f} ms, massima {dati['latenza_massima'] * 1000:.1f} ms "
+                      f"({dati['entro_obiettivo']:.0%} entro {self.latenza_obiettivo * 1000:.0f} ms)")
+        return testo
+
+    def chiudi(self):
+        """Spegne la nota e chiude il pianificatore"""
+        self.pianificatore.chiudi()
+
+
+def apri_sonificazione(file_midi=None, device_id=None, **opzioni):
+    """Sonificazione con un pianificatore proprio, su un file MIDI o sul dispositivo indicato (default: predefinito)"""
+    backend = BackendFileMidi(file_midi) if file_midi else BackendPygameMidi(device_id)
+    return Sonificazione(PianificatoreAudio(backend), **opzioni)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Suona gli accordi di LifeMeter per una serie di percentuali di verde')
+    parser.add_argument('percentuali', nargs='+', type=float, metavar='PERCENTUALE', help='Percentuali di verde da suonare in sequenza')
+    parser.add_argument('--intervallo', type=float, default=1.0, help='Secondi tra un accordo e il successivo (default: 1)')
+    parser.add_argument('--durata', type=float, default=1.0, help='Durata di ogni accordo in secondi (default: 1)')
+    parser.add_argument('--continuo', action='store_true', help='Suono continuo che segue le percentuali invece di un accordo per ciascuna')
+    uscita = parser.add_mutually_exclusive_group()
+    uscita.add_argument('--file', type=str, default=None, help='Registra gli accordi in un file MIDI invece di suonarli')
+    uscita.add_argument('--dispositivo', type=int, default=None, help='Id del dispositivo MIDI (default: quello predefinito)')
+    uscita.add_argument('--elenca', action='store_true', help='Elenca i dispositivi MIDI di output e termina')
+    args = parser.parse_args(argv)
+
+    if args.elenca:
+        for device_id, nome in dispositivi_midi():
+            print(f"{device_id}: {nome}")
+        return 0
+
+    if args.continuo:
+        sonificazione = apri_sonificazione(args.file, args.dispositivo)
+        try:
+            for percentuale in args.percentuali:
+                sonificazione.aggiorna(percentuale)
+                time.sleep(args.intervallo)
+        finally:
+            sonificazione.chiudi()
+        print(sonificazione.riepilogo(), file=sys.stderr)
+        return 0
+
+    backend = BackendFileMidi(args.file) if args.file else BackendPygameMidi(args.dispositivo)
+    pianificatore = PianificatoreAudio(backend)
+    try:
+        for percentuale in args.percentuali:
+            pianificatore.suona_accordo(accordo_per_percentuale(percentuale), durata=args.durata)
+            time.sleep(args.intervallo)
+        # Attende lo spegnimento dell'ultimo accordo
+        time.sleep(max(0.0, args.durata - args.intervallo) + 0.1)
+    finally:
+        pianificatore.chiudi()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,207 @@
+import csv
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from green_detector import ClassificatoreStandard, analizza_verde
+
+# Estensioni considerate quando si analizza una cartella
+ESTENSIONI_IMMAGINI = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp', '.webp')
+
+CAMPI_RISULTATO = ('percorso', 'percentuale', 'pixel_verdi', 'pixel_totali', 'scala', 'secondi', 'overlay', 'cache',
+                   'errore')
+
+# Cache dei risultati su disco aperte da questo processo, per (database, limite in byte)
+_CACHE_PROCESSO = {}
+
+
+def trova_immagini(percorsi, ricorsivo=False):
+    """Espande cartelle, file e pattern glob in una lista ordinata e senza duplicati di immagini"""
+    trovate = []
+    for percorso in percorsi:
+        if os.path.isdir(percorso):
+            if ricorsivo:
+                candidati = (os.path.join(radice, nome) for radice, _, nomi in os.walk(percorso) for nome in nomi)
+            else:
+                candidati = (os.path.join(percorso, nome) for nome in os.listdir(percorso))
+            trovate.extend(c for c in candidati
+                           if os.path.isfile(c) and os.path.splitext(c)[1].lower() in ESTENSIONI_IMMAGINI)
+        elif os.path.isfile(percorso):
+            trovate.append(percorso)
+        else:
+            trovate.extend(c for c in glob.glob(percorso, recursive=True) if os.path.isfile(c))
+
+    visti = set()
+    uniche = []
+    for percorso in sorted(trovate):
+        assoluto = os.path.abspath(percorso)
+        if assoluto not in visti:
+            visti.add(assoluto)
+            uniche.append(percorso)
+    return uniche
+
+
+def nomi_overlay(percorsi, output_dir, impronta=False):
+    """Assegna a ogni immagine un file di output distinto in output_dir.
+
+    Il nome è "<nome>_verde.png"; se più immagini hanno lo stesso nome (in cartelle diverse o
+    con estensioni diverse) si aggiunge un hash del percorso, così il nome resta stabile tra esecuzioni.
+    Con impronta vera l'hash si aggiunge sempre, così i nomi restano distinti anche tra chiamate diverse.
+    """
+    nomi_base = [os.path.splitext(os.path.basename(p))[0] for p in percorsi]
+    conteggi = {}
+    for nome in nomi_base:
+        conteggi[nome.lower()] = conteggi.get(nome.lower(), 0) + 1
+
+    nomi = []
+    for percorso, nome in zip(percorsi, nomi_base):
+        if impronta or conteggi[nome.lower()] > 1:
+            hash_percorso = hashlib.sha1(os.path.abspath(percorso).encode('utf-8')).hexdigest()[:8]
+            nome = f"{nome}_{hash_percorso}"
+        nomi.append(os.path.join(output_dir, f"{nome}_verde.png"))
+    return nomi
+
+
+def _cache_risultati(cache_db):
+    if cache_db not in _CACHE_PROCESSO:
+        from cache_detector import CacheRisultati
+        _CACHE_PROCESSO[cache_db] = CacheRisultati(*cache_db)
+    return _CACHE_PROCESSO[cache_db]
+
+
+def analizza_file(compito):
+    """Eseguita nei processi del pool: analizza un'immagine e ne salva l'overlay se richiesto"""
+    percorso, soglia, motore, percorso_overlay, cache_db, classificatore, scala = compito
+    inizio = time.perf_counter()
+    try:
+        genera = percorso_overlay is not None
+        if cache_db is not None:
+            risultato, dalla_cache = _cache_risultati(cache_db).analizza(percorso, soglia, genera, motore)
+        else:
+            risultato = analizza_verde(percorso, soglia, genera_immagine_output=genera, motore=motore,
+                                       classificatore=classificatore, scala=scala)
+            dalla_cache = False
+        if percorso_overlay is not None:
+            risultato.immagine_output.save(percorso_overlay)
+        return {
+            'percorso': percorso,
+            'percentuale': risultato.percentuale,
+            'pixel_verdi': risultato.pixel_verdi,
+            'pixel_totali': risultato.pixel_totali,
+            'scala': scala,
+            'secondi': round(time.perf_counter() - inizio, 4),
+            'overlay': percorso_overlay,
+            'cache': dalla_cache,
+            'errore': None,
+        }
+    except Exception as e:
+        return {
+            'percorso': percorso,
+            'percentuale': None,
+            'pixel_verdi': None,
+            'pixel_totali': None,
+            'scala': scala,
+            'secondi': round(time.perf_counter() - inizio, 4),
+            'overlay': None,
+            'cache': False,
+            'errore': f"{type(e).__name__}: {e}",
+        }
+
+
+def _chunksize_automatico(numero_immagini, workers):
+    # Abbastanza grande da ammortizzare la comunicazione tra processi, abbastanza piccolo
+    # da bilanciare il carico e far uscire i primi risultati presto
+    return max(1, min(32, numero_immagini // (workers * 8)))
+
+
+def analizza_in_batch(percorsi, soglia=2, motore=None, output_dir=None, workers=None, chunksize=None,
+                      cache_db=None, cache_limite_byte=1024 * 1024 * 1024, classificatore=None, scala=1):
+    """Analizza le immagini in parallelo e restituisce i risultati (dizionari) man mano che arrivano.
+
+    L'ordine dei risultati è quello di completamento, non quello di percorsi.
+    Con cache_db (percorso di un database SQLite) i risultati già calcolati in esecuzioni
+    precedenti vengono riusati e quelli nuovi salvati, vedi cache_detector.CacheRisultati;
+    la cache vale solo per la regola standard. classificatore, se indicato, sostituisce la
+    regola standard (vedi vegetation_detector). Con scala > 1 le immagini sono analizzate a
+    risoluzione ridotta (vedi calcola_percentuale_verde).
+    """
+    if isinstance(classificatore, ClassificatoreStandard):
+        soglia, classificatore = classificatore.soglia, None
+    if cache_db is not None and classificatore is not None:
+        raise ValueError("La cache dei risultati si può usare solo con la regola standard")
+    if cache_db is not None and scala != 1:
+        raise ValueError("La cache dei risultati si può usare solo a piena risoluzione")
+    percorsi = list(percorsi)
+    if not percorsi:
+        return
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        overlay = nomi_overlay(percorsi, output_dir)
+    else:
+        overlay = [None] * len(percorsi)
+    cache = (cache_db, cache_limite_byte) if cache_db is not None else None
+    compiti = [(p, soglia, motore, o, cache, classificatore, scala) for p, o in zip(percorsi, overlay)]
+
+    workers = min(workers or os.cpu_count() or 1, len(compiti))
+    if workers == 1:
+        for compito in compiti:
+            yield analizza_file(compito)
+        return
+
+    chunksize = chunksize or _chunksize_automatico(len(compiti), workers)
+    with multiprocessing.Pool(workers) as pool:
+        yield from pool.imap_unordered(analizza_file, compiti, chunksize=chunksize)
+
+
+class ScrittoreRisultati:
+    """Scrive i risultati (dizionari con i campi CAMPI_RISULTATO) in CSV o JSONL, una riga alla volta"""
+
+    def __init__(self, file, formato, campi=CAMPI_RISULTATO):
+        self.file = file
+        self.formato = formato
+        if formato == 'csv':
+            self._csv = csv.DictWriter(file, fieldnames=campi)
+            self._csv.writeheader()
+
+    def scrivi(self, risultato):
+        if self.formato == 'csv':
+            self._csv.writerow(risultato)
+        else:
+            self.file.write(json.dumps(risultato, ensure_ascii=False) + '\n')
+        # Ogni riga è disponibile subito a chi legge lo stream
+        self.file.flush()
+
+
+def main_batch(args):
+    """Modalità batch della riga di comando di green_detector.py"""
+    percorsi = trova_immagini(args.batch, ricorsivo=args.ricorsivo)
+    if not percorsi:
+        print("Nessuna immagine trovata", file=sys.stderr)
+        return 1
+
+    file_risultati = open(args.risultati, 'w', newline='', encoding='utf-8') if args.risultati else sys.stdout
+    errori = 0
+    dalla_cache = 0
+    inizio = time.perf_counter()
+    try:
+        scrittore = ScrittoreRisultati(file_risultati, args.formato)
+        for risultato in analizza_in_batch(percorsi, args.soglia, args.motore, args.output_dir,
+                                           args.workers, args.chunksize, args.cache_db,
+                                           args.cache_limite * 1024 * 1024, args.classificatore, args.scala):
+            if risultato['errore']:
+                errori += 1
+            if risultato['cache']:
+                dalla_cache += 1
+            scrittore.scrivi(risultato)
+    finally:
+        if file_risultati is not sys.stdout:
+            file_risultati.close()
+
+    durata = time.perf_counter() - inizio
+    print(f"{len(percorsi)} immagini analizzate in {durata:.2f} s "
+          f"({len(percorsi) / durata:.1f} immagini/s), dalla cache: {dalla_cache}, errori: {errori}", file=sys.stderr)
+    return 1 if errori else 0
@@ -0,0 +1,259 @@
+import argparse
+import ctypes
+import gc
+import io
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import PIL
+from PIL import Image, ImageChops
+
+from green_detector import (MOTORI_DISPONIBILI, maschera_numpy, maschera_pil, normalizza_soglia,
+                            overlay_numpy, overlay_pil, converti_rgb, np)
+
+DIMENSIONI_PREDEFINITE = ('640x480', '1920x1080', '4000x3000')
+DENSITA_PREDEFINITE = (0.1, 0.5, 0.9)
+
+
+def immagine_sintetica(larghezza, altezza, densita, seme=0):
+    """Immagine RGB casuale in cui circa una frazione `densita` dei pixel è verde.
+
+    I pixel non verdi hanno g = min(r, b) / 2, quelli verdi g = max(r, b) + 40 (saturato a 255):
+    con le soglie usuali la frazione di pixel verdi rilevati è quindi vicina a `densita`.
+    Usa solo Pillow, così il benchmark non dipende da NumPy né da file esterni.
+    """
+    generatore = random.Random(seme)
+
+    def rumore():
+        return Image.frombytes('L', (larghezza, altezza), generatore.randbytes(larghezza * altezza))
+
+    r, b, scelta = rumore(), rumore(), rumore()
+    g_non_verde = ImageChops.darker(r, b).point(lambda v: v // 2)
+    g_verde = ImageChops.lighter(r, b).point(lambda v: min(v + 40, 255))
+    maschera = scelta.point(lambda v: 255 if v < densita * 256 else 0)
+    return Image.merge('RGB', (r, Image.composite(g_verde, g_non_verde, maschera), b))
+
+
+class _MisuratoreMemoria:
+    """Picco di memoria di una fase, in MB.
+
+    Su Linux si azzera il picco di memoria residente del processo (VmHWM) prima della fase, così
+    si misurano anche le allocazioni di Pillow; altrove si usa tracemalloc, che vede solo quelle
+    di Python e di NumPy. Prima di ogni misura la memoria libera viene restituita al sistema
+    (cache dei blocchi di Pillow e malloc_trim di glibc), altrimenti la fase riuserebbe pagine
+    già residenti e il picco risulterebbe nullo.
+    """
+
+    def __init__(self):
+        self.metodo = 'vmhwm' if self._azzera_picco() else 'tracemalloc'
+        self._malloc_trim = None
+        if self.metodo == 'vmhwm':
+            try:
+                self._malloc_trim = ctypes.CDLL('libc.so.6').malloc_trim
+            except (OSError, AttributeError):
+                pass
+            # Senza cache Pillow libera subito i blocchi delle immagini non più usate
+            Image.core.set_blocks_max(0)
+
+    def _libera_memoria(self):
+        gc.collect()
+        if self._malloc_trim is not None:
+            self._malloc_trim(0)
+
+    @staticmethod
+    def _azzera_picco():
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def _stato_kb(campo):
+        with open('/proc/self/status') as f:
+            for riga in f:
+                if riga.startswith(campo + ':'):
+                    return int(riga.split()[1])
+        return 0
+
+    def misura(self, funzione):
+        """Esegue funzione() e restituisce (risultato, picco_mb)"""
+        if self.metodo == 'vmhwm':
+            self._libera_memoria()
+            self._azzera_picco()
+            residente = self._stato_kb('VmRSS')
+            risultato = funzione()
+            return risultato, max(0, self._stato_kb('VmHWM') - residente) / 1024
+        tracemalloc.start()
+        try:
+            risultato = funzione()
+            return risultato, tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        finally:
+            tracemalloc.stop()
+
+
+def _cronometra(funzione, ripetizioni):
+    """Restituisce (risultato, tempo migliore in secondi) su più ripetizioni.
+
+    Prima delle ripetizioni funzione() viene eseguita una volta senza misurarla, così tempi (e picchi
+    di memoria, misurati dopo) non includono l'importazione pigra di NumPy né altre inizializzazioni.
+    """
+    funzione()
+    migliore = None
+    risultato = None
+    for _ in range(ripetizioni):
+        inizio = time.perf_counter()
+        risultato = funzione()
+        durata = time.perf_counter() - inizio
+        migliore = durata if migliore is None else min(migliore, durata)
+    return risultato, migliore
+
+
+def _fasi_motore(motore, img_rgb, soglia):
+    """Funzioni (nome, funzione) delle fasi di un motore, ognuna dipendente dalla precedente"""
+    stato = {}
+    if motore == 'numpy':
+        def maschera():
+            stato['arr'] = np.asarray(img_rgb)
+            stato['maschera'] = maschera_numpy(stato['arr'], soglia)
+
+        def conteggio():
+            return int(np.count_nonzero(stato['maschera']))
+
+        def overlay():
+            return overlay_numpy(stato['arr'], stato['maschera'])
+    else:
+        def maschera():
+            stato['maschera'] = maschera_pil(img_rgb, soglia)
+
+        def conteggio():
+            return stato['maschera'].histogram()[255]
+
+        def overlay():
+            return overlay_pil(img_rgb, stato['maschera'])
+    return [('maschera', maschera), ('conteggio', conteggio), ('overlay', overlay)]
+
+
+def esegui_benchmark(dimensioni=DIMENSIONI_PREDEFINITE, densita=DENSITA_PREDEFINITE, motori=MOTORI_DISPONIBILI,
+                     soglia=2, ripetizioni=3, stampa=None):
+    """Esegue tutte le combinazioni e restituisce il dizionario che viene salvato in JSON"""
+    memoria = _MisuratoreMemoria()
+    soglia = normalizza_soglia(soglia)
+    risultati = []
+
+    def registra(voce):
+        risultati.append(voce)
+        if stampa is not None:
+            stampa(voce)
+
+    for testo_dimensioni in dimensioni:
+        larghezza, altezza = (int(v) for v in testo_dimensioni.lower().split('x'))
+        megapixel = larghezza * altezza / 1e6
+        for frazione in densita:
+            originale = immagine_sintetica(larghezza, altezza, frazione)
+            base = {'dimensioni': f"{larghezza}x{altezza}", 'densita': frazione}
+
+            for formato in ('PNG', 'JPEG'):
+                buffer = io.BytesIO()
+                originale.save(buffer, formato)
+                dati = buffer.getvalue()
+
+                def decodifica():
+                    return converti_rgb(Image.open(io.BytesIO(dati)))
+
+                _, secondi = _cronometra(decodifica, ripetizioni)
+                _, picco = memoria.misura(decodifica)
+                registra(dict(base, motore=None, fase=f"decodifica_{formato.lower()}", secondi=round(secondi, 6),
+                              mpixel_s=round(megapixel / secondi, 2), picco_mb=round(picco, 2)))
+
+            for motore in motori:
+                for fase, funzione in _fasi_motore(motore, originale, soglia):
+                    _, secondi = _cronometra(funzione, ripetizioni)
+                    _, picco = memoria.misura(funzione)
+                    registra(dict(base, motore=motore, fase=fase, secondi=round(secondi, 6),
+                                  mpixel_s=round(megapixel / secondi, 2), picco_mb=round(picco, 2)))
+
+    return {
+        'meta': {
+            'data': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'piattaforma': platform.platform(),
+            'pillow': PIL.__version__,
+            'numpy': np.__version__ if np is not None else None,
+            'soglia': soglia,
+            'ripetizioni': ripetizioni,
+            'memoria': memoria.metodo,
+            'motori': list(motori),
+        },
+        'risultati': risultati,
+    }
+
+
+def confronta(attuale, riferimento, tolleranza=0.15):
+    """Elenca le misure il cui throughput è sceso di più di `tolleranza` rispetto al riferimento"""
+    def chiave(voce):
+        return (voce['dimensioni'], voce['densita'], voce['motore'], voce['fase'])
+
+    precedenti = {chiave(v): v for v in riferimento['risultati']}
+    rallentamenti = []
+    for voce in attuale['risultati']:
+        precedente = precedenti.get(chiave(voce))
+        if precedente is None or not precedente['mpixel_s']:
+            continue
+        variazione = voce['mpixel_s'] / precedente['mpixel_s'] - 1
+        if variazione < -tolleranza:
+            rallentamenti.append(dict(voce, mpixel_s_riferimento=precedente['mpixel_s'],
+                                      variazione=round(variazione, 3)))
+    return rallentamenti
+
+
+def _stampa_voce(voce):
+    print(f"{voce['dimensioni']:>10} densità {voce['densita']:<4} {voce['motore'] or '-':>6} {voce['fase']:<16} "
+          f"{voce['secondi'] * 1000:9.2f} ms {voce['mpixel_s']:9.2f} MP/s {voce['picco_mb']:8.1f} MB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark di green_detector su immagini sintetiche')
+    parser.add_argument('--dimensioni', nargs='+', default=list(DIMENSIONI_PREDEFINITE), metavar='LxA',
+                        help='Dimensioni delle immagini (default: %(default)s)')
+    parser.add_argument('--densita', nargs='+', type=float, default=list(DENSITA_PREDEFINITE),
+                        help='Frazioni di pixel verdi (default: %(default)s)')
+    parser.add_argument('--motori', nargs='+', choices=MOTORI_DISPONIBILI, default=list(MOTORI_DISPONIBILI),
+                        help='Motori da misurare (default: tutti quelli disponibili)')
+    parser.add_argument('--soglia', type=int, default=2, help='Soglia di rilevamento verde (default: 2)')
+    parser.add_argument('--ripetizioni', type=int, default=3, help='Ripetizioni per misura, si tiene la migliore (default: 3)')
+    parser.add_argument('--output', type=str, default=None, help='File JSON in cui salvare i risultati')
+    parser.add_argument('--confronta', type=str, default=None, metavar='JSON',
+                        help='Risultati di riferimento: segnala i rallentamenti e termina con codice 1')
+    parser.add_argument('--tolleranza', type=float, default=0.15,
+                        help='Calo di throughput tollerato rispetto al riferimento (default: 0.15)')
+    args = parser.parse_args(argv)
+
+    risultati = esegui_benchmark(args.dimensioni, args.densita, args.motori, args.soglia, args.ripetizioni,
+                                 stampa=_stampa_voce)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(risultati, f, indent=2, ensure_ascii=False)
+        print(f"Risultati salvati in: {args.output}")
+
+    if args.confronta:
+        with open(args.confronta, encoding='utf-8') as f:
+            riferimento = json.load(f)
+        rallentamenti = confronta(risultati, riferimento, args.tolleranza)
+        for voce in rallentamenti:
+            print(f"RALLENTAMENTO {voce['dimensioni']} densità {voce['densita']} {voce['motore'] or '-'} {voce['fase']}: "
+                  f"{voce['mpixel_s_riferimento']} -> {voce['mpixel_s']} MP/s ({voce['variazione']:+.0%})")
+        if rallentamenti:
+            return 1
+        print("Nessun rallentamento rispetto al riferimento")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,198 @@
+import hashlib
+import json
+import numbers
+import os
+import sqlite3
+import time
+import zlib
+
+from green_detector import (VERSIONE_MOTORE, MascheraVerde, RisultatoVerde, apri_regione, normalizza_soglia,
+                            analizza_verde)
+
+# Le inserzioni tra due controlli della dimensione del database
+_CONTROLLO_OGNI = 256
+
+# Spazio stimato di una riga oltre alla maschera (chiave, conteggi, indice)
+_BYTE_PER_RIGA = 128
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS risultati (
+    impronta TEXT NOT NULL,
+    soglia INTEGER NOT NULL,
+    area TEXT NOT NULL,
+    versione INTEGER NOT NULL,
+    percentuale REAL NOT NULL,
+    pixel_verdi INTEGER NOT NULL,
+    pixel_totali INTEGER NOT NULL,
+    larghezza_maschera INTEGER,
+    altezza_maschera INTEGER,
+    maschera BLOB,
+    byte INTEGER NOT NULL,
+    ultimo_uso REAL NOT NULL,
+    PRIMARY KEY (impronta, soglia, area, versione)
+);
+CREATE INDEX IF NOT EXISTS risultati_ultimo_uso ON risultati (ultimo_uso);
+CREATE TABLE IF NOT EXISTS file (
+    percorso TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    dimensione INTEGER NOT NULL,
+    impronta TEXT NOT NULL
+);
+"""
+
+
+def impronta_contenuto(percorso, dimensione_blocco=1024 * 1024):
+    """Hash del contenuto del file: due copie della stessa immagine hanno la stessa impronta"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(percorso, 'rb') as f:
+        while blocco := f.read(dimensione_blocco):
+            h.update(blocco)
+    return h.hexdigest()
+
+
+def _chiave_area(area_di_interesse):
+    # Stessa area, stessa chiave: un riquadro singolo equivale a una lista con quel riquadro
+    if area_di_interesse is None:
+        return ''
+    if len(area_di_interesse) == 4 and all(isinstance(v, numbers.Real) for v in area_di_interesse):
+        area_di_interesse = [area_di_interesse]
+    return json.dumps([list(r) for r in area_di_interesse])
+
+
+class CacheRisultati:
+    """Risultati delle analisi salvati in un database SQLite, riusabili tra esecuzioni diverse.
+
+    La chiave è l'impronta del contenuto dell'immagine, la soglia, l'area di interesse e
+    VERSIONE_MOTORE: file copiati o rinominati restano nella cache, mentre un cambio dell'algoritmo
+    la invalida. Il motore non fa parte della chiave perché NumPy e Pillow danno gli stessi
+    conteggi. Per non rileggere i file già visti, l'impronta di ogni percorso viene conservata
+    insieme a data di modifica e dimensione. Oltre limite_byte si eliminano i risultati usati meno
+    di recente. Più processi possono usare lo stesso file contemporaneamente (WAL e attesa sui lock);
+    ogni processo apre la propria connessione.
+    """
+
+    def __init__(self, percorso_db, limite_byte=1024 * 1024 * 1024, salva_maschere=False):
+        self.percorso_db = percorso_db
+        self.limite_byte = limite_byte
+        self.salva_maschere = salva_maschere
+        self._connessione = None
+        self._pid = None
+        self._inserzioni = 0
+
+    def _db(self):
+        # Una connessione SQLite non può passare a un processo figlio: dopo un fork se ne apre un'altra
+        if self._connessione is None or self._pid != os.getpid():
+            connessione = sqlite3.connect(self.percorso_db, timeout=60, isolation_level=None)
+            connessione.execute('PRAGMA journal_mode=WAL')
+            connessione.execute('PRAGMA synchronous=NORMAL')
+            connessione.executescript(_SCHEMA)
+            self._connessione, self._pid = connessione, os.getpid()
+        return self._connessione
+
+    def chiudi(self):
+        if self._connessione is not None and self._pid == os.getpid():
+            self._connessione.close()
+        self._connessione = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *eccezione):
+        self.chiudi()
+
+    def impronta(self, percorso):
+        """Impronta del file, ricalcolata solo se data di modifica o dimensione sono cambiate"""
+        stato = os.stat(percorso)
+        assoluto = os.path.abspath(percorso)
+        db = self._db()
+        riga = db.execute('SELECT mtime_ns, dimensione, impronta FROM file WHERE percorso = ?', (assoluto,)).fetchone()
+        if riga is not None and riga[:2] == (stato.st_mtime_ns, stato.st_size):
+            return riga[2]
+        impronta = impronta_contenuto(percorso)
+        db.execute('INSERT OR REPLACE INTO file VALUES (?, ?, ?, ?)',
+                   (assoluto, stato.st_mtime_ns, stato.st_size, impronta))
+        return impronta
+
+    def cerca(self, impronta, soglia, area_di_interesse=None):
+        """Restituisce un RisultatoVerde o None; il risultato contiene la MascheraVerde se è stata salvata"""
+        chiave = (impronta, normalizza_soglia(soglia), _chiave_area(area_di_interesse), VERSIONE_MOTORE)
+        db = self._db()
+        riga = db.execute('SELECT percentuale, pixel_verdi, pixel_totali, larghezza_maschera, altezza_maschera, '
+                          'maschera, ultimo_uso FROM risultati '
+                          'WHERE impronta = ? AND soglia = ? AND area = ? AND versione = ?', chiave).fetchone()
+        if riga is None:
+            return None
+        percentuale, pixel_verdi, pixel_totali, larghezza, altezza, maschera, ultimo_uso = riga
+        adesso = time.time()
+        # Per l'ordine di eliminazione basta un'ora di precisione: si evita una scrittura per ogni lettura
+        if adesso - ultimo_uso > 3600:
+            db.execute('UPDATE risultati SET ultimo_uso = ? '
+                       'WHERE impronta = ? AND soglia = ? AND area = ? AND versione = ?', (adesso,) + chiave)
+        if maschera is not None:
+            maschera = MascheraVerde(zlib.decompress(maschera), (larghezza, altezza))
+        return RisultatoVerde(percentuale, pixel_verdi, pixel_totali, maschera=maschera)
+
+    def salva(self, impronta, soglia, area_di_interesse, risultato, maschera=None):
+        """Salva un risultato; maschera (MascheraVerde o immagine dei pixel verdi) è facoltativa"""
+        dati = dimensioni = None
+        if maschera is not None:
+            if not isinstance(maschera, MascheraVerde):
+                maschera = MascheraVerde.da_immagine(maschera)
+            dati, dimensioni = zlib.compress(maschera.dati, 6), maschera.dimensioni
+        self._db().execute(
+            'INSERT OR REPLACE INTO risultati VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (impronta, normalizza_soglia(soglia), _chiave_area(area_di_interesse), VERSIONE_MOTORE,
+             risultato.percentuale, risultato.pixel_verdi, risultato.pixel_totali,
+             dimensioni[0] if dimensioni else None, dimensioni[1] if dimensioni else None, dati,
+             len(dati or b'') + _BYTE_PER_RIGA, time.time()))
+        self._inserzioni += 1
+        if self._inserzioni % _CONTROLLO_OGNI == 0:
+            self.riduci()
+
+    def byte_usati(self):
+        return self._db().execute('SELECT COALESCE(SUM(byte), 0) FROM risultati').fetchone()[0]
+
+    def riduci(self, limite_byte=None):
+        """Elimina i risultati usati meno di recente finché la cache non scende al 90% del limite"""
+        limite_byte = self.limite_byte if limite_byte is None else limite_byte
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            totale = db.execute('SELECT COALESCE(SUM(byte), 0) FROM risultati').fetchone()[0]
+            if totale > limite_byte:
+                eccesso = totale - limite_byte * 0.9
+                da_eliminare = []
+                for rowid, byte in db.execute('SELECT rowid, byte FROM risultati ORDER BY ultimo_uso'):
+                    if eccesso <= 0:
+                        break
+                    da_eliminare.append((rowid,))
+                    eccesso -= byte
+                db.executemany('DELETE FROM risultati WHERE rowid = ?', da_eliminare)
+                # Le impronte senza più risultati non servono più
+                db.execute('DELETE FROM file WHERE impronta NOT IN (SELECT impronta FROM risultati)')
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    def analizza(self, image_path, soglia=5, genera_immagine_output=False, motore=None, area_di_interesse=None):
+        """Come analizza_verde, ma usa la cache. Restituisce (RisultatoVerde, dalla_cache).
+
+        Se serve l'immagine dei pixel verdi e la cache ha la maschera, l'immagine viene ricostruita
+        dalla maschera senza ripetere l'analisi (ma l'immagine va comunque decodificata).
+        """
+        impronta = self.impronta(image_path)
+        risultato = self.cerca(impronta, soglia, area_di_interesse)
+        if risultato is not None:
+            if not genera_immagine_output:
+                return risultato, True
+            if risultato.maschera is not None:
+                img_rgb, _ = apri_regione(image_path, area_di_interesse)
+                risultato.immagine_output = risultato.maschera.disegna(img_rgb)
+                return risultato, True
+
+        genera_maschera = genera_immagine_output or self.salva_maschere
+        risultato = analizza_verde(image_path, soglia, genera_immagine_output, motore, area_di_interesse,
+                                   genera_maschera=genera_maschera)
+        self.salva(impronta, soglia, area_di_interesse, risultato, risultato.maschera)
+        return risultato, False
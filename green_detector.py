@@ -1,54 +1,1746 @@
-from PIL import Image
-import argparse
+from PIL import Image, ImageChops, ImageOps
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from functools import cached_property, lru_cache
+import contextlib
+import importlib
+import importlib.util
+import io
+import math
+import numbers
+import os
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+import zlib
 
-def calcola_percentuale_verde(image_path, soglia=5, genera_immagine_output=False):
-    img = Image.open(image_path)
-    img_rgb = img.convert('RGB')
+
+class _ModuloPigro:
+    """Segnaposto di un modulo che viene importato al primo accesso a un suo attributo"""
+
+    def __init__(self, nome):
+        self._nome = nome
+
+    def __getattr__(self, attributo):
+        # import_module è protetto dai lock degli import: più thread possono arrivare qui insieme
+        modulo = importlib.import_module(self._nome)
+        # Da qui in poi gli attributi si trovano nel __dict__ e __getattr__ non viene più chiamato
+        self.__dict__.update(vars(modulo))
+        return getattr(modulo, attributo)
+
+
+# NumPy è facoltativo (senza si usa il percorso puro Pillow) e viene importato solo al primo uso:
+# importare green_detector resta veloce, per l'avvio dell'interfaccia grafica o con il motore pil
+np = _ModuloPigro('numpy') if importlib.util.find_spec('numpy') is not None else None
+
+# Motori di calcolo disponibili, in ordine di preferenza
+MOTORI_DISPONIBILI = ('numpy', 'pil') if np is not None else ('pil',)
+
+# Versione dell'algoritmo di rilevamento: va incrementata quando cambiano i risultati,
+# così i risultati salvati da cache_detector con la versione precedente non vengono più usati
+VERSIONE_MOTORE = 1
+
+
+def scegli_motore(motore):
+    """Il motore indicato, controllato, o il più veloce disponibile se None"""
+    if motore is None:
+        return MOTORI_DISPONIBILI[0]
+    if motore not in MOTORI_DISPONIBILI:
+        raise ValueError(f"Motore non disponibile: {motore} (disponibili: {', '.join(MOTORI_DISPONIBILI)})")
+    return motore
+
+
+def normalizza_soglia(soglia):
+    """Soglia intera limitata a [-256, 255], come la usano maschera_numpy e maschera_pil"""
+    # g - r e g - b sono sempre in [-255, 255]: oltre questi limiti il risultato non cambia,
+    # quindi la soglia si può limitare senza rischiare overflow negli interi a 16 bit
+    return max(-256, min(int(soglia), 255))
+
+
+def converti_rgb(img):
+    """Immagine Pillow caricata in modo RGB"""
+    # Evita la copia di convert() quando l'immagine è già RGB
+    if img.mode == 'RGB':
+        img.load()
+        return img
+    return img.convert('RGB')
+
+
+def maschera_numpy(arr, soglia):
+    """Maschera booleana dei pixel con g > r + soglia e g > b + soglia"""
+    g_meno_soglia = arr[..., 1].astype(np.int16) - soglia
+    maschera = g_meno_soglia > arr[..., 0]
+    maschera &= g_meno_soglia > arr[..., 2]
+    return maschera
+
+
+def overlay_numpy(arr, maschera):
+    """Immagine RGBA con i soli pixel verdi opachi, il resto trasparente"""
+    altezza, larghezza = maschera.shape
+    output = np.zeros((altezza, larghezza, 4), dtype=np.uint8)
+    np.copyto(output[..., :3], arr, where=maschera[..., None])
+    output[..., 3] = maschera.view(np.uint8) * 255
+    return Image.fromarray(output)
+
+
+def maschera_pil(img_rgb, soglia):
+    """Maschera in modo 'L' (255 = verde) calcolata con l'aritmetica sulle bande di Pillow"""
+    r, g, b = img_rgb.split()
+    if soglia >= 0:
+        # ImageChops.subtract satura a 0: max(min(g - r, g - b), 0) > soglia equivale
+        # al confronto originale perché la soglia non è negativa
+        differenza = ImageChops.darker(ImageChops.subtract(g, r), ImageChops.subtract(g, b))
+        return differenza.point(lambda v: 255 if v > soglia else 0)
+    # Con soglia negativa si usa la parte negativa della differenza, max(r - g, b - g, 0)
+    differenza = ImageChops.lighter(ImageChops.subtract(r, g), ImageChops.subtract(b, g))
+    return differenza.point(lambda v: 255 if v < -soglia else 0)
+
+
+def overlay_pil(img_rgb, maschera):
+    """Come overlay_numpy, con una maschera Pillow in modo 'L' o '1'"""
+    output_img = Image.new('RGBA', img_rgb.size, (0, 0, 0, 0))
+    output_img.paste(img_rgb, (0, 0), maschera)
+    return output_img
+
+
+class CanaliRGB:
+    """Pixel RGB (array uint8 altezza x larghezza x 3) e grandezze derivate per i classificatori.
+
+    Le grandezze sono calcolate al primo uso e poi condivise: più classificatori applicati allo stesso
+    CanaliRGB convertono i canali in virgola mobile una volta sola.
+    """
+
+    def __init__(self, rgb):
+        self.rgb = rgb
+
+    @cached_property
+    def r(self):
+        return self.rgb[..., 0].astype(np.float32)
+
+    @cached_property
+    def g(self):
+        return self.rgb[..., 1].astype(np.float32)
+
+    @cached_property
+    def b(self):
+        return self.rgb[..., 2].astype(np.float32)
+
+    @cached_property
+    def somma(self):
+        return self.r + self.g + self.b
+
+    @cached_property
+    def hsv(self):
+        """(tonalità in gradi [0, 360), saturazione [0, 1], valore [0, 1])"""
+        massimo = np.maximum(np.maximum(self.r, self.g), self.b)
+        delta = massimo - np.minimum(np.minimum(self.r, self.g), self.b)
+        # Settore della tonalità secondo il canale massimo; a parità vale il primo, come in colorsys.
+        # La scelta è fatta con pesi 0/1 invece di np.where, che su maschere irregolari è molto più lento
+        peso_r = (self.r == massimo).astype(np.float32)
+        peso_g = ((self.g == massimo) & (peso_r == 0)).astype(np.float32)
+        peso_b = 1 - peso_r - peso_g
+        numeratore = peso_r * (self.g - self.b) + peso_g * (self.b - self.r) + peso_b * (self.r - self.g)
+        # Con delta nullo i tre canali sono uguali e il numeratore è già zero
+        np.divide(numeratore, delta, out=numeratore, where=delta > 0)
+        tonalita = numeratore + 2 * peso_g + 4 * peso_b
+        # tonalita è in [-1, 5]: riportata in [0, 6) senza modulo in virgola mobile
+        tonalita += 6 * (tonalita < 0)
+        tonalita *= 60
+        saturazione = np.divide(delta, massimo, out=np.zeros_like(massimo), where=massimo > 0)
+        return tonalita, saturazione, massimo / 255
+
+
+class Classificatore:
+    """Regola che decide quali pixel sono verdi (vegetazione).
+
+    Le sottoclassi implementano maschera(canali), che riceve un CanaliRGB e restituisce un array
+    booleano; vedi vegetation_detector per gli indici di vegetazione e per registrarne di nuovi.
+    """
+    nome = None
+
+    def maschera(self, canali):
+        raise NotImplementedError
+
+    def maschera_array(self, rgb):
+        return self.maschera(CanaliRGB(rgb))
+
+    @classmethod
+    def da_parametro(cls, testo):
+        """Crea il classificatore dal parametro scritto in riga di comando (di solito la soglia)"""
+        return cls(float(testo))
+
+    def __repr__(self):
+        parametri = ', '.join(f"{k}={v!r}" for k, v in vars(self).items())
+        return f"{type(self).__name__}({parametri})"
+
+
+class ClassificatoreStandard(Classificatore):
+    """La regola di sempre: g > r + soglia e g > b + soglia. È l'unica disponibile anche senza NumPy"""
+    nome = 'standard'
+
+    def __init__(self, soglia=5):
+        self.soglia = soglia
+
+    @classmethod
+    def da_parametro(cls, testo):
+        return cls(int(testo))
+
+    def maschera(self, canali):
+        return maschera_numpy(canali.rgb, normalizza_soglia(self.soglia))
+
+
+@dataclass
+class FaseProfilo:
+    """Tempo, pixel elaborati e memoria di picco di una fase, sommati su tutte le sue esecuzioni"""
+    nome: str
+    secondi: float = 0.0
+    chiamate: int = 0
+    pixel: int = 0
+    memoria_picco: int = None  # byte allocati oltre quelli già in uso all'inizio della fase
+
+
+class ProfiloAnalisi:
+    """Tempi, pixel e memoria di picco delle fasi di un'analisi (apertura, decodifica, maschera, ...).
+
+    Si passa come profilo= alle funzioni di analisi, che lo riportano anche nel campo profilo del
+    RisultatoVerde; le esecuzioni di una stessa fase (es. le bande di un'analisi interrompibile) si
+    sommano. Senza profilo non si misura nulla. Con memoria=True la memoria di picco di ogni fase è
+    misurata con tracemalloc: vede le allocazioni di Python e NumPy ma non i buffer interni di
+    Pillow, è globale per il processo e rallenta le fasi con molte piccole allocazioni.
+    """
+
+    def __init__(self, memoria=False):
+        self.fasi = {}
+        self.memoria = memoria
+        # tracemalloc viene fermato da chiudi() solo se è stato avviato qui
+        self._avviato_tracemalloc = memoria and not tracemalloc.is_tracing()
+        if self._avviato_tracemalloc:
+            tracemalloc.start()
+
+    def chiudi(self):
+        if self._avviato_tracemalloc:
+            tracemalloc.stop()
+            self._avviato_tracemalloc = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *eccezione):
+        self.chiudi()
+
+    @contextlib.contextmanager
+    def fase(self, nome, pixel=0):
+        """Misura il blocco with come fase nome; restituisce la FaseProfilo, a cui si possono aggiungere pixel"""
+        fase = self.fasi.get(nome)
+        if fase is None:
+            fase = self.fasi[nome] = FaseProfilo(nome)
+        memoria = self.memoria and tracemalloc.is_tracing()
+        if memoria:
+            tracemalloc.reset_peak()
+            memoria_iniziale = tracemalloc.get_traced_memory()[0]
+        inizio = time.perf_counter()
+        try:
+            yield fase
+        finally:
+            fase.secondi += time.perf_counter() - inizio
+            fase.chiamate += 1
+            fase.pixel += pixel
+            if memoria and tracemalloc.is_tracing():
+                picco = max(0, tracemalloc.get_traced_memory()[1] - memoria_iniziale)
+                fase.memoria_picco = max(fase.memoria_picco or 0, picco)
+
+    @property
+    def secondi_totali(self):
+        return sum(fase.secondi for fase in self.fasi.values())
+
+    def come_lista(self):
+        """Le fasi come dizionari, nell'ordine in cui sono state eseguite la prima volta"""
+        return [asdict(fase) for fase in self.fasi.values()]
+
+    def riepilogo(self):
+        """Una riga con i millisecondi di ogni fase, per una barra di stato"""
+        parti = [f"{fase.nome} {fase.secondi * 1000:.0f} ms" for fase in self.fasi.values()]
+        picchi = [fase.memoria_picco for fase in self.fasi.values() if fase.memoria_picco is not None]
+        totale = f"totale {self.secondi_totali * 1000:.0f} ms"
+        if picchi:
+            totale += f", picco {max(picchi) / 2 ** 20:.1f} MB"
+        return " · ".join(parti) + f" ({totale})"
+
+    def tabella(self):
+        """Tabella di testo con una riga per fase"""
+        righe = [f"{'fase':<18}{'secondi':>10}{'chiamate':>10}{'Mpixel':>10}{'picco MB':>10}"]
+        for fase in self.fasi.values():
+            picco = '-' if fase.memoria_picco is None else f"{fase.memoria_picco / 2 ** 20:.1f}"
+            righe.append(f"{fase.nome:<18}{fase.secondi:>10.4f}{fase.chiamate:>10}{fase.pixel / 1e6:>10.2f}{picco:>10}")
+        righe.append(f"{'totale':<18}{self.secondi_totali:>10.4f}")
+        return "\n".join(righe)
+
+
+# Contesto vuoto riusabile: senza profilo le fasi non costano quasi nulla
+_NESSUNA_FASE = contextlib.nullcontext()
+
+
+def _fase(profilo, nome, pixel=0):
+    if profilo is None:
+        return _NESSUNA_FASE
+    return profilo.fase(nome, pixel)
+
+
+def _dimensioni_pixel(pixel):
+    # Il controllo su Image.Image non importa NumPy quando si usa il motore pil
+    if isinstance(pixel, Image.Image):
+        return pixel.size
+    return pixel.shape[1], pixel.shape[0]
+
+
+def analizza_rgb(img_rgb, soglia, genera_immagine_output, motore, riquadri=None, genera_maschera=False,
+                 classificatore=None, profilo=None):
+    """Restituisce (pixel_verdi, pixel_totali, immagine_output, maschera) per un'immagine RGB già decodificata.
+
+    img_rgb può essere un'immagine Pillow in modo RGB o un array NumPy (altezza, larghezza, 3).
+    riquadri, se indicato, è una lista di riquadri (x1, y1, x2, y2) relativi a img_rgb:
+    vengono analizzati solo i pixel che cadono in almeno uno di essi.
+    maschera è una MascheraVerde se genera_maschera è vero, altrimenti None.
+    classificatore, se indicato, sostituisce la regola standard e la soglia.
+    profilo, se indicato, è un ProfiloAnalisi in cui si misurano le fasi.
+    """
+    if isinstance(classificatore, ClassificatoreStandard):
+        soglia, classificatore = classificatore.soglia, None
+    soglia = normalizza_soglia(soglia)
+    width, height = _dimensioni_pixel(img_rgb)
+    output_img = maschera_verde = None
+    if riquadri == [(0, 0, width, height)]:
+        riquadri = None
+
+    if scegli_motore(motore) == 'numpy':
+        arr = np.asarray(img_rgb)
+
+        def calcola_maschera(pixel):
+            if classificatore is not None:
+                return classificatore.maschera_array(pixel)
+            return maschera_numpy(pixel, soglia)
+
+        with _fase(profilo, 'maschera', width * height):
+            if riquadri is None:
+                maschera = calcola_maschera(arr)
+                pixel_totali = width * height
+            else:
+                # La maschera verde viene calcolata solo dentro i riquadri; le sovrapposizioni contano una volta
+                maschera = np.zeros((height, width), dtype=bool)
+                maschera_area = np.zeros((height, width), dtype=bool)
+                for x1, y1, x2, y2 in riquadri:
+                    maschera[y1:y2, x1:x2] = calcola_maschera(arr[y1:y2, x1:x2])
+                    maschera_area[y1:y2, x1:x2] = True
+                pixel_totali = int(np.count_nonzero(maschera_area))
+            pixel_verdi_cont = int(np.count_nonzero(maschera))
+        if genera_immagine_output:
+            with _fase(profilo, 'immagine_output', width * height):
+                output_img = overlay_numpy(arr, maschera)
+        if genera_maschera:
+            with _fase(profilo, 'maschera_bit', width * height):
+                maschera_verde = MascheraVerde.da_array(maschera)
+    else:
+        if classificatore is not None:
+            if np is None:
+                raise ImportError(f"Il classificatore {classificatore.nome} richiede NumPy (pip install numpy)")
+            raise ValueError(f"Il classificatore {classificatore.nome} richiede il motore numpy")
+        if not isinstance(img_rgb, Image.Image):
+            img_rgb = Image.fromarray(img_rgb)
+        with _fase(profilo, 'maschera', width * height):
+            if riquadri is None:
+                maschera = maschera_pil(img_rgb, soglia)
+                pixel_totali = width * height
+            else:
+                maschera = Image.new('L', (width, height), 0)
+                maschera_area = Image.new('L', (width, height), 0)
+                for riquadro in riquadri:
+                    maschera.paste(maschera_pil(img_rgb.crop(riquadro), soglia), riquadro[:2])
+                    maschera_area.paste(255, riquadro)
+                pixel_totali = maschera_area.histogram()[255]
+            pixel_verdi_cont = maschera.histogram()[255]
+        if genera_immagine_output:
+            with _fase(profilo, 'immagine_output', width * height):
+                output_img = overlay_pil(img_rgb, maschera)
+        if genera_maschera:
+            with _fase(profilo, 'maschera_bit', width * height):
+                maschera_verde = MascheraVerde.da_immagine(maschera)
+
+    return pixel_verdi_cont, pixel_totali, output_img, maschera_verde
+
+
+def _normalizza_riquadri(area_di_interesse, dimensioni):
+    """Converte l'area di interesse in una lista di riquadri (x1, y1, x2, y2) interi,
+    con coordinate ordinate e limitate ai bordi dell'immagine"""
+    width, height = dimensioni
+    if len(area_di_interesse) == 4 and all(isinstance(v, numbers.Real) for v in area_di_interesse):
+        area_di_interesse = [area_di_interesse]
+
+    riquadri = []
+    for x1, y1, x2, y2 in area_di_interesse:
+        x1, x2 = sorted(min(max(int(x), 0), width) for x in (x1, x2))
+        y1, y2 = sorted(min(max(int(y), 0), height) for y in (y1, y2))
+        if x2 > x1 and y2 > y1:
+            riquadri.append((x1, y1, x2, y2))
+    if not riquadri:
+        raise ValueError("L'area di interesse non contiene pixel dell'immagine")
+    return riquadri
+
+
+def _riquadro_contenitore(riquadri):
+    return (min(r[0] for r in riquadri), min(r[1] for r in riquadri),
+            max(r[2] for r in riquadri), max(r[3] for r in riquadri))
+
+
+# Byte per pixel dei rawmode più comuni, per calcolare il passo di riga quando il file non lo indica
+_BYTE_PER_PIXEL_RAW = {'L': 1, 'P': 1, 'RGB': 3, 'BGR': 3, 'RGBA': 4, 'BGRA': 4, 'RGBX': 4, 'BGRX': 4}
+
+
+def _tile_singola(img):
+    """L'unica tile di img se copre tutta l'immagine e ha la forma attesa (ImageFile._Tile di Pillow), altrimenti None.
+
+    La decodifica parziale modifica attributi interni di Pillow: se cambiano forma si ripiega
+    sulla decodifica completa invece di rischiare di leggere le righe sbagliate.
+    """
     width, height = img.size
-    data_rgb = list(img_rgb.getdata())
+    tile = img.tile[0] if isinstance(img.tile, list) and len(img.tile) == 1 else None
+    if not all(hasattr(tile, campo) for campo in ('codec_name', 'extents', 'offset', 'args', '_replace')):
+        return None
+    if tuple(tile.extents) != (0, 0, width, height) or not isinstance(tile.offset, int) or tile.offset < 0:
+        return None
+    return tile
+
+
+def _byte_file(img):
+    """Dimensione in byte del file da cui img è letta, None se non si può sapere"""
+    fp = getattr(img, 'fp', None)
+    try:
+        posizione = fp.tell()
+        fine = fp.seek(0, os.SEEK_END)
+        fp.seek(posizione)
+        return fine
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def _tile_raw(img):
+    """(tile, passo_riga, orientamento) se img è un'unica tile di dati raw non compressi, altrimenti None"""
+    width, height = img.size
+    tile = _tile_singola(img)
+    if img.format not in ('BMP', 'PPM', 'TGA', 'TIFF') or tile is None or tile.codec_name != 'raw':
+        return None
+    args = (tile.args,) if isinstance(tile.args, str) else tuple(tile.args)
+    rawmode, stride, orientamento = (args + (0, 1))[:3]
+    if not stride:
+        if rawmode not in _BYTE_PER_PIXEL_RAW:
+            return None
+        stride = width * _BYTE_PER_PIXEL_RAW[rawmode]
+    if not isinstance(stride, int) or orientamento not in (-1, 1):
+        return None
+    # Le righe devono stare tutte nel file, altrimenti passo o offset non sono quelli che sembrano
+    byte_file = _byte_file(img)
+    if byte_file is not None and tile.offset + abs(stride) * height > byte_file:
+        return None
+    return tile, abs(stride), orientamento
+
+
+def _imposta_dimensioni(img, dimensioni):
+    """Cambia le dimensioni dichiarate di img; False (img invariata) se gli attributi di Pillow non sono quelli attesi"""
+    if not hasattr(img, '_size'):
+        return False
+    originali = img.size
+    img._size = dimensioni
+    if img.size != dimensioni:
+        img._size = originali
+        return False
+    if hasattr(img, '_tile_size'):
+        # TiffImageFile alloca l'immagine in load_prepare con queste dimensioni
+        img._tile_size = dimensioni
+    return True
+
+
+def _prepara_decodifica_parziale(img, y1, y2):
+    """Come _limita_decodifica, senza controllare che la decodifica parziale funzioni con questa versione di Pillow"""
+    width, height = img.size
+    tile_raw = _tile_raw(img)
+    if tile_raw is not None:
+        tile, stride, orientamento = tile_raw
+        # Con orientamento -1 le righe sono memorizzate dal basso verso l'alto
+        prima_riga_file = y1 if orientamento >= 0 else height - y2
+        if not _imposta_dimensioni(img, (width, y2 - y1)):
+            return 0
+        img.tile = [tile._replace(extents=(0, 0, width, y2 - y1), offset=tile.offset + prima_riga_file * stride)]
+        return y1
+
+    tile = _tile_singola(img)
+    if (tile is not None and img.format == 'PNG' and tile.codec_name == 'zip' and not img.info.get('interlace') and
+            _imposta_dimensioni(img, (width, y2))):
+        # Lo stream zlib va letto dall'inizio, ma le righe dopo y2 non vengono decompresse
+        img.tile = [tile._replace(extents=(0, 0, width, y2))]
+    return 0
+
+
+def _immagine_di_prova(formato):
+    """File in memoria di un'immagine 7x9 in cui ogni pixel è diverso, per verificare la decodifica parziale"""
+    img = Image.new('RGB', (7, 9))
+    img.putdata([(x * 30, y * 25, (x * 9 + y) * 3) for y in range(9) for x in range(7)])
+    dati = io.BytesIO()
+    img.save(dati, formato)
+    return img, dati
+
+
+@lru_cache(maxsize=None)
+def _decodifica_parziale_verificata():
+    """True se con questa versione di Pillow la decodifica parziale restituisce le stesse righe di crop.
+
+    Si prova una volta sola per processo, su piccole immagini in memoria: PNG, BMP (righe dal basso)
+    e TIFF (righe dall'alto, con _tile_size).
+    """
+    for formato in ('PNG', 'BMP', 'TIFF'):
+        originale, dati = _immagine_di_prova(formato)
+        try:
+            with Image.open(dati) as img:
+                riga_iniziale = _prepara_decodifica_parziale(img, 3, 7)
+                parziale = img.convert('RGB').crop((0, 3 - riga_iniziale, 7, 7 - riga_iniziale))
+        except Exception:
+            return False
+        if parziale.size != (7, 4) or parziale.tobytes() != originale.crop((0, 3, 7, 7)).tobytes():
+            return False
+    return True
+
+
+def _limita_decodifica(img, y1, y2):
+    """Prepara img (aperta e non ancora caricata) in modo che load() decodifichi solo le righe [y1, y2).
+
+    Restituisce la riga dell'immagine originale che corrisponde alla prima riga decodificata.
+    Funziona solo per i formati con un'unica tile di cui si conosce la disposizione in memoria
+    (dati raw non compressi e PNG non interlacciati); negli altri casi, o se la disposizione non è
+    quella attesa o la decodifica parziale non supera la verifica con questa versione di Pillow,
+    non modifica nulla e l'immagine viene decodificata per intero.
+    """
+    if not _decodifica_parziale_verificata():
+        return 0
+    return _prepara_decodifica_parziale(img, y1, y2)
+
+
+def _decodifica_rgb(img, profilo=None, riquadro=None):
+    """Come converti_rgb(img.crop(riquadro)), con decodifica e conversione misurate come fasi separate del profilo"""
+    if profilo is None:
+        return converti_rgb(img if riquadro is None else img.crop(riquadro))
+    with profilo.fase('decodifica', img.width * img.height):
+        img.load()
+        if riquadro is not None:
+            img = img.crop(riquadro)
+    if img.mode == 'RGB':
+        return img
+    with profilo.fase('conversione_rgb', img.width * img.height):
+        return img.convert('RGB')
+
+
+# Fattori di riduzione per lato ammessi per l'analisi a risoluzione ridotta
+SCALE = (1, 2, 4, 8)
+
+
+def _livello_piramide(img, scala):
+    """Per un TIFF con livelli a risoluzione ridotta (pagine con NewSubfileType = 1) si posiziona sul
+    livello più ridotto il cui fattore divide scala e restituisce il fattore; 1 se non ce ne sono"""
+    if img.format != 'TIFF' or getattr(img, 'n_frames', 1) < 2:
+        return 1
+    larghezza, altezza = img.size
+    fattore_migliore, pagina_migliore = 1, 0
+    for pagina in range(1, img.n_frames):
+        img.seek(pagina)
+        if not img.tag_v2.get(254, 0) & 1:
+            continue
+        fattore = round(larghezza / img.width)
+        if (fattore in SCALE and scala % fattore == 0 and fattore > fattore_migliore and
+                abs(img.width - larghezza / fattore) <= 1 and abs(img.height - altezza / fattore) <= 1):
+            fattore_migliore, pagina_migliore = fattore, pagina
+    img.seek(pagina_migliore)
+    return fattore_migliore
+
+
+def _bozza_jpeg(img, scala):
+    """Per un JPEG (aperto e non ancora caricato) chiede la decodifica ridotta fino a scala volte per lato
+    (Image.draft, nel dominio DCT) e restituisce il fattore ottenuto; 1 per gli altri formati"""
+    if img.format != 'JPEG' or scala == 1:
+        return 1
+    # draft sceglie la riduzione più forte che non scende sotto le dimensioni indicate
+    larghezza = img.width
+    bozza = img.draft('RGB', (max(1, larghezza // scala), max(1, img.height // scala)))
+    if bozza is None:
+        return 1
+    # bozza è (modo, riquadro originale in pixel ridotti)
+    return round(larghezza / bozza[1][2])
+
+
+def _decodifica_ridotta(img, scala, profilo=None):
+    """Decodifica img (aperta e non ancora caricata) in RGB ridotta di scala volte per lato, come img.reduce(scala).
+
+    I JPEG vengono ridotti durante la decodifica (Image.draft, nel dominio DCT) e dei TIFF piramidali
+    si decodifica il livello adatto: in questi casi la decodifica costa una frazione di quella completa.
+    Il resto della riduzione è una media a blocchi (Image.reduce).
+    """
+    if img.format == 'JPEG':
+        fattore = _bozza_jpeg(img, scala)
+    else:
+        fattore = _livello_piramide(img, scala)
+    pixel = _decodifica_rgb(img, profilo)
+    if scala // fattore > 1:
+        with _fase(profilo, 'riduzione', pixel.width * pixel.height):
+            pixel = pixel.reduce(scala // fattore)
+    return pixel
+
+
+def _area_ridotta(area_di_interesse, dimensioni, scala):
+    """Area di interesse in pixel dell'immagine ridotta di scala volte: ogni riquadro copre i pixel ridotti che tocca"""
+    if area_di_interesse is None or scala == 1:
+        return area_di_interesse
+    return [(x1 // scala, y1 // scala, -(-x2 // scala), -(-y2 // scala))
+            for x1, y1, x2, y2 in _normalizza_riquadri(area_di_interesse, dimensioni)]
+
+
+def apri_regione(image_path, area_di_interesse=None, profilo=None, scala=1):
+    """Apre l'immagine decodificando solo le righe che servono all'area di interesse.
+
+    Restituisce l'immagine RGB ritagliata sul riquadro che contiene l'area e la lista
+    dei riquadri relativi a questo ritaglio (None se si analizza l'intera immagine).
+    Con scala > 1 l'immagine è decodificata ridotta (vedi _decodifica_ridotta) e
+    riquadri e ritaglio sono in pixel dell'immagine ridotta.
+    """
+    with _fase(profilo, 'apertura'):
+        img = Image.open(image_path)
+    if scala > 1:
+        dimensioni = img.size
+        return ritaglia(_decodifica_ridotta(img, scala, profilo), _area_ridotta(area_di_interesse, dimensioni, scala))
+    if area_di_interesse is None:
+        return _decodifica_rgb(img, profilo), None
+
+    riquadri = _normalizza_riquadri(area_di_interesse, img.size)
+    x1, y1, x2, y2 = _riquadro_contenitore(riquadri)
+    if (x1, y1, x2, y2) == (0, 0) + img.size:
+        return _decodifica_rgb(img, profilo), riquadri
+
+    riga_iniziale = _limita_decodifica(img, y1, y2)
+    img_regione = _decodifica_rgb(img, profilo, (x1, y1 - riga_iniziale, x2, y2 - riga_iniziale))
+    return img_regione, _riquadri_relativi(riquadri, (x1, y1))
+
+
+def carica_regione(image_path, area_di_interesse, motore, cache, profilo=None, scala=1):
+    """Come apri_regione, ma dalla CacheImmagini se indicata (come array se il motore è numpy)"""
+    if scala not in SCALE:
+        raise ValueError(f"Scala non valida: {scala} (ammesse: {', '.join(map(str, SCALE))})")
+    if cache is None:
+        return apri_regione(image_path, area_di_interesse, profilo, scala)
+    if scala > 1:
+        # L'immagine in cache è già decodificata a piena risoluzione: resta solo la riduzione
+        with _fase(profilo, 'decodifica'):
+            img_rgb = cache.immagine_rgb(image_path)
+        with _fase(profilo, 'riduzione', img_rgb.width * img_rgb.height):
+            ridotta = img_rgb.reduce(scala)
+        return ritaglia(ridotta, _area_ridotta(area_di_interesse, img_rgb.size, scala))
+    with _fase(profilo, 'decodifica') as fase:
+        img_rgb, riquadri = cache.regione(image_path, area_di_interesse, come_array=scegli_motore(motore) == 'numpy')
+        if fase is not None:
+            larghezza, altezza = _dimensioni_pixel(img_rgb)
+            fase.pixel += larghezza * altezza
+    return img_rgb, riquadri
+
+
+def _riquadri_relativi(riquadri, origine):
+    ox, oy = origine
+    return [(x1 - ox, y1 - oy, x2 - ox, y2 - oy) for x1, y1, x2, y2 in riquadri]
+
+
+def ritaglia(pixel, area_di_interesse):
+    """Come apri_regione, ma su pixel già decodificati (immagine RGB o array NumPy)"""
+    if area_di_interesse is None:
+        return pixel, None
+    riquadri = _normalizza_riquadri(area_di_interesse, _dimensioni_pixel(pixel))
+    x1, y1, x2, y2 = _riquadro_contenitore(riquadri)
+    if isinstance(pixel, Image.Image):
+        regione = pixel.crop((x1, y1, x2, y2))
+    else:
+        regione = pixel[y1:y2, x1:x2]  # vista, nessuna copia
+    return regione, _riquadri_relativi(riquadri, (x1, y1))
+
+
+class CacheImmagini:
+    """Cache LRU delle immagini decodificate, condivisa da anteprima, analisi e selezione.
+
+    Le voci sono indicizzate per percorso, data di modifica e dimensione del file, così un file
+    sovrascritto viene riletto. Ogni voce conserva i pixel una sola volta, come immagine Pillow
+    o come array NumPy a seconda dell'ultimo uso. Quando i byte occupati superano limite_byte
+    vengono scartate le immagini usate meno di recente. Le immagini e gli array restituiti sono
+    condivisi: non vanno modificati sul posto.
+    """
+
+    def __init__(self, limite_byte=512 * 1024 * 1024, limite_voci=256):
+        self.limite_byte = limite_byte
+        self.limite_voci = limite_voci
+        self._voci = OrderedDict()  # chiave -> {'dimensioni', 'pixel', 'anteprime', 'byte', 'decodifica'}
+        self._byte_usati = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _chiave(image_path):
+        stat = os.stat(image_path)
+        return (os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size)
+
+    @property
+    def byte_usati(self):
+        return self._byte_usati
+
+    def __len__(self):
+        return len(self._voci)
+
+    def _voce(self, chiave):
+        with self._lock:
+            voce = self._voci.get(chiave)
+            if voce is None:
+                # Le versioni precedenti dello stesso file non servono più
+                for vecchia in [c for c in self._voci if c[0] == chiave[0]]:
+                    self._byte_usati -= self._voci.pop(vecchia)['byte']
+                voce = self._voci[chiave] = {'dimensioni': None, 'pixel': None, 'anteprime': {}, 'byte': 0,
+                                             'decodifica': threading.Lock()}
+                if len(self._voci) > self.limite_voci:
+                    self._byte_usati -= self._voci.popitem(last=False)[1]['byte']
+            self._voci.move_to_end(chiave)
+            return voce
+
+    def _salva(self, chiave, voce, campo, valore):
+        with self._lock:
+            if campo == 'pixel':
+                byte_prima = _byte_pixel(voce['pixel'])
+                voce['pixel'] = valore
+                byte = _byte_pixel(valore) - byte_prima
+            else:
+                voce['anteprime'][campo] = valore
+                byte = _byte_pixel(valore)
+            if self._voci.get(chiave) is not voce:
+                return  # voce scartata nel frattempo: il valore si usa ma non si conserva
+            voce['byte'] += byte
+            self._byte_usati += byte
+            # Scarta le voci meno recenti; quella appena usata resta finché è l'unica
+            while self._byte_usati > self.limite_byte and len(self._voci) > 1:
+                _, scartata = self._voci.popitem(last=False)
+                self._byte_usati -= scartata['byte']
+            if self._byte_usati > self.limite_byte:
+                self._voci.clear()
+                self._byte_usati = 0
+
+    def dimensioni(self, image_path):
+        """Dimensioni (larghezza, altezza) dell'immagine; se non è in cache legge solo l'intestazione"""
+        voce = self._voce(self._chiave(image_path))
+        if voce['dimensioni'] is None:
+            with Image.open(image_path) as img:
+                voce['dimensioni'] = img.size
+        return voce['dimensioni']
+
+    def immagine_rgb(self, image_path):
+        """Immagine intera decodificata in modo RGB; più thread che la chiedono insieme la decodificano una volta"""
+        chiave = self._chiave(image_path)
+        voce = self._voce(chiave)
+        with voce['decodifica']:
+            pixel = voce['pixel']
+            if isinstance(pixel, Image.Image):
+                return pixel
+            if pixel is not None:
+                return Image.fromarray(pixel)
+            img_rgb = converti_rgb(Image.open(image_path))
+            voce['dimensioni'] = img_rgb.size
+            self._salva(chiave, voce, 'pixel', img_rgb)
+            return img_rgb
+
+    def array_rgb(self, image_path):
+        """Array NumPy (altezza, larghezza, 3) in sola lettura con i pixel dell'immagine"""
+        chiave = self._chiave(image_path)
+        voce = self._voce(chiave)
+        if voce['pixel'] is not None and not isinstance(voce['pixel'], Image.Image):
+            return voce['pixel']
+        arr = np.asarray(self.immagine_rgb(image_path))
+        arr.flags.writeable = False
+        # L'array sostituisce l'immagine Pillow, che occupa un byte in più per pixel
+        self._salva(chiave, voce, 'pixel', arr)
+        return arr
+
+    def anteprima(self, image_path, dimensione_max=(400, 400)):
+        """Miniatura RGB che sta in dimensione_max, calcolata una sola volta per immagine"""
+        chiave = self._chiave(image_path)
+        voce = self._voce(chiave)
+        dimensione_max = tuple(dimensione_max)
+        if dimensione_max in voce['anteprime']:
+            return voce['anteprime'][dimensione_max]
+        img_rgb = self.immagine_rgb(image_path)
+        if img_rgb.width <= dimensione_max[0] and img_rgb.height <= dimensione_max[1]:
+            miniatura = img_rgb.copy()
+        else:
+            miniatura = ImageOps.contain(img_rgb, dimensione_max)
+        self._salva(chiave, voce, dimensione_max, miniatura)
+        return miniatura
+
+    def ha_pixel(self, image_path):
+        """True se l'immagine è già decodificata in cache"""
+        with self._lock:
+            voce = self._voci.get(self._chiave(image_path))
+            return voce is not None and voce['pixel'] is not None
+
+    def regione(self, image_path, area_di_interesse=None, come_array=False):
+        """Pixel dell'area di interesse e riquadri relativi, come apri_regione ma senza decodificare di nuovo"""
+        pixel = self.array_rgb(image_path) if come_array else self.immagine_rgb(image_path)
+        return ritaglia(pixel, area_di_interesse)
+
+    def svuota(self):
+        with self._lock:
+            self._voci.clear()
+            self._byte_usati = 0
+
+
+def _byte_pixel(pixel):
+    if pixel is None:
+        return 0
+    if isinstance(pixel, Image.Image):
+        # Pillow memorizza i pixel RGB su 4 byte
+        return pixel.width * pixel.height * 4
+    return pixel.nbytes
+
+
+def percentuale_pixel(pixel_verdi, pixel_totali):
+    """Percentuale arrotondata a due decimali, come in tutti i risultati (0 senza pixel)"""
+    return round((pixel_verdi / pixel_totali) * 100, 2) if pixel_totali > 0 else 0
+
+
+def _byte_per_riga(larghezza):
+    return (larghezza + 7) // 8
+
 
+class MascheraVerde:
+    """Maschera dei pixel verdi compressa a 1 bit per pixel, 1/32 della memoria di un overlay RGBA.
+
+    I bit sono nel formato grezzo del modo '1' di Pillow (il bit più significativo è il pixel più
+    a sinistra, ogni riga occupa un numero intero di byte), lo stesso di numpy.packbits sulle righe.
+    L'immagine dei pixel verdi non viene conservata: disegna() la crea solo quando serve, alle
+    dimensioni richieste. Le maschere si combinano con &, |, ^, - (differenza) e ~.
+    """
+
+    # Intestazione dei file RLE: firma, larghezza, altezza
+    _FIRMA_RLE = b'MVRLE\x01'
+    _INTESTAZIONE_RLE = struct.Struct('<6sII')
+
+    def __init__(self, dati, dimensioni):
+        larghezza, altezza = dimensioni
+        if len(dati) != _byte_per_riga(larghezza) * altezza:
+            raise ValueError("I dati non corrispondono alle dimensioni della maschera")
+        self.dati = bytes(dati)
+        self.dimensioni = (larghezza, altezza)
+        self._pixel_verdi = None
+
+    @classmethod
+    def da_array(cls, maschera):
+        """Da un array booleano (altezza, larghezza)"""
+        altezza, larghezza = maschera.shape
+        return cls(np.packbits(maschera, axis=1).tobytes(), (larghezza, altezza))
+
+    @classmethod
+    def da_immagine(cls, img):
+        """Da un'immagine Pillow: sono verdi i pixel non nulli (per RGBA si usa il canale alfa)"""
+        if img.mode == 'RGBA':
+            img = img.getchannel('A')
+        if img.mode != '1':
+            img = img.point(lambda v: 255 if v else 0, '1')
+        return cls(img.tobytes(), img.size)
+
+    @classmethod
+    def carica(cls, percorso):
+        """Legge una maschera salvata con salva(), in formato RLE o come immagine"""
+        with open(percorso, 'rb') as f:
+            firma = f.read(len(cls._FIRMA_RLE))
+        if firma == cls._FIRMA_RLE:
+            return cls._da_rle(percorso)
+        with Image.open(percorso) as img:
+            return cls.da_immagine(img)
+
+    @property
+    def larghezza(self):
+        return self.dimensioni[0]
+
+    @property
+    def altezza(self):
+        return self.dimensioni[1]
+
+    @property
+    def nbytes(self):
+        return len(self.dati)
+
+    @property
+    def pixel_verdi(self):
+        # I bit di riempimento a fine riga sono sempre zero: basta contare i bit a 1
+        if self._pixel_verdi is None:
+            self._pixel_verdi = int.from_bytes(self.dati, 'big').bit_count()
+        return self._pixel_verdi
+
+    def __repr__(self):
+        return f"MascheraVerde({self.larghezza}x{self.altezza}, pixel_verdi={self.pixel_verdi})"
+
+    def __eq__(self, altra):
+        if not isinstance(altra, MascheraVerde):
+            return NotImplemented
+        return self.dimensioni == altra.dimensioni and self.dati == altra.dati
+
+    def come_immagine(self):
+        """Immagine Pillow in modo '1' (in memoria Pillow usa un byte per pixel)"""
+        return Image.frombytes('1', self.dimensioni, self.dati)
+
+    def come_array(self):
+        """Array booleano (altezza, larghezza); richiede NumPy"""
+        return self.righe_array(slice(None)).astype(bool)
+
+    def righe_array(self, righe):
+        """Array uint8 (0/1) delle righe indicate (slice o indici), senza espandere il resto della maschera; richiede NumPy"""
+        bit = np.frombuffer(self.dati, dtype=np.uint8).reshape(self.altezza, _byte_per_riga(self.larghezza))
+        return np.unpackbits(bit[righe], axis=1, count=self.larghezza)
+
+    def _ridotta(self, dimensioni):
+        """Maschera in modo 'L' alle dimensioni indicate, con il vicino più prossimo"""
+        if dimensioni == self.dimensioni:
+            return self.come_immagine()
+        if np is None:
+            return self.come_immagine().resize(dimensioni, Image.Resampling.NEAREST)
+        # Si espandono solo le righe e le colonne campionate, non l'intera maschera
+        larghezza, altezza = dimensioni
+        # Centro di ogni pixel di destinazione, come il NEAREST di Pillow
+        righe = ((2 * np.arange(altezza) + 1) * self.altezza) // (2 * altezza)
+        colonne = ((2 * np.arange(larghezza) + 1) * self.larghezza) // (2 * larghezza)
+        return Image.fromarray(self.righe_array(righe)[:, colonne] * np.uint8(255))
+
+    def disegna(self, sorgente=None, dimensioni=None, colore=(0, 255, 0)):
+        """Immagine RGBA dei pixel verdi alle dimensioni indicate (default: quelle della maschera).
+
+        Con sorgente (immagine Pillow o array RGB, anche già rimpicciolita) i pixel verdi hanno il
+        colore originale, altrimenti il colore indicato; gli altri pixel sono trasparenti.
+        """
+        dimensioni = tuple(dimensioni) if dimensioni is not None else self.dimensioni
+        maschera = self._ridotta(dimensioni)
+        output_img = Image.new('RGBA', dimensioni, (0, 0, 0, 0))
+        if sorgente is None:
+            output_img.paste(tuple(colore) + (255,), (0, 0) + dimensioni, maschera)
+            return output_img
+        if not isinstance(sorgente, Image.Image):
+            sorgente = Image.fromarray(np.asarray(sorgente))
+        sorgente = converti_rgb(sorgente)
+        if sorgente.size != dimensioni:
+            sorgente = sorgente.resize(dimensioni, Image.Resampling.BILINEAR)
+        output_img.paste(sorgente, (0, 0), maschera)
+        return output_img
+
+    def salva(self, percorso, formato=None):
+        """Salva la maschera come PNG a 1 bit (default) o, con formato='rle' o estensione .rle,
+        come sequenza di lunghezze compressa, più compatta per maschere a grandi zone uniformi"""
+        if formato is None:
+            formato = 'rle' if percorso.lower().endswith('.rle') else 'png'
+        if formato.lower() != 'rle':
+            self.come_immagine().save(percorso, formato)
+            return
+        if np is None:
+            raise ImportError("Il formato RLE richiede NumPy")
+        bit = self.righe_array(slice(None)).ravel()
+        cambi = np.flatnonzero(bit[1:] != bit[:-1]) + 1
+        confini = np.concatenate(([0], cambi, [bit.size]))
+        lunghezze = np.diff(confini)
+        if bit.size and bit[0]:
+            # Le lunghezze si alternano partendo sempre da una sequenza di pixel non verdi
+            lunghezze = np.concatenate(([0], lunghezze))
+        with open(percorso, 'wb') as f:
+            f.write(self._INTESTAZIONE_RLE.pack(self._FIRMA_RLE, self.larghezza, self.altezza))
+            f.write(zlib.compress(lunghezze.astype('<u4').tobytes()))
+
+    @classmethod
+    def _da_rle(cls, percorso):
+        if np is None:
+            raise ImportError("Il formato RLE richiede NumPy")
+        with open(percorso, 'rb') as f:
+            _, larghezza, altezza = cls._INTESTAZIONE_RLE.unpack(f.read(cls._INTESTAZIONE_RLE.size))
+            lunghezze = np.frombuffer(zlib.decompress(f.read()), dtype='<u4')
+        valori = np.arange(lunghezze.size, dtype=np.uint8) & 1
+        bit = np.repeat(valori, lunghezze)
+        if bit.size != larghezza * altezza:
+            raise ValueError(f"File RLE non valido: {percorso}")
+        return cls.da_array(bit.reshape(altezza, larghezza).astype(bool))
+
+    def _combina(self, altra, operazione):
+        if not isinstance(altra, MascheraVerde):
+            return NotImplemented
+        if altra.dimensioni != self.dimensioni:
+            raise ValueError("Le maschere hanno dimensioni diverse")
+        a = int.from_bytes(self.dati, 'big')
+        b = int.from_bytes(altra.dati, 'big')
+        return MascheraVerde(operazione(a, b).to_bytes(len(self.dati), 'big'), self.dimensioni)
+
+    def __and__(self, altra):
+        return self._combina(altra, lambda a, b: a & b)
+
+    def __or__(self, altra):
+        return self._combina(altra, lambda a, b: a | b)
+
+    def __xor__(self, altra):
+        return self._combina(altra, lambda a, b: a ^ b)
+
+    def __sub__(self, altra):
+        return self._combina(altra, lambda a, b: a & ~b)
+
+    def __invert__(self):
+        # Si invertono solo i bit dei pixel, non quelli di riempimento a fine riga
+        piene, resto = divmod(self.larghezza, 8)
+        riga = b'\xff' * piene + (bytes([(0xff << (8 - resto)) & 0xff]) if resto else b'')
+        validi = int.from_bytes(riga * self.altezza, 'big')
+        return MascheraVerde((int.from_bytes(self.dati, 'big') ^ validi).to_bytes(len(self.dati), 'big'),
+                             self.dimensioni)
+
+
+@dataclass
+class RisultatoVerde:
+    """Esito dettagliato di un'analisi: percentuale, conteggi e immagine o MascheraVerde dei pixel verdi (se richieste).
+
+    Per le stime (esatta=False) i conteggi si riferiscono al campione analizzato e margine_errore
+    è la semiampiezza, in punti percentuali, dell'intervallo di confidenza al 95%. Con scala > 1
+    l'immagine è stata analizzata ridotta di scala volte per lato: conteggi, immagine e maschera
+    si riferiscono all'immagine ridotta.
+    """
+    percentuale: float
+    pixel_verdi: int
+    pixel_totali: int
+    immagine_output: object = None
+    esatta: bool = True
+    margine_errore: float = 0.0
+    maschera: object = None
+    profilo: object = None
+    scala: int = 1
+
+
+class AnalisiAnnullata(Exception):
+    """Sollevata quando un'analisi viene interrotta tramite l'evento annulla"""
+
+
+# Numero di bande in cui si divide l'analisi quando servono avanzamento o annullamento
+_BANDE_INTERROMPIBILI = 16
+
+
+def _controlla_annullamento(annulla):
+    if annulla is not None and annulla.is_set():
+        raise AnalisiAnnullata()
+
+
+def _analizza_a_bande(pixel, soglia, genera_immagine_output, motore, riquadri, annulla, progresso,
+                      genera_maschera=False, classificatore=None, profilo=None):
+    """Come analizza_rgb, ma per bande orizzontali, controllando annulla e riportando l'avanzamento"""
+    width, height = _dimensioni_pixel(pixel)
+    if riquadri is None:
+        riquadri = [(0, 0, width, height)]
+    altezza_banda = max(64, -(-height // _BANDE_INTERROMPIBILI))
+    output_img = Image.new('RGBA', (width, height), (0, 0, 0, 0)) if genera_immagine_output else None
+    # Le righe della maschera occupano byte interi: le bande si concatenano direttamente
+    bit_maschera = [] if genera_maschera else None
+    pixel_verdi_cont = pixel_totali = 0
+
+    for y in range(0, height, altezza_banda):
+        _controlla_annullamento(annulla)
+        y2 = min(y + altezza_banda, height)
+        riquadri_banda = [(x1, max(ry1, y) - y, x2, min(ry2, y2) - y)
+                          for x1, ry1, x2, ry2 in riquadri if ry1 < y2 and ry2 > y]
+        if riquadri_banda:
+            if isinstance(pixel, Image.Image):
+                banda = pixel.crop((0, y, width, y2))
+            else:
+                banda = pixel[y:y2]
+            verdi, totali, output_banda, maschera_banda = analizza_rgb(
+                banda, soglia, genera_immagine_output, motore, riquadri_banda, genera_maschera, classificatore, profilo)
+            pixel_verdi_cont += verdi
+            pixel_totali += totali
+            if output_banda is not None:
+                with _fase(profilo, 'immagine_output'):
+                    output_img.paste(output_banda, (0, y))
+            if maschera_banda is not None:
+                bit_maschera.append(maschera_banda.dati)
+        elif genera_maschera:
+            bit_maschera.append(bytes(_byte_per_riga(width) * (y2 - y)))
+        if progresso is not None:
+            progresso(y2 / height)
+    maschera = MascheraVerde(b''.join(bit_maschera), (width, height)) if genera_maschera else None
+    return pixel_verdi_cont, pixel_totali, output_img, maschera
+
+
+def analizza_verde(image_path, soglia=5, genera_immagine_output=False, motore=None, area_di_interesse=None,
+                   cache=None, annulla=None, progresso=None, genera_maschera=False, classificatore=None, profilo=None,
+                   scala=1):
+    """Come calcola_percentuale_verde, ma restituisce un RisultatoVerde con i conteggi dei pixel.
+
+    Con genera_maschera=True il risultato contiene anche una MascheraVerde a 1 bit per pixel, da cui
+    l'immagine dei pixel verdi si può disegnare alle dimensioni che servono: quando non serve a piena
+    risoluzione conviene a genera_immagine_output, che costruisce un'immagine RGBA a 4 byte per pixel.
+
+    annulla è un threading.Event: se viene impostato durante l'analisi si solleva AnalisiAnnullata.
+    progresso, se indicato, viene chiamato con la frazione di immagine analizzata (da 0 a 1).
+    Entrambi sono controllati tra una banda e l'altra dell'immagine, non durante la decodifica.
+    Con un ProfiloAnalisi in profilo si misurano le fasi dell'analisi; il profilo è riportato nel risultato.
+    scala (1, 2, 4 o 8) analizza l'immagine ridotta di scala volte per lato, vedi calcola_percentuale_verde.
+    """
+    img_rgb, riquadri = carica_regione(image_path, area_di_interesse, motore, cache, profilo, scala)
+
+    if annulla is None and progresso is None:
+        pixel_verdi_cont, pixel_totali, output_img, maschera = analizza_rgb(
+            img_rgb, soglia, genera_immagine_output, motore, riquadri, genera_maschera, classificatore, profilo)
+    else:
+        pixel_verdi_cont, pixel_totali, output_img, maschera = _analizza_a_bande(
+            img_rgb, soglia, genera_immagine_output, motore, riquadri, annulla, progresso, genera_maschera,
+            classificatore, profilo)
+    return RisultatoVerde(percentuale_pixel(pixel_verdi_cont, pixel_totali), pixel_verdi_cont, pixel_totali, output_img,
+                          maschera=maschera, profilo=profilo, scala=scala)
+
+
+def analizza_pixel(pixel, soglia=5, genera_immagine_output=False, motore=None, area_di_interesse=None,
+                   genera_maschera=False, classificatore=None, profilo=None):
+    """Come analizza_verde, ma su pixel già decodificati: un'immagine Pillow o un array (altezza, larghezza, 3) RGB.
+
+    Serve per fotogrammi video e altre sorgenti che non sono file immagine.
+    """
+    if isinstance(pixel, Image.Image):
+        pixel = _decodifica_rgb(pixel, profilo)
+    regione, riquadri = ritaglia(pixel, area_di_interesse)
+    pixel_verdi_cont, pixel_totali, output_img, maschera = analizza_rgb(
+        regione, soglia, genera_immagine_output, motore, riquadri, genera_maschera, classificatore, profilo)
+    return RisultatoVerde(percentuale_pixel(pixel_verdi_cont, pixel_totali), pixel_verdi_cont, pixel_totali, output_img,
+                          maschera=maschera, profilo=profilo)
+
+
+def _dimensioni_anteprima(dimensioni, dimensione_max):
+    # Come Image.thumbnail: proporzioni mantenute, mai ingrandita
+    larghezza, altezza = dimensioni
+    scala = min(1, dimensione_max[0] / larghezza, dimensione_max[1] / altezza)
+    return max(1, round(larghezza * scala)), max(1, round(altezza * scala))
+
+
+def _riduci(pixel, dimensioni):
+    """Immagine Pillow dei pixel ridotta alle dimensioni indicate"""
+    if isinstance(pixel, Image.Image):
+        img = pixel
+    else:
+        # Da un array si prende prima un pixel ogni passo, così non si converte l'intera immagine
+        larghezza, altezza = _dimensioni_pixel(pixel)
+        passo = max(1, min(larghezza // dimensioni[0], altezza // dimensioni[1]))
+        img = Image.fromarray(np.ascontiguousarray(pixel[::passo, ::passo]))
+    if img.size == dimensioni:
+        return img
+    return img.resize(dimensioni, Image.Resampling.BILINEAR, reducing_gap=2.0)
+
+
+def analizza_anteprima(image_path, dimensione_max=(400, 400), soglia=5, motore=None, area_di_interesse=None,
+                       cache=None, annulla=None, progresso=None, classificatore=None, profilo=None):
+    """Conteggio esatto a piena risoluzione con l'immagine dei pixel verdi già alle dimensioni dell'anteprima.
+
+    Equivale ad analizza_verde con genera_immagine_output=True seguito da thumbnail(dimensione_max),
+    ma l'immagine RGBA a piena risoluzione non viene mai costruita: si calcola la MascheraVerde a 1 bit
+    e l'immagine viene disegnata direttamente alle dimensioni finali. Con un'area di interesse copre il
+    riquadro che la contiene, come in analizza_verde. Il RisultatoVerde contiene anche la maschera.
+    """
+    img_rgb, riquadri = carica_regione(image_path, area_di_interesse, motore, cache, profilo)
+
+    if annulla is None and progresso is None:
+        pixel_verdi_cont, pixel_totali, _, maschera = analizza_rgb(
+            img_rgb, soglia, False, motore, riquadri, True, classificatore, profilo)
+    else:
+        pixel_verdi_cont, pixel_totali, _, maschera = _analizza_a_bande(
+            img_rgb, soglia, False, motore, riquadri, annulla, progresso, True, classificatore, profilo)
+
+    with _fase(profilo, 'anteprima') as fase:
+        if area_di_interesse is None and cache is not None:
+            # La miniatura dell'immagine intera è già in cache per il pannello dell'originale
+            sorgente = cache.anteprima(image_path, dimensione_max)
+        else:
+            sorgente = _riduci(img_rgb, _dimensioni_anteprima(_dimensioni_pixel(img_rgb), dimensione_max))
+        immagine_output = maschera.disegna(sorgente, sorgente.size)
+        if fase is not None:
+            fase.pixel += sorgente.width * sorgente.height
+    return RisultatoVerde(percentuale_pixel(pixel_verdi_cont, pixel_totali), pixel_verdi_cont, pixel_totali,
+                          immagine_output, maschera=maschera, profilo=profilo)
+
+
+# Le differenze min(g - r, g - b) vanno da -255 a 255: l'istogramma ha un contenitore per valore
+_VALORI_DIFFERENZA = 511
+
+
+def _istogramma_differenze(pixel, riquadri, motore):
+    """Istogramma di min(g - r, g - b) sui pixel (solo nei riquadri, se indicati).
+
+    L'elemento i conta i pixel con differenza i - 255. Un pixel è verde per la soglia s
+    se e solo se la sua differenza è maggiore di s.
+    """
+    width, height = _dimensioni_pixel(pixel)
+    if scegli_motore(motore) == 'numpy':
+        arr = np.asarray(pixel)
+        selezione = None
+        if riquadri is not None:
+            selezione = np.zeros((height, width), dtype=bool)
+            for x1, y1, x2, y2 in riquadri:
+                selezione[y1:y2, x1:x2] = True
+        istogramma = np.zeros(_VALORI_DIFFERENZA, dtype=np.int64)
+        # Per bande, per non allocare interi a 64 bit grandi quanto l'immagine in bincount
+        altezza_banda = max(1, (1 << 20) // max(width, 1))
+        for y in range(0, height, altezza_banda):
+            banda = arr[y:y + altezza_banda].astype(np.int16)
+            differenza = np.minimum(banda[..., 1] - banda[..., 0], banda[..., 1] - banda[..., 2])
+            differenza += 255
+            if selezione is not None:
+                differenza = differenza[selezione[y:y + altezza_banda]]
+            istogramma += np.bincount(differenza.ravel(), minlength=_VALORI_DIFFERENZA)
+        return [int(v) for v in istogramma]
+
+    img_rgb = pixel if isinstance(pixel, Image.Image) else Image.fromarray(pixel)
+    maschera_area = None
+    if riquadri is not None:
+        maschera_area = Image.new('L', (width, height), 0)
+        for riquadro in riquadri:
+            maschera_area.paste(255, riquadro)
+    r, g, b = img_rgb.split()
+    # max(d, 0) e max(-d, 0): la sottrazione di Pillow satura a zero
+    positivi = ImageChops.darker(ImageChops.subtract(g, r), ImageChops.subtract(g, b)).histogram(maschera_area)
+    negativi = ImageChops.lighter(ImageChops.subtract(r, g), ImageChops.subtract(b, g)).histogram(maschera_area)
+    istogramma = [0] * _VALORI_DIFFERENZA
+    for v in range(1, 256):
+        istogramma[255 + v] = positivi[v]
+        istogramma[255 - v] = negativi[v]
+    # I pixel con max(d, 0) = 0 sono quelli con d = 0 più tutti quelli con d negativo
+    istogramma[255] = positivi[0] - sum(negativi[1:])
+    return istogramma
+
+
+def percentuali_per_soglie(image_path, soglie=range(0, 256), motore=None, area_di_interesse=None, cache=None):
+    """Percentuale di verde per ogni soglia in soglie, con una sola passata sull'immagine.
+
+    Si calcola una volta l'istogramma di min(g - r, g - b) e, dalla sua somma cumulativa, il numero
+    di pixel verdi per ogni soglia. Restituisce un dizionario {soglia: percentuale} con gli stessi
+    valori che darebbe calcola_percentuale_verde chiamata soglia per soglia.
+    """
+    if cache is not None:
+        pixel, riquadri = cache.regione(image_path, area_di_interesse, come_array=scegli_motore(motore) == 'numpy')
+    else:
+        pixel, riquadri = apri_regione(image_path, area_di_interesse)
+    istogramma = _istogramma_differenze(pixel, riquadri, motore)
+    pixel_totali = sum(istogramma)
+
+    # verdi_oltre[i] = pixel con differenza > i - 255
+    verdi_oltre = [0] * _VALORI_DIFFERENZA
+    cumulata = 0
+    for i in range(_VALORI_DIFFERENZA - 1, -1, -1):
+        verdi_oltre[i] = cumulata
+        cumulata += istogramma[i]
+
+    percentuali = {}
+    for soglia in soglie:
+        soglia_normalizzata = normalizza_soglia(soglia)
+        verdi = pixel_totali if soglia_normalizzata < -255 else verdi_oltre[soglia_normalizzata + 255]
+        percentuali[soglia] = percentuale_pixel(verdi, pixel_totali)
+    return percentuali
+
+
+def _intervallo_soglie(testo):
+    """Interpreta "a:b" (estremi inclusi) o un elenco "a,b,c" di soglie"""
+    if ':' in testo:
+        inizio, fine = (int(v) for v in testo.split(':', 1))
+        passo = 1 if fine >= inizio else -1
+        return list(range(inizio, fine + passo, passo))
+    return [int(v) for v in testo.split(',') if v.strip()]
+
+
+def _griglia(testo):
+    """Interpreta "righexcolonne" (es. "32x32"; "8" equivale a "8x8") come coppia (righe, colonne)"""
+    righe, _, colonne = testo.lower().partition('x')
+    griglia = int(righe), int(colonne or righe)
+    if min(griglia) < 1:
+        raise ValueError(testo)
+    return griglia
+
+
+class IndiceVerde:
+    """Immagine integrale (tabella delle somme) della maschera verde di un'immagine per una soglia.
+
+    Si costruisce con una sola passata sull'immagine; dopo, il numero di pixel verdi di un qualsiasi
+    riquadro si ottiene con quattro letture, indipendentemente dalla sua dimensione. Richiede NumPy.
+    """
+
+    def __init__(self, maschera, soglia=None):
+        if np is None:
+            raise ImportError("IndiceVerde richiede NumPy (pip install numpy)")
+        altezza, larghezza = maschera.shape
+        self.dimensioni = (larghezza, altezza)
+        self.soglia = soglia
+        dtype = np.uint32 if larghezza * altezza < 2 ** 32 else np.uint64
+        # Riga e colonna iniziali a zero: somme[y, x] = pixel verdi nel riquadro (0, 0, x, y)
+        self._somme = np.zeros((altezza + 1, larghezza + 1), dtype=dtype)
+        np.cumsum(maschera, axis=0, dtype=dtype, out=self._somme[1:, 1:])
+        np.cumsum(self._somme[1:, 1:], axis=1, dtype=dtype, out=self._somme[1:, 1:])
+
+    @classmethod
+    def da_immagine(cls, image_path, soglia=5, cache=None):
+        """Costruisce l'indice decodificando l'immagine (o riusando quella in cache)"""
+        if np is None:
+            raise ImportError("IndiceVerde richiede NumPy (pip install numpy)")
+        arr = cache.array_rgb(image_path) if cache is not None else np.asarray(converti_rgb(Image.open(image_path)))
+        return cls(maschera_numpy(arr, normalizza_soglia(soglia)), soglia)
+
+    @property
+    def pixel_verdi(self):
+        return int(self._somme[-1, -1])
+
+    def conta(self, riquadro):
+        """Pixel verdi nel riquadro (x1, y1, x2, y2), con le stesse regole di area_di_interesse"""
+        x1, y1, x2, y2 = _normalizza_riquadri(riquadro, self.dimensioni)[0]
+        s = self._somme
+        return int(s[y2, x2]) - int(s[y1, x2]) - int(s[y2, x1]) + int(s[y1, x1])
+
+    def percentuale(self, riquadro=None):
+        """Percentuale di verde nel riquadro (nell'intera immagine se None), come calcola_percentuale_verde"""
+        if riquadro is None:
+            return percentuale_pixel(self.pixel_verdi, self.dimensioni[0] * self.dimensioni[1])
+        x1, y1, x2, y2 = _normalizza_riquadri(riquadro, self.dimensioni)[0]
+        return percentuale_pixel(self.conta((x1, y1, x2, y2)), (x2 - x1) * (y2 - y1))
+
+    def conta_molti(self, riquadri):
+        """Pixel verdi di molti riquadri in una volta: riquadri è una sequenza o un array (n, 4).
+
+        Le coordinate vengono ordinate e limitate all'immagine; i riquadri vuoti contano zero.
+        """
+        riquadri = np.asarray(riquadri, dtype=np.int64).reshape(-1, 4)
+        larghezza, altezza = self.dimensioni
+        xs = np.clip(riquadri[:, [0, 2]], 0, larghezza)
+        ys = np.clip(riquadri[:, [1, 3]], 0, altezza)
+        x1, x2 = xs.min(axis=1), xs.max(axis=1)
+        y1, y2 = ys.min(axis=1), ys.max(axis=1)
+        s = self._somme
+        return (s[y2, x2].astype(np.int64) - s[y1, x2].astype(np.int64)
+                - s[y2, x1].astype(np.int64) + s[y1, x1].astype(np.int64))
+
+    def percentuali(self, riquadri):
+        """Percentuali di verde di molti riquadri (0 per i riquadri vuoti), arrotondate come le altre API"""
+        riquadri = np.asarray(riquadri, dtype=np.int64).reshape(-1, 4)
+        larghezza, altezza = self.dimensioni
+        xs = np.clip(riquadri[:, [0, 2]], 0, larghezza)
+        ys = np.clip(riquadri[:, [1, 3]], 0, altezza)
+        aree = (xs.max(axis=1) - xs.min(axis=1)) * (ys.max(axis=1) - ys.min(axis=1))
+        conteggi = self.conta_molti(riquadri)
+        # Arrotondamento di Python, per ottenere esattamente i valori di calcola_percentuale_verde
+        return np.array([percentuale_pixel(int(c), int(a)) for c, a in zip(conteggi, aree)], dtype=float)
+
+
+# Numero indicativo di pixel su cui si calcola la stima rapida della modalità progressiva
+PIXEL_STIMA = 65536
+
+
+def _margine_errore(pixel_verdi, pixel_totali):
+    """Semiampiezza massima, in punti percentuali, dell'intervallo di Wilson al 95% per la proporzione"""
+    if pixel_totali == 0:
+        return 0.0
+    z = 1.96
+    p = pixel_verdi / pixel_totali
+    denominatore = 1 + z * z / pixel_totali
+    centro = (p + z * z / (2 * pixel_totali)) / denominatore
+    semiampiezza = z * math.sqrt(p * (1 - p) / pixel_totali + z * z / (4 * pixel_totali ** 2)) / denominatore
+    return round(max(p - (centro - semiampiezza), (centro + semiampiezza) - p) * 100, 2)
+
+
+def _riquadri_scalati(riquadri, scala_x, scala_y):
+    # Un pixel di indice i del campione corrisponde al pixel i * scala dell'originale
+    scalati = [(math.ceil(x1 / scala_x), math.ceil(y1 / scala_y), math.ceil(x2 / scala_x), math.ceil(y2 / scala_y))
+               for x1, y1, x2, y2 in riquadri]
+    return [r for r in scalati if r[2] > r[0] and r[3] > r[1]]
+
+
+def _conta_campione(regione, riquadri, soglia, motore, classificatore):
+    """Pixel verdi e totali di un campione di circa PIXEL_STIMA pixel della regione (None se l'area non ne contiene)"""
+    larghezza_regione, altezza_regione = _dimensioni_pixel(regione)
+    passo = max(1, int(math.sqrt(larghezza_regione * altezza_regione / PIXEL_STIMA)))
+    if isinstance(regione, Image.Image):
+        # Vicino più prossimo: ogni pixel del campione è un pixel della regione, non una media
+        campione = regione.resize((-(-larghezza_regione // passo), -(-altezza_regione // passo)),
+                                  Image.Resampling.NEAREST)
+    else:
+        campione = regione[::passo, ::passo]
+    if riquadri is not None:
+        riquadri = _riquadri_scalati(riquadri, passo, passo)
+        if not riquadri:
+            # Area più piccola del passo di campionamento: nessun pixel nel campione
+            return None
+    pixel_verdi_cont, pixel_totali, _, _ = analizza_rgb(campione, soglia, False, motore, riquadri,
+                                                        classificatore=classificatore)
+    return pixel_verdi_cont, pixel_totali
+
+
+def _pixel_ridotti(image_path, fattore, profilo=None):
+    """Pixel RGB del JPEG decodificato ridotto di fattore volte per lato (Image.draft), None se non è possibile"""
+    with _fase(profilo, 'apertura'):
+        img = Image.open(image_path)
+    if _bozza_jpeg(img, fattore) != fattore:
+        img.close()
+        return None
+    return _decodifica_rgb(img, profilo)
+
+
+def _stima_rapida(image_path, soglia, motore, area_di_interesse, cache, classificatore=None, profilo=None):
+    """Analizza un campione di circa PIXEL_STIMA pixel e restituisce un RisultatoVerde non esatto.
+
+    Se i pixel sono già nella CacheImmagini il campione prende un pixel ogni `passo` righe e colonne.
+    Altrimenti i JPEG grandi sono decodificati ridotti (Image.draft), in pochi millisecondi, mentre
+    gli altri formati sono decodificati per intero nella cache, dove il calcolo esatto li ritrova.
+    I pixel della decodifica ridotta sono medie di blocchi, che spostano la percentuale lungo i bordi
+    delle zone verdi: lo spostamento si stima ripetendo il conteggio con blocchi di lato doppio e la
+    differenza tra i due conteggi si aggiunge al margine di errore.
+    """
+    fattore = 1
+    if not cache.ha_pixel(image_path):
+        with Image.open(image_path) as img:
+            formato, dimensioni = img.format, img.size
+        if formato == 'JPEG':
+            # La riduzione più forte che lascia almeno 4 * PIXEL_STIMA pixel, su cui lo spostamento resta piccolo
+            fattore = max([s for s in SCALE if dimensioni[0] * dimensioni[1] >= 4 * PIXEL_STIMA * s * s] or [1])
+    pixel = _pixel_ridotti(image_path, fattore, profilo) if fattore > 1 else None
+    if pixel is not None:
+        regione, riquadri = ritaglia(pixel, _area_ridotta(area_di_interesse, dimensioni, fattore))
+    else:
+        fattore = 1
+        with _fase(profilo, 'decodifica') as fase:
+            pixel = cache.array_rgb(image_path) if scegli_motore(motore) == 'numpy' else cache.immagine_rgb(image_path)
+            if fase is not None:
+                larghezza, altezza = _dimensioni_pixel(pixel)
+                fase.pixel += larghezza * altezza
+        regione, riquadri = ritaglia(pixel, area_di_interesse)
+
+    with _fase(profilo, 'stima') as fase:
+        conteggi = _conta_campione(regione, riquadri, soglia, motore, classificatore)
+        if conteggi is None:
+            return RisultatoVerde(0, 0, 0, esatta=False, margine_errore=100.0)
+        pixel_verdi_cont, pixel_totali = conteggi
+        margine = _margine_errore(pixel_verdi_cont, pixel_totali)
+        if fattore > 1:
+            # Oltre 1/8 Image.draft non riduce: i blocchi doppi sono una media dei pixel ridotti
+            pixel_doppi = _pixel_ridotti(image_path, 2 * fattore) if 2 * fattore in SCALE else None
+            if pixel_doppi is None:
+                pixel_doppi = pixel.reduce(2)
+            doppi = _conta_campione(*ritaglia(pixel_doppi, _area_ridotta(area_di_interesse, dimensioni, 2 * fattore)),
+                                    soglia, motore, classificatore)
+            if doppi is not None and doppi[1] > 0:
+                spostamento = abs(doppi[0] / doppi[1] - pixel_verdi_cont / pixel_totali) * 100
+                margine = round(min(100.0, margine + spostamento), 2)
+        if fase is not None:
+            fase.pixel += pixel_totali
+    return RisultatoVerde(percentuale_pixel(pixel_verdi_cont, pixel_totali), pixel_verdi_cont, pixel_totali,
+                          esatta=False, margine_errore=margine, profilo=profilo)
+
+
+def calcola_percentuale_verde_progressiva(image_path, soglia=5, genera_immagine_output=False, motore=None,
+                                          area_di_interesse=None, cache=None, annulla=None, progresso=None,
+                                          genera_maschera=False, classificatore=None, profilo=None):
+    """Modalità progressiva: genera prima una stima rapida, poi il risultato esatto.
+
+    Il primo RisultatoVerde ha esatta=False ed è calcolato su un campione dell'immagine, con il
+    relativo margine_errore; il secondo è quello di analizza_verde, con gli stessi parametri.
+    Per i JPEG la stima viene da una decodifica ridotta e arriva in pochi millisecondi; l'immagine
+    è decodificata per intero una volta sola, in cache (una privata se cache è None).
+    Il generatore è pigro: il calcolo esatto parte solo quando si chiede il secondo risultato.
+    """
+    _controlla_annullamento(annulla)
+    if cache is None:
+        cache = CacheImmagini(limite_byte=sys.maxsize, limite_voci=1)
+    yield _stima_rapida(image_path, soglia, motore, area_di_interesse, cache, classificatore, profilo)
+    yield analizza_verde(image_path, soglia, genera_immagine_output, motore, area_di_interesse, cache, annulla, progresso,
+                         genera_maschera, classificatore, profilo)
+
+
+def _strisce_rgb(image_path, altezza_striscia):
+    """Genera (y, striscia RGB) per bande orizzontali consecutive dell'immagine.
+
+    Per i formati raw non compressi (BMP, PPM, TGA, TIFF) ogni banda viene letta dal disco
+    separatamente, quindi in memoria c'è una sola striscia alla volta; per gli altri formati
+    Pillow non sa decodificare una banda isolata e l'immagine viene decodificata una volta sola.
+    """
+    with Image.open(image_path) as img:
+        width, height = img.size
+        a_bande = _tile_raw(img) is not None and _decodifica_parziale_verificata()
+
+    if a_bande:
+        for y in range(0, height, altezza_striscia):
+            y2 = min(y + altezza_striscia, height)
+            with Image.open(image_path) as img:
+                riga_iniziale = _limita_decodifica(img, y, y2)
+                yield y, converti_rgb(img.crop((0, y - riga_iniziale, width, y2 - riga_iniziale)))
+    else:
+        img_rgb = converti_rgb(Image.open(image_path))
+        for y in range(0, height, altezza_striscia):
+            yield y, img_rgb.crop((0, y, width, min(y + altezza_striscia, height)))
+
+
+class _ScrittorePngAStrisce:
+    """Scrive un PNG RGBA a 8 bit una striscia alla volta, senza tenere l'immagine in memoria"""
+
+    def __init__(self, percorso, larghezza, altezza):
+        self.larghezza = larghezza
+        self._file = open(percorso, 'wb')
+        self._zlib = zlib.compressobj()
+        self._file.write(b'\x89PNG\r\n\x1a\n')
+        # Profondità 8 bit, tipo colore 6 (RGBA), compressione, filtro e interlacciamento standard
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', larghezza, altezza, 8, 6, 0, 0, 0))
+
+    def _chunk(self, tipo, dati):
+        self._file.write(struct.pack('>I', len(dati)))
+        self._file.write(tipo)
+        self._file.write(dati)
+        self._file.write(struct.pack('>I', zlib.crc32(dati, zlib.crc32(tipo))))
+
+    def scrivi(self, striscia_rgba):
+        """Aggiunge le righe di un'immagine RGBA larga quanto il PNG"""
+        byte_riga = self.larghezza * 4
+        dati = striscia_rgba.tobytes()
+        # Ogni riga è preceduta dal byte del filtro (0 = nessun filtro)
+        righe = b''.join(b'\x00' + dati[i:i + byte_riga] for i in range(0, len(dati), byte_riga))
+        compressi = self._zlib.compress(righe)
+        if compressi:
+            self._chunk(b'IDAT', compressi)
+
+    def chiudi(self):
+        self._chunk(b'IDAT', self._zlib.flush())
+        self._chunk(b'IEND', b'')
+        self._file.close()
+
+
+def analizza_verde_a_strisce(image_path, soglia=5, motore=None, altezza_striscia=256, percorso_output=None,
+                             annulla=None, progresso=None, classificatore=None):
+    """Analizza l'immagine per strisce orizzontali, con memoria di picco limitata a una striscia.
+
+    I conteggi delle strisce vengono sommati, quindi il risultato è identico a quello di analizza_verde.
+    Se percorso_output è indicato, l'immagine dei pixel verdi viene scritta come PNG striscia per
+    striscia invece di essere costruita in memoria; il RisultatoVerde non contiene immagini.
+    annulla e progresso funzionano come in analizza_verde e sono controllati a ogni striscia.
+    """
+    if altezza_striscia < 1:
+        raise ValueError("L'altezza della striscia deve essere almeno 1")
+    with Image.open(image_path) as img:
+        width, height = img.size
+
+    scrittore = _ScrittorePngAStrisce(percorso_output, width, height) if percorso_output else None
     pixel_verdi_cont = 0
-    output_img_data = None
+    try:
+        for y, striscia in _strisce_rgb(image_path, altezza_striscia):
+            _controlla_annullamento(annulla)
+            verdi, _, output_striscia, _ = analizza_rgb(striscia, soglia, scrittore is not None, motore,
+                                                        classificatore=classificatore)
+            pixel_verdi_cont += verdi
+            if scrittore is not None:
+                scrittore.scrivi(output_striscia)
+            if progresso is not None:
+                progresso((y + striscia.height) / height)
+    finally:
+        if scrittore is not None:
+            scrittore.chiudi()
 
-    if genera_immagine_output:
-        # Crea una nuova immagine RGBA per supportare la trasparenza
-        output_img = Image.new('RGBA', (width, height), (0, 0, 0, 0)) 
-        output_pixels = output_img.load()
-
-    new_data = []
-    for i, (r, g, b) in enumerate(data_rgb):
-        if g > r + soglia and g > b + soglia:
-            pixel_verdi_cont += 1
-            if genera_immagine_output:
-                # Copia il pixel verde sull'immagine di output
-                x = i % width
-                y = i // width
-                output_pixels[x, y] = (r, g, b, 255) # Rendi il pixel opaco
-        elif genera_immagine_output:
-            # Lascia il pixel trasparente se non è verde
-            pass # Già inizializzato trasparente
-    
-    percentuale = round((pixel_verdi_cont / len(data_rgb)) * 100, 2) if len(data_rgb) > 0 else 0
+    return RisultatoVerde(percentuale_pixel(pixel_verdi_cont, width * height), pixel_verdi_cont, width * height)
+
+
+def calcola_percentuale_verde(image_path, soglia=5, genera_immagine_output=False, motore=None, area_di_interesse=None,
+                              cache=None, classificatore=None, profilo=None, scala=1):
+    """Calcola la percentuale di pixel verdi (g > r + soglia e g > b + soglia).
+
+    area_di_interesse può essere un riquadro (x1, y1, x2, y2) in pixel dell'immagine originale,
+    con x2 e y2 esclusi come in Image.crop, oppure una lista di riquadri: la percentuale è calcolata
+    sull'unione dei riquadri e l'immagine di output copre il riquadro che li contiene tutti.
+    Con una CacheImmagini in cache l'immagine decodificata viene riusata tra chiamate successive.
+    classificatore (un Classificatore, vedi vegetation_detector) sostituisce la regola standard e la soglia.
+
+    Con scala 2, 4 o 8 l'analisi avviene sull'immagine ridotta di tanto per lato, quando basta una
+    precisione minore: i JPEG sono ridotti già in decodifica e dei TIFF piramidali si legge il livello
+    adatto, con decodifica più veloce e meno memoria. I pixel ridotti sono medie di blocchi, quindi la
+    percentuale può differire leggermente da quella a piena risoluzione; l'immagine di output è ridotta.
+    """
+    risultato = analizza_verde(image_path, soglia, genera_immagine_output, motore, area_di_interesse, cache,
+                               classificatore=classificatore, profilo=profilo, scala=scala)
 
     if genera_immagine_output:
-        return percentuale, output_img
+        return risultato.percentuale, risultato.immagine_output
     else:
-        return percentuale
+        return risultato.percentuale
+
+
+def main(argv=None):
+    import argparse
 
-if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Calcola la percentuale di verde in un\'immagine')
-    parser.add_argument('--image', type=str, required=True, help='Percorso dell\'immagine da analizzare')
+    sorgente = parser.add_mutually_exclusive_group(required=True)
+    sorgente.add_argument('--image', type=str, help='Percorso dell\'immagine da analizzare')
+    sorgente.add_argument('--batch', nargs='+', metavar='PERCORSO',
+                          help='Cartelle, file o pattern glob (es. "tiles/**/*.jpg") da analizzare in parallelo')
+    sorgente.add_argument('--raw', type=str, default=None, metavar='FILE',
+                          help='File di fotogrammi grezzi già decodificati (es. dump video), letto in memoria mappata '
+                               'senza decodifica né copie: stampa una riga CSV per fotogramma')
     parser.add_argument('--soglia', type=int, default=2, help='Soglia di rilevamento verde (default: 2)')
-    
-    args = parser.parse_args()
-    
-    percentuale, immagine_verde = calcola_percentuale_verde(args.image, args.soglia, genera_immagine_output=True)
-    print(f"Percentuale verde: {percentuale}%")
+    parser.add_argument('--motore', choices=MOTORI_DISPONIBILI, default=None, help='Motore di calcolo (default: il più veloce disponibile)')
+    parser.add_argument('--soglie', type=_intervallo_soglie, default=None, metavar='A:B',
+                        help='Calcola la percentuale per più soglie in una sola passata: intervallo "0:255" o elenco "2,5,10"')
+    parser.add_argument('--strisce', type=int, default=None, metavar='RIGHE',
+                        help='Analizza l\'immagine a strisce di RIGHE righe, con memoria limitata (per immagini molto grandi)')
+    parser.add_argument('--indice', nargs='+', default=None, metavar='NOME[:PARAMETRO]',
+                        help='Classificatore al posto della regola standard: standard, exg, vari, gli, hsv '
+                             '(es. "exg:0.05", "hsv:70-160"); con più indici stampa una tabella calcolata in una sola passata')
+    parser.add_argument('--maschera', type=str, default=None, metavar='FILE',
+                        help='Salva solo la maschera dei pixel verdi, a 1 bit per pixel: PNG o, con estensione .rle, RLE')
+    parser.add_argument('--scala', type=int, choices=SCALE, default=1,
+                        help='Analizza l\'immagine ridotta di 2, 4 o 8 volte per lato: più veloce, meno preciso (default: 1)')
+    parser.add_argument('--profilo', '--profile', action='store_true',
+                        help='Stampa su standard error tempi, pixel e memoria di picco di ogni fase dell\'analisi')
+    zone = parser.add_argument_group('statistiche zonali')
+    zona = zone.add_mutually_exclusive_group()
+    zona.add_argument('--zone', type=_griglia, default=None, metavar='RIGHExCOLONNE',
+                      help='Percentuale di verde per ogni cella di una griglia, es. "32x32"')
+    zona.add_argument('--etichette', type=str, default=None, metavar='FILE',
+                      help='Percentuale di verde per ogni regione di una maschera di etichette (immagine a un canale, '
+                           '0 = sfondo) o di un file JSON con una lista di poligoni')
+    zone.add_argument('--zone-output', type=str, default=None, metavar='FILE',
+                      help='Salva le statistiche zonali in CSV o, con estensione .npy, come array NumPy (default: standard output)')
+    zone.add_argument('--mappa', type=str, default=None, metavar='FILE', help='Salva la mappa di calore delle zone')
+    grezzo = parser.add_argument_group('input grezzo (--raw)')
+    grezzo.add_argument('--larghezza', type=int, default=None, help='Larghezza dei fotogrammi in pixel')
+    grezzo.add_argument('--altezza', type=int, default=None, help='Altezza dei fotogrammi in pixel')
+    grezzo.add_argument('--ordine', choices=('rgb', 'bgr', 'rgba', 'bgra', 'argb', 'abgr'), default='rgb',
+                        help='Ordine dei canali, 8 bit ciascuno (default: rgb)')
+    grezzo.add_argument('--passo-riga', type=int, default=None, metavar='BYTE',
+                        help='Byte tra l\'inizio di due righe, se le righe hanno padding (default: larghezza x byte per pixel)')
+    grezzo.add_argument('--offset', type=int, default=0, metavar='BYTE',
+                        help='Byte da saltare all\'inizio del file, es. un\'intestazione (default: 0)')
+    grezzo.add_argument('--byte-fotogramma', type=int, default=None, metavar='BYTE',
+                        help='Byte tra l\'inizio di due fotogrammi (default: passo riga x altezza)')
+    batch = parser.add_argument_group('modalità batch')
+    batch.add_argument('--workers', type=int, default=None, help='Numero di processi (default: uno per core)')
+    batch.add_argument('--chunksize', type=int, default=None, help='Immagini assegnate a un processo per volta (default: automatico)')
+    batch.add_argument('--formato', choices=('csv', 'jsonl'), default='csv', help='Formato dei risultati (default: csv)')
+    batch.add_argument('--risultati', type=str, default=None, help='File in cui scrivere i risultati (default: standard output)')
+    batch.add_argument('--output-dir', type=str, default=None, help='Cartella in cui salvare le immagini dei pixel verdi')
+    batch.add_argument('--ricorsivo', action='store_true', help='Cerca le immagini anche nelle sottocartelle')
+    batch.add_argument('--cache-db', type=str, default=None, metavar='FILE',
+                       help='Database SQLite in cui conservare i risultati tra un\'esecuzione e l\'altra')
+    batch.add_argument('--cache-limite', type=int, default=1024, metavar='MB',
+                       help='Dimensione massima della cache dei risultati (default: 1024 MB)')
+
+    args = parser.parse_args(argv)
+
+    zonale = args.zone is not None or args.etichette is not None
+    if (args.zone_output or args.mappa) and not zonale:
+        parser.error("--zone-output e --mappa richiedono --zone o --etichette")
+    if zonale and (args.batch or args.soglie or args.strisce or args.maschera):
+        parser.error("Le statistiche zonali si calcolano solo su una singola immagine")
+    if args.scala > 1 and (args.soglie or args.strisce or zonale):
+        parser.error("--scala non si può combinare con --soglie, --strisce, --zone o --etichette")
+    if args.scala > 1 and args.cache_db:
+        parser.error("--cache-db si può usare solo a piena risoluzione")
+    if args.raw and (args.soglie or args.strisce or args.maschera or zonale or args.scala > 1 or args.profilo):
+        parser.error("--raw non si può combinare con --soglie, --strisce, --maschera, --zone, --etichette, --scala o --profilo")
+    if args.raw and (args.larghezza is None or args.altezza is None):
+        parser.error("--raw richiede --larghezza e --altezza")
+    if not args.raw and (args.larghezza is not None or args.altezza is not None or args.passo_riga or args.offset or
+                         args.byte_fotogramma):
+        parser.error("--larghezza, --altezza, --passo-riga, --offset e --byte-fotogramma valgono solo con --raw")
+
+    profilo = None
+    if args.profilo:
+        if args.batch or args.soglie or args.strisce or zonale or (args.indice and len(args.indice) > 1):
+            parser.error("--profilo vale solo per l'analisi di una singola immagine")
+        profilo = ProfiloAnalisi(memoria=True)
+
+    args.classificatore = None
+    if args.indice:
+        import vegetation_detector
+        try:
+            classificatori = [vegetation_detector.crea_classificatore(s, args.soglia) for s in args.indice]
+        except ValueError as e:
+            parser.error(str(e))
+        if len(classificatori) > 1 and (args.batch or args.raw or args.soglie or args.strisce or args.maschera or
+                                        zonale or args.scala > 1):
+            parser.error("Più indici insieme si possono calcolare solo su una singola immagine")
+        if args.soglie:
+            parser.error("--soglie usa sempre la regola standard: non si può combinare con --indice")
+        if args.cache_db and not isinstance(classificatori[0], ClassificatoreStandard):
+            parser.error("--cache-db si può usare solo con la regola standard")
+        if len(classificatori) > 1:
+            print("indice,percentuale,pixel_verdi,pixel_totali")
+            for specifica, risultato in zip(args.indice, vegetation_detector.analizza_indici(args.image, classificatori)):
+                print(f"{specifica},{risultato.percentuale},{risultato.pixel_verdi},{risultato.pixel_totali}")
+            return
+        args.classificatore = classificatori[0]
+
+    if args.batch:
+        import batch_detector
+        return batch_detector.main_batch(args)
+
+    if zonale:
+        if np is None:
+            parser.error("Le statistiche zonali richiedono NumPy (pip install numpy)")
+        import zonal_detector
+        return zonal_detector.main_zone(args)
+
+    if args.raw:
+        if np is None:
+            parser.error("L'input grezzo richiede NumPy (pip install numpy)")
+        import raw_detector
+        return raw_detector.main_raw(args)
+
+    if args.soglie:
+        print("soglia,percentuale")
+        for soglia, percentuale in percentuali_per_soglie(args.image, args.soglie, args.motore).items():
+            print(f"{soglia},{percentuale}")
+        return
+
+    if args.strisce:
+        # Le immagini molto grandi superano il limite anti "decompression bomb" di Pillow:
+        # da riga di comando l'utente ha scelto esplicitamente il file da analizzare
+        Image.MAX_IMAGE_PIXELS = None
+        output_image_path = "green_pixels_detected.png"
+        risultato = analizza_verde_a_strisce(args.image, args.soglia, args.motore, args.strisce, output_image_path,
+                                             classificatore=args.classificatore)
+        print(f"Percentuale verde: {risultato.percentuale}%")
+        print(f"Immagine con pixel verdi salvata in: {output_image_path}")
+        return
+
+    if args.maschera:
+        risultato = analizza_verde(args.image, args.soglia, motore=args.motore, genera_maschera=True,
+                                   classificatore=args.classificatore, profilo=profilo, scala=args.scala)
+        print(f"Percentuale verde: {risultato.percentuale}%{_nota_scala(args.scala)}")
+        with _fase(profilo, 'salvataggio'):
+            risultato.maschera.salva(args.maschera)
+        print(f"Maschera dei pixel verdi salvata in: {args.maschera}")
+        _stampa_profilo(profilo)
+        return
+
+    percentuale, immagine_verde = calcola_percentuale_verde(args.image, args.soglia, genera_immagine_output=True, motore=args.motore,
+                                                            classificatore=args.classificatore, profilo=profilo,
+                                                            scala=args.scala)
+    print(f"Percentuale verde: {percentuale}%{_nota_scala(args.scala)}")
 
     # Salva l'immagine con i soli pixel verdi
     try:
         output_image_path = "green_pixels_detected.png"
-        immagine_verde.save(output_image_path)
+        with _fase(profilo, 'salvataggio'):
+            immagine_verde.save(output_image_path)
         print(f"Immagine con pixel verdi salvata in: {output_image_path}")
     except Exception as e:
-        print(f"Errore durante il salvataggio dell'immagine dei pixel verdi: {e}")
\ No newline at end of file
+        print(f"Errore durante il salvataggio dell'immagine dei pixel verdi: {e}")
+    _stampa_profilo(profilo)
+
+
+def _nota_scala(scala):
+    return f" (analisi a 1/{scala} della risoluzione)" if scala > 1 else ""
+
+
+def _stampa_profilo(profilo):
+    if profilo is not None:
+        profilo.chiudi()
+        print(profilo.tabella(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
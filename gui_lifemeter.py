@@ -1,27 +1,48 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 from PIL import Image, ImageTk
+import contextlib
 import os
-import sys
-import winsound # Per l'audio su Windows
-import math # Per la frequenza del suono
-import time # Per le pause durante la riproduzione
-import pygame.midi # Per la funzionalità MIDI
-import threading # Per eseguire l'audio in background
+import threading # Per eseguire l'audio e l'analisi in background
+import queue # Per passare i risultati dell'analisi al thread Tk
+import tracemalloc # Per la memoria di picco nel profilo delle analisi
 
 # Assicurati che green_detector.py sia nello stesso percorso o nel PYTHONPATH
 try:
-    from green_detector import calcola_percentuale_verde
+    from green_detector import (analizza_anteprima, calcola_percentuale_verde_progressiva, AnalisiAnnullata,
+                                CacheImmagini, IndiceVerde, MOTORI_DISPONIBILI, ProfiloAnalisi)
+    from vegetation_detector import CLASSIFICATORI, crea_classificatore
+    from zonal_detector import griglia_da_maschera
+    from audio_lifemeter import (BackendPygameMidi, PianificatoreAudio, Sonificazione, accordo_per_percentuale,
+                                 chiudi_pygame_midi, dispositivi_midi, frequenza_per_percentuale)
 except ImportError:
     messagebox.showerror("Errore", "Non è stato possibile importare 'green_detector.py'. Assicurati che sia nella stessa cartella.")
     exit()
 
+NUMPY_DISPONIBILE = 'numpy' in MOTORI_DISPONIBILI
+
+
+def _winsound():
+    """Modulo winsound, importato al primo beep; None fuori da Windows"""
+    try:
+        import winsound
+    except ImportError:
+        return None
+    return winsound
+
 class GreenDetectorApp:
+    # Ogni quanto il thread Tk controlla i messaggi del thread di analisi (circa un fotogramma)
+    INTERVALLO_CONTROLLO_MS = 16
+    # Dimensione massima delle immagini nei pannelli
+    DIMENSIONE_ANTEPRIMA = (400, 400)
+
     def __init__(self, master):
         self.master = master
         master.title("LifeMeter - Rilevatore di Verde")
 
         self.soglia_default = 2
+        # None è la regola standard con soglia_default; gli altri indici richiedono NumPy
+        self.classificatore = None
 
         self.label_info = tk.Label(master, text="Carica un'immagine per analizzare la percentuale di verde.")
         self.label_info.pack(pady=10)
@@ -51,8 +72,41 @@ class GreenDetectorApp:
         self.panel_verde = tk.Label(self.frame_immagini)
         self.panel_verde.grid(row=1, column=1, padx=10)
 
+        # Mappa di calore delle zone, mostrata solo quando si sceglie una griglia
+        self.label_zone_testo = tk.Label(self.frame_immagini, text="Verde per zona:")
+        self.panel_zone = tk.Label(self.frame_immagini)
+        self.img_zone_tk = None
+
+        self.frame_indice = tk.Frame(master)
+        self.frame_indice.pack(pady=2)
+        tk.Label(self.frame_indice, text="Indice di vegetazione:").grid(row=0, column=0, padx=5)
+        self.combo_indice = ttk.Combobox(self.frame_indice, width=12, state="readonly",
+                                         values=list(CLASSIFICATORI) if NUMPY_DISPONIBILE else ["standard"])
+        self.combo_indice.set("standard")
+        self.combo_indice.grid(row=0, column=1, padx=5)
+        self.combo_indice.bind("<<ComboboxSelected>>", self.cambia_indice)
+        if NUMPY_DISPONIBILE:
+            tk.Label(self.frame_indice, text="Zone:").grid(row=0, column=2, padx=5)
+            self.combo_zone = ttk.Combobox(self.frame_indice, width=8, state="readonly",
+                                           values=["nessuna", "4x4", "8x8", "16x16", "32x32"])
+            self.combo_zone.set("nessuna")
+            self.combo_zone.grid(row=0, column=3, padx=5)
+            self.combo_zone.bind("<<ComboboxSelected>>", self.cambia_zone)
+        self.griglia_zone = None  # (righe, colonne) o None
+
         self.label_risultato = tk.Label(master, text="Percentuale verde: -")
         self.label_risultato.pack(pady=10)
+
+        self.progress_analisi = ttk.Progressbar(master, length=300, mode="determinate", maximum=100)
+        self.progress_analisi.pack(pady=2)
+
+        # Profilo delle fasi dell'analisi, mostrato in una riga di stato solo se richiesto
+        self.profilo_attivo = tk.BooleanVar(value=False)
+        self.check_profilo = tk.Checkbutton(master, text="Profilo analisi", variable=self.profilo_attivo,
+                                            command=self.toggle_profilo)
+        self.check_profilo.pack()
+        self.label_profilo = tk.Label(master, text="", font=("TkDefaultFont", 8))
+        self.label_profilo.pack()
         
         # Pulsante per riprodurre il suono senza ricaricare l'immagine
         self.btn_riproduci_suono = tk.Button(master, text="Riproduci Suono", command=self.riproduci_suono, state=tk.DISABLED)
@@ -62,6 +116,16 @@ class GreenDetectorApp:
         self.img_originale_tk = None
         self.img_verde_tk = None
         self.ultima_percentuale = None  # Memorizza l'ultima percentuale calcolata
+        # Immagini decodificate condivise da anteprima, analisi e selezione
+        self.cache_immagini = CacheImmagini()
+
+        # Stato dell'analisi in background: solo il risultato dell'ultima analisi avviata viene mostrato
+        self._id_analisi = 0
+        self._id_risultato = 0  # ultima analisi di cui è già stato mostrato il valore esatto
+        self._annulla_analisi = None
+        self._coda_analisi = queue.Queue()
+        self._controllo_coda_attivo = False
+        self._indice_verde = None  # (percorso, criterio, IndiceVerde) dell'immagine corrente
 
         # Configurazione MIDI
         self.frame_midi = tk.Frame(master)
@@ -70,39 +134,27 @@ class GreenDetectorApp:
         self.label_midi = tk.Label(self.frame_midi, text="Configurazione MIDI:")
         self.label_midi.grid(row=0, column=0, padx=5)
         
-        self.midi_devices = ttk.Combobox(self.frame_midi, width=30)
+        self.midi_devices = ttk.Combobox(self.frame_midi, width=30, state="readonly")
         self.midi_devices.grid(row=0, column=1, padx=5)
+        self.midi_devices.bind("<<ComboboxSelected>>", self.seleziona_midi)
         
         self.btn_refresh_midi = tk.Button(self.frame_midi, text="Aggiorna", command=self.refresh_midi_devices)
         self.btn_refresh_midi.grid(row=0, column=2, padx=5)
         
-        # Inizializza pygame.midi
-        try:
-            # Verifica se pygame.midi è già inizializzato
-            if not pygame.midi.get_init():
-                pygame.midi.init()
-                print("pygame.midi inizializzato con successo")
-            else:
-                print("pygame.midi era già inizializzato")
-                
-            # Mostra informazioni sui dispositivi MIDI disponibili
-            midi_count = pygame.midi.get_count()
-            print(f"Dispositivi MIDI disponibili: {midi_count}")
-            for i in range(midi_count):
-                info = pygame.midi.get_device_info(i)
-                name, is_input, is_output, is_opened = info[1].decode(), info[2], info[3], info[4]
-                print(f"  Dispositivo {i}: {name} (input: {is_input}, output: {is_output}, aperto: {is_opened})")
-            
-            self.refresh_midi_devices()
-            self.midi_output = None
-            self.midi_enabled = False
-        except Exception as e:
-            print(f"Errore durante l'inizializzazione MIDI: {e}")
-            messagebox.showwarning("MIDI non disponibile", f"Impossibile inizializzare MIDI: {e}\nVerrà utilizzato il beep predefinito.")
+        # Tutti i suoni passano dal pianificatore audio, che usa pygame.midi solo dal suo thread:
+        # pygame.midi viene importato e inizializzato quando serve (scelta di MIDI, "Aggiorna" o
+        # primo accordo), così la finestra compare subito anche senza pygame. L'uscita MIDI
+        # resta aperta tra un accordo e l'altro
+        self.audio = PianificatoreAudio(BackendPygameMidi())
+        # Modalità "Continuo": una nota tenuta che segue la percentuale, anche mentre si trascina la selezione
+        self.sonificazione = Sonificazione(self.audio)
+        self.midi_device_ids = []
+        self._midi_device_id = None  # None: uscita predefinita del sistema
+        self._dispositivi_midi_cercati = False
         
         # Opzioni audio
         self.audio_enabled = True
-        self.audio_type = tk.StringVar(value="beep")  # Opzioni: "beep" o "midi"
+        self.audio_type = tk.StringVar(value="beep")  # Opzioni: "beep", "midi" o "continuo"
         
         self.frame_audio = tk.Frame(master)
         self.frame_audio.pack(pady=5)
@@ -110,58 +162,250 @@ class GreenDetectorApp:
         self.btn_mute = tk.Button(self.frame_audio, text="Mute Audio", command=self.toggle_audio)
         self.btn_mute.grid(row=0, column=0, padx=5)
         
-        self.radio_beep = tk.Radiobutton(self.frame_audio, text="Beep", variable=self.audio_type, value="beep")
+        self.radio_beep = tk.Radiobutton(self.frame_audio, text="Beep", variable=self.audio_type, value="beep",
+                                         command=self.cambia_tipo_audio)
         self.radio_beep.grid(row=0, column=1, padx=5)
         
-        self.radio_midi = tk.Radiobutton(self.frame_audio, text="MIDI", variable=self.audio_type, value="midi")
+        self.radio_midi = tk.Radiobutton(self.frame_audio, text="MIDI", variable=self.audio_type, value="midi",
+                                         command=self.cambia_tipo_audio)
         self.radio_midi.grid(row=0, column=2, padx=5)
+        
+        self.radio_continuo = tk.Radiobutton(self.frame_audio, text="Continuo", variable=self.audio_type,
+                                             value="continuo", command=self.cambia_tipo_audio)
+        self.radio_continuo.grid(row=0, column=3, padx=5)
 
-    def _analizza_e_aggiorna_ui(self):
+    def _analizza_e_aggiorna_ui(self, carica_anteprima=False, suona=False):
+        """Avvia l'analisi in un thread separato; un'analisi già in corso viene annullata"""
         if not self.image_path:
             # messagebox.showinfo("Info", "Carica prima un'immagine.")
             return
 
+        if self._annulla_analisi is not None:
+            self._annulla_analisi.set()
+        self._id_analisi += 1
+        self._annulla_analisi = threading.Event()
+
+        indice = self._indice_verde_corrente()
+        if indice is not None and self.area_selezione is not None:
+            # Con l'indice il valore esatto dell'area è immediato: in background resta solo l'immagine dei pixel verdi
+            self.label_risultato.config(text=f"Percentuale verde ({self._criterio()}): {indice.percentuale(self.area_selezione)}%")
+            progressiva = False
+        else:
+            self.label_risultato.config(text="Analisi in corso...")
+            progressiva = True
+        profilo = ProfiloAnalisi(memoria=True) if self.profilo_attivo.get() else None
+        parametri = (self._id_analisi, self.image_path, self.area_selezione, carica_anteprima, suona, progressiva,
+                     self._annulla_analisi, profilo)
+        threading.Thread(target=self._esegui_analisi, args=parametri, daemon=True).start()
+
+        self.progress_analisi.config(value=0)
+        if not self._controllo_coda_attivo:
+            self._controllo_coda_attivo = True
+            self.master.after(self.INTERVALLO_CONTROLLO_MS, self._controlla_coda_analisi)
+
+    def _indice_verde_corrente(self):
+        if self._indice_verde is None:
+            return None
+        image_path, criterio, indice = self._indice_verde
+        if image_path != self.image_path or criterio != self._criterio():
+            return None
+        return indice
+
+    def _criterio(self):
+        """Descrizione del criterio corrente, usata nelle etichette e per riconoscere un indice ancora valido"""
+        if self.classificatore is None:
+            return f"soglia {self.soglia_default}"
+        return repr(self.classificatore)
+
+    def cambia_indice(self, event=None):
+        nome = self.combo_indice.get()
+        self.classificatore = None if nome == "standard" else crea_classificatore(nome)
+        self._analizza_e_aggiorna_ui()
+
+    def cambia_zone(self, event=None):
+        scelta = self.combo_zone.get()
+        if scelta == "nessuna":
+            self.griglia_zone = None
+            self.label_zone_testo.grid_remove()
+            self.panel_zone.grid_remove()
+            self.panel_zone.config(image=None)
+            self.img_zone_tk = None
+            return
+        righe, colonne = scelta.split("x")
+        self.griglia_zone = (int(righe), int(colonne))
+        self.label_zone_testo.grid(row=0, column=2, padx=10)
+        self.panel_zone.grid(row=1, column=2, padx=10)
+        self._analizza_e_aggiorna_ui()
+
+    def toggle_profilo(self):
+        # tracemalloc resta attivo finché il profilo è abilitato, invece di avviarlo e fermarlo a ogni analisi
+        if self.profilo_attivo.get():
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+        else:
+            tracemalloc.stop()
+            self.label_profilo.config(text="")
+
+    def _esegui_analisi(self, id_analisi, image_path, area, carica_anteprima, suona, progressiva, annulla, profilo):
+        # Eseguito nel thread di analisi: non tocca mai i widget Tk, comunica solo tramite la coda
+        fase = "il caricamento" if carica_anteprima else "l'elaborazione"
+        # Letti una volta sola: l'utente può cambiare indice mentre l'analisi è in corso
+        classificatore, criterio, griglia = self.classificatore, self._criterio(), self.griglia_zone
         try:
-            # Calcola percentuale solo nell'area selezionata
-            percentuale, img_verde_pil = calcola_percentuale_verde(
-                self.image_path,
-                self.soglia_default,
-                genera_immagine_output=True,
-                area_di_interesse=self.area_selezione
-            )
-            self.label_risultato.config(text=f"Percentuale verde (soglia {self.soglia_default}): {percentuale}%")
-
-            # Mostra immagine con pixel verdi
-            if img_verde_pil:
-                img_verde_pil.thumbnail((400, 400))
-                self.img_verde_tk = ImageTk.PhotoImage(img_verde_pil)
-                self.panel_verde.config(image=self.img_verde_tk)
-                self.panel_verde.image = self.img_verde_tk
-            else:
-                self.panel_verde.config(image=None)
-                self.panel_verde.image = None
-
-            self.ultima_percentuale = percentuale
-            self.btn_riproduci_suono.config(state=tk.NORMAL)
-            # Non riprodurre il suono automaticamente qui, ma solo su richiesta
-            # self.play_green_sound(percentuale) 
-
-        except FileNotFoundError:
-            messagebox.showerror("Errore", f"File non trovato: {self.image_path}")
-            self.label_risultato.config(text="Percentuale verde: Errore")
-            self.panel_verde.config(image=None)
-            self.panel_verde.image = None
-            self.btn_riproduci_suono.config(state=tk.DISABLED)
-            self.ultima_percentuale = None
-        except ImportError as e:
-            messagebox.showerror("Errore di Importazione", f"Errore durante l'importazione di moduli necessari: {e}. Assicurati che Pillow (PIL) sia installato.")
+            if progressiva:
+                # La stima ha un thread suo, così l'anteprima non la aspetta: per i JPEG viene da una
+                # decodifica ridotta, negli altri casi dai pixel che l'anteprima decodifica nella cache
+                threading.Thread(target=self._esegui_stima, args=(id_analisi, image_path, area, annulla, classificatore),
+                                 daemon=True).start()
+
+            if carica_anteprima:
+                if profilo is not None:
+                    with profilo.fase("miniatura"):
+                        anteprima = self.cache_immagini.anteprima(image_path, self.DIMENSIONE_ANTEPRIMA)
+                else:
+                    anteprima = self.cache_immagini.anteprima(image_path, self.DIMENSIONE_ANTEPRIMA)
+                self._coda_analisi.put(("anteprima", id_analisi, anteprima, profilo))
+                fase = "l'elaborazione"
+
+            # Conteggio esatto a piena risoluzione, ma l'immagine dei pixel verdi arriva già alle
+            # dimensioni del pannello: nel thread Tk resta solo la creazione della PhotoImage
+            risultato = analizza_anteprima(
+                image_path, self.DIMENSIONE_ANTEPRIMA, self.soglia_default, area_di_interesse=area,
+                cache=self.cache_immagini, annulla=annulla, classificatore=classificatore, profilo=profilo,
+                progresso=lambda frazione: self._coda_analisi.put(("progresso", id_analisi, frazione)))
+            self._coda_analisi.put(("risultato", id_analisi, risultato.percentuale, risultato.immagine_output, suona,
+                                    profilo))
+
+            if griglia is not None:
+                # Conteggi per cella dalla maschera appena calcolata, senza ripassare sull'immagine;
+                # la mappa ha le dimensioni dell'immagine dei pixel verdi
+                larghezza, altezza = risultato.maschera.dimensioni
+                griglia = (min(griglia[0], altezza), min(griglia[1], larghezza))
+                with profilo.fase("zone") if profilo is not None else contextlib.nullcontext():
+                    mappa = griglia_da_maschera(risultato.maschera, griglia).mappa_di_calore(
+                        risultato.immagine_output.size)
+                self._coda_analisi.put(("zone", id_analisi, mappa, profilo))
+
+            # Dopo la prima analisi dell'immagine intera si costruisce l'indice per le selezioni successive,
+            # dalla maschera appena calcolata
+            if area is None and NUMPY_DISPONIBILE and self._indice_verde_corrente() is None:
+                indice = IndiceVerde(risultato.maschera.come_array(), self.soglia_default)
+                self._coda_analisi.put(("indice", id_analisi, image_path, criterio, indice))
+        except AnalisiAnnullata:
+            pass
         except Exception as e:
-            messagebox.showerror("Errore", f"Si è verificato un errore durante l'elaborazione dell'immagine: {e}")
-            self.label_risultato.config(text="Percentuale verde: Errore")
+            self._coda_analisi.put(("errore", id_analisi, e, fase))
+        finally:
+            self._coda_analisi.put(("fine", id_analisi))
+
+    def _esegui_stima(self, id_analisi, image_path, area, annulla, classificatore):
+        # Eseguito nel thread della stima; non entra nel profilo, perché le sue fasi si sovrappongono a quelle
+        # dell'analisi esatta. Gli eventuali errori li riporta l'analisi esatta
+        try:
+            stima = next(calcola_percentuale_verde_progressiva(
+                image_path, self.soglia_default, area_di_interesse=area, cache=self.cache_immagini, annulla=annulla,
+                classificatore=classificatore))
+        except Exception:
+            return
+        self._coda_analisi.put(("stima", id_analisi, stima))
+
+    def _controlla_coda_analisi(self):
+        """Applica all'interfaccia i messaggi del thread di analisi, ignorando quelli delle analisi superate"""
+        in_corso = True
+        while True:
+            try:
+                messaggio = self._coda_analisi.get_nowait()
+            except queue.Empty:
+                break
+            tipo, id_analisi = messaggio[0], messaggio[1]
+            if tipo == "indice":
+                # L'indice resta valido anche se nel frattempo è partita un'altra analisi della stessa immagine
+                if messaggio[2] == self.image_path:
+                    self._indice_verde = messaggio[2:]
+                continue
+            if id_analisi != self._id_analisi:
+                continue
+            if tipo == "progresso":
+                self.progress_analisi.config(value=messaggio[2] * 100)
+            elif tipo == "stima":
+                if self._id_risultato == id_analisi:
+                    continue  # il valore esatto è arrivato prima della stima
+                stima = messaggio[2]
+                self.label_risultato.config(
+                    text=f"Stima verde ({self._criterio()}): {stima.percentuale}% ± {stima.margine_errore}, calcolo esatto in corso...")
+            elif tipo == "anteprima":
+                self._mostra_anteprima(*messaggio[2:])
+            elif tipo == "risultato":
+                self._id_risultato = id_analisi
+                self._mostra_risultato(*messaggio[2:])
+            elif tipo == "zone":
+                self._mostra_zone(*messaggio[2:])
+            elif tipo == "errore":
+                self._mostra_errore(*messaggio[2:])
+            elif tipo == "fine":
+                in_corso = False
+
+        if in_corso:
+            self.master.after(self.INTERVALLO_CONTROLLO_MS, self._controlla_coda_analisi)
+        else:
+            self._controllo_coda_attivo = False
+
+    def _photoimage(self, img_pil, profilo):
+        """Crea la PhotoImage nel thread Tk, misurandola nel profilo se indicato"""
+        if profilo is None:
+            return ImageTk.PhotoImage(img_pil)
+        with profilo.fase("photoimage", img_pil.width * img_pil.height):
+            return ImageTk.PhotoImage(img_pil)
+
+    def _mostra_anteprima(self, img_originale_pil, profilo=None):
+        self.img_originale_tk = self._photoimage(img_originale_pil, profilo)
+        self.panel_originale.config(width=img_originale_pil.width, height=img_originale_pil.height)
+        self.img_id = self.panel_originale.create_image(0, 0, anchor=tk.NW, image=self.img_originale_tk)
+
+    def _mostra_risultato(self, percentuale, img_verde_pil, suona, profilo=None):
+        self.progress_analisi.config(value=100)
+        self.label_risultato.config(text=f"Percentuale verde ({self._criterio()}): {percentuale}%")
+
+        # Mostra immagine con pixel verdi
+        if img_verde_pil:
+            self.img_verde_tk = self._photoimage(img_verde_pil, profilo)
+            self.panel_verde.config(image=self.img_verde_tk)
+            self.panel_verde.image = self.img_verde_tk
+        else:
             self.panel_verde.config(image=None)
             self.panel_verde.image = None
-            self.btn_riproduci_suono.config(state=tk.DISABLED)
-            self.ultima_percentuale = None
+
+        if profilo is not None:
+            self.label_profilo.config(text=profilo.riepilogo())
+
+        self.ultima_percentuale = percentuale
+        self.btn_riproduci_suono.config(state=tk.NORMAL)
+        # Il suono parte automaticamente solo dopo il caricamento di una nuova immagine
+        if suona:
+            self.play_green_sound(percentuale)
+
+    def _mostra_zone(self, mappa, profilo=None):
+        if self.griglia_zone is None:
+            return
+        self.img_zone_tk = self._photoimage(mappa, profilo)
+        self.panel_zone.config(image=self.img_zone_tk)
+        if profilo is not None:
+            self.label_profilo.config(text=profilo.riepilogo())
+
+    def _mostra_errore(self, e, fase):
+        self.progress_analisi.config(value=0)
+        if isinstance(e, FileNotFoundError):
+            messagebox.showerror("Errore", f"File non trovato: {self.image_path}")
+        elif isinstance(e, ImportError):
+            messagebox.showerror("Errore di Importazione", f"Errore durante l'importazione di moduli necessari: {e}. Assicurati che Pillow (PIL) sia installato.")
+            return
+        else:
+            messagebox.showerror("Errore", f"Si è verificato un errore durante {fase} dell'immagine: {e}")
+        self.label_risultato.config(text="Percentuale verde: Errore")
+        self.panel_verde.config(image=None)
+        self.panel_verde.image = None
+        self.btn_riproduci_suono.config(state=tk.DISABLED)
+        self.ultima_percentuale = None
 
     def carica_immagine(self):
         new_image_path = filedialog.askopenfilename(
@@ -175,153 +419,95 @@ class GreenDetectorApp:
         
         self.image_path = new_image_path
         self.area_selezione = None # Resetta l'area di selezione quando si carica una nuova immagine
+        self._indice_verde = None
 
-        try:
-            # Pulisci il canvas prima di caricare una nuova immagine
-            self.panel_originale.delete("all")
-            
-            # Mostra immagine originale
-            img_originale_pil = Image.open(self.image_path)
-            img_originale_pil.thumbnail((400, 400))
-            self.img_originale_tk = ImageTk.PhotoImage(img_originale_pil)
-            self.panel_originale.config(width=img_originale_pil.width, height=img_originale_pil.height)
-            self.img_id = self.panel_originale.create_image(0, 0, anchor=tk.NW, image=self.img_originale_tk)
-
-            # Ora analizza l'intera immagine
-            self._analizza_e_aggiorna_ui()
-            if self.ultima_percentuale is not None:
-                 self.play_green_sound(self.ultima_percentuale) # Riproduci suono dopo caricamento iniziale
+        # Pulisci il canvas prima di caricare una nuova immagine
+        self.panel_originale.delete("all")
+        self.img_originale_tk = None
 
-        except FileNotFoundError:
-            messagebox.showerror("Errore", f"File non trovato: {self.image_path}")
-        except ImportError as e:
-            messagebox.showerror("Errore di Importazione", f"Errore durante l'importazione di moduli necessari: {e}. Assicurati che Pillow (PIL) sia installato.")
-        except Exception as e:
-            messagebox.showerror("Errore", f"Si è verificato un errore durante il caricamento dell'immagine: {e}")
-            self.label_risultato.config(text="Percentuale verde: Errore")
-            self.panel_originale.config(image=None)
-            self.panel_originale.image = None
-            self.panel_verde.config(image=None)
-            self.panel_verde.image = None
-            self.btn_riproduci_suono.config(state=tk.DISABLED)
-            self.ultima_percentuale = None
+        # Anteprima e analisi dell'intera immagine avvengono in background;
+        # il suono viene riprodotto quando arriva il risultato
+        self._analizza_e_aggiorna_ui(carica_anteprima=True, suona=True)
+
+    def cambia_tipo_audio(self):
+        if self.audio_type.get() != "continuo":
+            self.sonificazione.ferma()
+        # Alla prima scelta di MIDI si cercano i dispositivi
+        if self.audio_type.get() != "beep" and not self._dispositivi_midi_cercati:
+            self.refresh_midi_devices(avvisa=False)
+
+    def refresh_midi_devices(self, avvisa=True):
+        """Cerca i dispositivi MIDI nel thread audio: import e inizializzazione di pygame.midi sono lenti"""
+        self._dispositivi_midi_cercati = True
+        self.midi_devices.set("Ricerca dispositivi MIDI...")
+        futuro = self.audio.esegui(dispositivi_midi)
+        self.master.after(50, self._controlla_dispositivi_midi, futuro, avvisa)
+
+    def _controlla_dispositivi_midi(self, futuro, avvisa):
+        if not futuro.done():
+            self.master.after(50, self._controlla_dispositivi_midi, futuro, avvisa)
+            return
 
-    def refresh_midi_devices(self):
-        try:
-            self.midi_devices.set("")
-            devices = []
-            for i in range(pygame.midi.get_count()):
-                info = pygame.midi.get_device_info(i)
-                name, is_input, is_output, is_opened = info[1].decode(), info[2], info[3], info[4]
-                if is_output == 1:  # Solo dispositivi di output
-                    devices.append((i, name))
-            
-            if devices:
-                self.midi_devices["values"] = [name for _, name in devices]
-                self.midi_device_ids = [id for id, _ in devices]
-                self.midi_devices.current(0)
-                self.connect_midi()
-            else:
-                self.midi_devices["values"] = ["Nessun dispositivo MIDI trovato"]
-                self.midi_device_ids = []
-                self.midi_enabled = False
-        except Exception as e:
-            print(f"Errore durante l'aggiornamento dei dispositivi MIDI: {e}")
-            self.midi_enabled = False
-    
-    def connect_midi(self):
         try:
-            if hasattr(self, 'midi_output') and self.midi_output is not None:
-                del self.midi_output
-            
-            selected_index = self.midi_devices.current()
-            if selected_index >= 0 and selected_index < len(self.midi_device_ids):
-                device_id = self.midi_device_ids[selected_index]
-                self.midi_output = pygame.midi.Output(device_id)
-                self.midi_enabled = True
-                print(f"Connesso al dispositivo MIDI: {self.midi_devices.get()} (ID: {device_id})")
-                # Invia una nota di test per verificare la connessione
-                try:
-                    self.midi_output.note_on(60, 100)  # Nota C4 con velocità 100
-                    time.sleep(0.1)
-                    self.midi_output.note_off(60, 0)
-                    print("Test MIDI inviato con successo")
-                except Exception as e:
-                    print(f"Errore durante il test MIDI: {e}")
-            else:
-                self.midi_enabled = False
-                print("Nessun dispositivo MIDI selezionato o disponibile")
+            devices = futuro.result()
         except Exception as e:
-            print(f"Errore durante la connessione al dispositivo MIDI: {e}")
-            self.midi_enabled = False
-            messagebox.showerror("Errore MIDI", f"Impossibile connettersi al dispositivo MIDI: {e}")
+            print(f"Errore durante l'inizializzazione MIDI: {e}")
+            self.midi_devices["values"] = []
+            self.midi_devices.set("MIDI non disponibile")
+            self.midi_device_ids = []
+            if avvisa:
+                messagebox.showwarning("MIDI non disponibile", f"Impossibile inizializzare MIDI: {e}\nVerrà utilizzato il beep predefinito.")
+            return
+
+        if devices:
+            self.midi_devices["values"] = [name for _, name in devices]
+            self.midi_device_ids = [id for id, _ in devices]
+            self.midi_devices.current(0)
+            self.seleziona_midi()
+        else:
+            self.midi_devices["values"] = []
+            self.midi_devices.set("Nessun dispositivo MIDI trovato")
+            self.midi_device_ids = []
+
+    def seleziona_midi(self, event=None):
+        selected_index = self.midi_devices.current()
+        if 0 <= selected_index < len(self.midi_device_ids):
+            device_id = self.midi_device_ids[selected_index]
+            if device_id != self._midi_device_id:
+                # La nuova uscita viene aperta dal pianificatore al prossimo accordo
+                self._midi_device_id = device_id
+                self.audio.cambia_backend(BackendPygameMidi(device_id))
+                print(f"Dispositivo MIDI selezionato: {self.midi_devices.get()} (ID: {device_id})")
+
+    def chiudi_midi(self):
+        """Spegne le note accese e chiude l'uscita MIDI e pygame.midi, se sono stati aperti"""
+        self.audio.chiudi()
+        chiudi_pygame_midi()
     
     def play_green_sound(self, percentuale):
-        if not self.audio_enabled or percentuale <= 0:
+        if not self.audio_enabled:
+            return
+        if self.audio_type.get() == "continuo":
+            # La nota tenuta si sposta verso la nuova percentuale, anche quando è zero
+            self.sonificazione.aggiorna(percentuale)
+            return
+        if percentuale <= 0:
             return
         
-        # Esegui l'audio in un thread separato per non bloccare l'interfaccia
-        threading.Thread(target=self._play_sound, args=(percentuale,), daemon=True).start()
-    
-    def _play_sound(self, percentuale):
-        try:
-            if self.audio_type.get() == "beep":
-                # Mappiamo la percentuale di verde alla frequenza del suono
-                # Frequenza minima: 500 Hz, massima: 2500 Hz
-                # Più verde = suono più acuto
-                duration_ms = 1000  # Durata esatta di 1 secondo
-                freq = int(500 + (percentuale / 100) * 2000)
-                
-                # Assicuriamoci che la frequenza sia nel range valido per winsound.Beep
-                # (tra 37 e 32767 Hz)
-                freq = max(37, min(freq, 32767))
-                
-                # Riproduci il beep con la frequenza calcolata
-                winsound.Beep(freq, duration_ms)
-            
-            elif self.audio_type.get() == "midi":
-                if not self.midi_enabled or self.midi_output is None:
-                    print("MIDI non abilitato o dispositivo non connesso. Riconnessione in corso...")
-                    self.connect_midi()
-                    if not self.midi_enabled or self.midi_output is None:
-                        print("Impossibile connettersi al dispositivo MIDI")
-                        return
-                
-                # Mappiamo la percentuale di verde a un accordo maggiore
-                # Più verde = accordo più alto
-                
-                # Calcola la nota base (C3 = 60, C7 = 108)
-                base_note = int(60 + (percentuale / 100) * 48)
-                base_note = max(36, min(base_note, 96))  # Limita il range delle note
-                
-                # Crea un accordo maggiore (base, terza maggiore, quinta)
-                chord = [base_note, base_note + 4, base_note + 7]
-                velocity = 100  # Volume (0-127)
-                
-                print(f"Invio accordo MIDI: {chord} con velocità {velocity}")
-                
-                try:
-                    # Suona l'accordo
-                    for note in chord:
-                        self.midi_output.note_on(note, velocity)
-                        time.sleep(0.01)  # Piccolo ritardo tra le note
-                    
-                    # Mantieni l'accordo per 1 secondo
-                    time.sleep(1)
-                    
-                    # Rilascia le note
-                    for note in chord:
-                        self.midi_output.note_off(note, 0)
-                        time.sleep(0.01)  # Piccolo ritardo tra le note
-                    
-                    print("Accordo MIDI inviato con successo")
-                except Exception as e:
-                    print(f"Errore durante l'invio dell'accordo MIDI: {e}")
-                    # Prova a riconnettersi al dispositivo MIDI
-                    self.connect_midi()
-                
-        except Exception as e:
-            print(f"Errore durante la riproduzione audio: {e}")
+        # Il pianificatore suona in un suo thread senza bloccare l'interfaccia; un nuovo suono
+        # sostituisce quello precedente invece di sovrapporsi
+        if self.audio_type.get() == "beep":
+            if _winsound() is None:
+                # Senza winsound (fuori da Windows) resta solo il segnale acustico di Tk, a frequenza fissa
+                self.master.bell()
+                return
+            # Più verde = suono più acuto, per 1 secondo
+            self.audio.suona_beep(frequenza_per_percentuale(percentuale), 1000)
+        else:
+            # Più verde = accordo maggiore più alto, tenuto per 1 secondo
+            chord = accordo_per_percentuale(percentuale)
+            print(f"Invio accordo MIDI: {chord} con velocità 100")
+            self.audio.suona_accordo(chord, velocita=100, durata=1.0)
 
     
     def toggle_audio(self):
@@ -330,6 +516,7 @@ class GreenDetectorApp:
             self.btn_mute.config(text="Mute Audio")
         else:
             self.btn_mute.config(text="Unmute Audio")
+            self.sonificazione.ferma()
     
     def riproduci_suono(self):
         """Riproduce il suono basato sull'ultima percentuale di verde rilevata"""
@@ -369,162 +556,47 @@ class GreenDetectorApp:
     def disegna_selezione(self, event):
         if self.selezione_attiva and self.img_originale_tk and hasattr(self, 'rect_id'):
             self.panel_originale.coords(self.rect_id, self.start_x, self.start_y, event.x, event.y)
+            if self.audio_enabled and self.audio_type.get() == "continuo":
+                # Con l'indice la percentuale dell'area è immediata: il suono segue il trascinamento
+                indice = self._indice_verde_corrente()
+                area = self._area_da_selezione(event)
+                if indice is not None and area is not None:
+                    self.sonificazione.aggiorna(indice.percentuale(area))
+
+    def _area_da_selezione(self, event):
+        """Area (x1, y1, x2, y2) in pixel dell'immagine originale tra l'inizio della selezione e event"""
+        # Converti coordinate relative all'immagine ridimensionata
+        img_width = self.panel_originale.winfo_width()
+        img_height = self.panel_originale.winfo_height()
+        
+        # Calcola rapporto dimensionale originale/anteprima
+        original_width, original_height = self.cache_immagini.dimensioni(self.image_path)
+        x_ratio = original_width / img_width
+        y_ratio = original_height / img_height
+        
+        # Normalizza coordinate
+        x1 = min(max(int(self.start_x * x_ratio), 0), original_width)
+        y1 = min(max(int(self.start_y * y_ratio), 0), original_height)
+        x2 = min(max(int(event.x * x_ratio), 0), original_width)
+        y2 = min(max(int(event.y * y_ratio), 0), original_height)
+
+        # Un semplice clic senza trascinamento non seleziona alcun pixel
+        if x1 == x2 or y1 == y2:
+            return None
+        return (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
 
     def fine_selezione(self, event):
         if self.selezione_attiva and self.img_originale_tk:
-            # Converti coordinate relative all'immagine ridimensionata
-            img_width = self.panel_originale.winfo_width()
-            img_height = self.panel_originale.winfo_height()
-            
-            # Calcola rapporto dimensionale originale/anteprima
-            original_width, original_height = Image.open(self.image_path).size
-            x_ratio = original_width / img_width
-            y_ratio = original_height / img_height
-            
-            # Normalizza coordinate
-            x1 = min(max(int(self.start_x * x_ratio), 0), original_width)
-            y1 = min(max(int(self.start_y * y_ratio), 0), original_height)
-            x2 = min(max(int(event.x * x_ratio), 0), original_width)
-            y2 = min(max(int(event.y * y_ratio), 0), original_height)
-            
-            self.area_selezione = (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+            area = self._area_da_selezione(event)
+            if area is None:
+                return
+
+            self.area_selezione = area
             if self.image_path:
                 self._analizza_e_aggiorna_ui() # Analizza l'area appena selezionata
             # Non disattivare la selezione automaticamente qui, l'utente potrebbe volerla modificare
             # self.toggle_selezione() # Opzionale: disattiva la modalità selezione dopo averla completata
 
-    def refresh_midi_devices(self):
-        try:
-            self.midi_devices.set("")
-            devices = []
-            for i in range(pygame.midi.get_count()):
-                info = pygame.midi.get_device_info(i)
-                name, is_input, is_output, is_opened = info[1].decode(), info[2], info[3], info[4]
-                if is_output == 1:  # Solo dispositivi di output
-                    devices.append((i, name))
-            
-            if devices:
-                self.midi_devices["values"] = [name for _, name in devices]
-                self.midi_device_ids = [id for id, _ in devices]
-                self.midi_devices.current(0)
-                self.connect_midi()
-            else:
-                self.midi_devices["values"] = ["Nessun dispositivo MIDI trovato"]
-                self.midi_device_ids = []
-                self.midi_enabled = False
-        except Exception as e:
-            print(f"Errore durante l'aggiornamento dei dispositivi MIDI: {e}")
-            self.midi_enabled = False
-    
-    def connect_midi(self):
-        try:
-            if hasattr(self, 'midi_output') and self.midi_output is not None:
-                del self.midi_output
-            
-            selected_index = self.midi_devices.current()
-            if selected_index >= 0 and selected_index < len(self.midi_device_ids):
-                device_id = self.midi_device_ids[selected_index]
-                self.midi_output = pygame.midi.Output(device_id)
-                self.midi_enabled = True
-                print(f"Connesso al dispositivo MIDI: {self.midi_devices.get()} (ID: {device_id})")
-                # Invia una nota di test per verificare la connessione
-                try:
-                    self.midi_output.note_on(60, 100)  # Nota C4 con velocità 100
-                    time.sleep(0.1)
-                    self.midi_output.note_off(60, 0)
-                    print("Test MIDI inviato con successo")
-                except Exception as e:
-                    print(f"Errore durante il test MIDI: {e}")
-            else:
-                self.midi_enabled = False
-                print("Nessun dispositivo MIDI selezionato o disponibile")
-        except Exception as e:
-            print(f"Errore durante la connessione al dispositivo MIDI: {e}")
-            self.midi_enabled = False
-            messagebox.showerror("Errore MIDI", f"Impossibile connettersi al dispositivo MIDI: {e}")
-    
-    def play_green_sound(self, percentuale):
-        if not self.audio_enabled or percentuale <= 0:
-            return
-        
-        # Esegui l'audio in un thread separato per non bloccare l'interfaccia
-        threading.Thread(target=self._play_sound, args=(percentuale,), daemon=True).start()
-    
-    def _play_sound(self, percentuale):
-        try:
-            if self.audio_type.get() == "beep":
-                # Mappiamo la percentuale di verde alla frequenza del suono
-                # Frequenza minima: 500 Hz, massima: 2500 Hz
-                # Più verde = suono più acuto
-                duration_ms = 1000  # Durata esatta di 1 secondo
-                freq = int(500 + (percentuale / 100) * 2000)
-                
-                # Assicuriamoci che la frequenza sia nel range valido per winsound.Beep
-                # (tra 37 e 32767 Hz)
-                freq = max(37, min(freq, 32767))
-                
-                # Riproduci il beep con la frequenza calcolata
-                winsound.Beep(freq, duration_ms)
-            
-            elif self.audio_type.get() == "midi":
-                if not self.midi_enabled or self.midi_output is None:
-                    print("MIDI non abilitato o dispositivo non connesso. Riconnessione in corso...")
-                    self.connect_midi()
-                    if not self.midi_enabled or self.midi_output is None:
-                        print("Impossibile connettersi al dispositivo MIDI")
-                        return
-                
-                # Mappiamo la percentuale di verde a un accordo maggiore
-                # Più verde = accordo più alto
-                
-                # Calcola la nota base (C3 = 60, C7 = 108)
-                base_note = int(60 + (percentuale / 100) * 48)
-                base_note = max(36, min(base_note, 96))  # Limita il range delle note
-                
-                # Crea un accordo maggiore (base, terza maggiore, quinta)
-                chord = [base_note, base_note + 4, base_note + 7]
-                velocity = 100  # Volume (0-127)
-                
-                print(f"Invio accordo MIDI: {chord} con velocità {velocity}")
-                
-                try:
-                    # Suona l'accordo
-                    for note in chord:
-                        self.midi_output.note_on(note, velocity)
-                        time.sleep(0.01)  # Piccolo ritardo tra le note
-                    
-                    # Mantieni l'accordo per 1 secondo
-                    time.sleep(1)
-                    
-                    # Rilascia le note
-                    for note in chord:
-                        self.midi_output.note_off(note, 0)
-                        time.sleep(0.01)  # Piccolo ritardo tra le note
-                    
-                    print("Accordo MIDI inviato con successo")
-                except Exception as e:
-                    print(f"Errore durante l'invio dell'accordo MIDI: {e}")
-                    # Prova a riconnettersi al dispositivo MIDI
-                    self.connect_midi()
-                
-        except Exception as e:
-            print(f"Errore durante la riproduzione audio: {e}")
-
-    
-    def toggle_audio(self):
-        self.audio_enabled = not self.audio_enabled
-        if self.audio_enabled:
-            self.btn_mute.config(text="Mute Audio")
-        else:
-            self.btn_mute.config(text="Unmute Audio")
-    
-    def riproduci_suono(self):
-        """Riproduce il suono basato sull'ultima percentuale di verde rilevata"""
-        if self.ultima_percentuale is not None:
-            self.play_green_sound(self.ultima_percentuale)
-        else:
-            messagebox.showinfo("Nessun dato", "Carica prima un'immagine per analizzare la percentuale di verde.")
-            self.btn_riproduci_suono.config(state=tk.DISABLED)
 
 if __name__ == "__main__":
     # Controlla se le dipendenze sono installate
@@ -534,21 +606,13 @@ if __name__ == "__main__":
         messagebox.showerror("Dipendenza Mancante", "Pillow (PIL) non è installato. Per favore, installalo eseguendo: pip install Pillow")
         exit()
     
-    try:
-        import pygame.midi
-    except ImportError:
-        messagebox.showwarning("Dipendenza Mancante", "pygame non è installato. La funzionalità MIDI non sarà disponibile.\nPer installarla, esegui: pip install pygame")
-    
     root = tk.Tk()
     app = GreenDetectorApp(root)
     
     # Funzione per chiudere correttamente l'applicazione
     def on_closing():
         # Chiudi correttamente le risorse MIDI
-        if hasattr(app, 'midi_output') and app.midi_output is not None:
-            del app.midi_output
-        if 'pygame.midi' in sys.modules and pygame.midi.get_init():
-            pygame.midi.quit()
+        app.chiudi_midi()
         root.destroy()
     
     root.protocol("WM_DELETE_WINDOW", on_closing)
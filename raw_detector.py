@@ -0,0 +1,127 @@
+import os
+import sys
+import time
+
+from green_detector import RisultatoVerde, analizza_rgb, percentuale_pixel, ritaglia, np
+from vegetation_detector import PIXEL_PER_BANDA
+
+# Byte per pixel e posizione di R, G e B per ogni ordine dei canali; con passo -1 la vista
+# inverte l'ordine dei canali senza copiare
+ORDINI_CANALI = {
+    'rgb': (3, slice(0, 3)),
+    'bgr': (3, slice(2, None, -1)),
+    'rgba': (4, slice(0, 3)),
+    'bgra': (4, slice(2, None, -1)),
+    'argb': (4, slice(1, 4)),
+    'abgr': (4, slice(3, 0, -1)),
+}
+
+
+def _formato(larghezza, altezza, ordine, passo_riga):
+    """Controlla il formato e restituisce (byte per pixel, selezione dei canali, passo tra le righe)"""
+    if ordine not in ORDINI_CANALI:
+        raise ValueError(f"Ordine dei canali sconosciuto: {ordine} (disponibili: {', '.join(ORDINI_CANALI)})")
+    if larghezza < 1 or altezza < 1:
+        raise ValueError(f"Dimensioni non valide: {larghezza}x{altezza}")
+    canali, selezione = ORDINI_CANALI[ordine]
+    passo_riga = passo_riga or larghezza * canali
+    if passo_riga < larghezza * canali:
+        raise ValueError(f"Passo tra le righe troppo piccolo: {passo_riga} byte per righe di {larghezza * canali} byte")
+    return canali, selezione, passo_riga
+
+
+def pixel_da_buffer(buffer, larghezza, altezza, ordine='rgb', passo_riga=None, offset=0):
+    """Vista NumPy (altezza, larghezza, 3) in ordine RGB sui pixel grezzi di buffer, senza copiarli.
+
+    buffer è un qualsiasi oggetto con il buffer protocol: bytes, bytearray, memoryview, mmap o array
+    NumPy (anche np.memmap). passo_riga è la distanza in byte tra l'inizio di due righe (default:
+    righe senza padding), offset il byte del primo pixel. La vista si passa direttamente ad
+    analizza_pixel o ad analizza_raw; se il buffer è in sola lettura lo è anche la vista.
+    """
+    if np is None:
+        raise ImportError("L'input grezzo richiede NumPy (pip install numpy)")
+    canali, selezione, passo_riga = _formato(larghezza, altezza, ordine, passo_riga)
+    dati = np.frombuffer(buffer, dtype=np.uint8)
+    necessari = offset + passo_riga * (altezza - 1) + larghezza * canali
+    if dati.size < necessari:
+        raise ValueError(f"Buffer troppo piccolo: servono {necessari} byte, ce ne sono {dati.size}")
+    vista = np.ndarray((altezza, larghezza, canali), dtype=np.uint8, buffer=dati, offset=offset,
+                       strides=(passo_riga, canali, 1))
+    return vista[..., selezione]
+
+
+def fotogrammi_raw(percorso, larghezza, altezza, ordine='rgb', passo_riga=None, offset=0, byte_fotogramma=None):
+    """Viste RGB (vedi pixel_da_buffer) dei fotogrammi grezzi consecutivi di un file, mappato in memoria.
+
+    offset è il numero di byte prima del primo fotogramma; byte_fotogramma la distanza tra l'inizio
+    di due fotogrammi (default: passo_riga * altezza, fotogrammi senza intestazioni). Un fotogramma
+    incompleto alla fine del file viene ignorato. Il file non viene mai letto tutto in memoria:
+    il sistema operativo carica le pagine man mano che le viste vengono analizzate.
+    """
+    if np is None:
+        raise ImportError("L'input grezzo richiede NumPy (pip install numpy)")
+    canali, _, passo_riga = _formato(larghezza, altezza, ordine, passo_riga)
+    byte_fotogramma = byte_fotogramma or passo_riga * altezza
+    ingombro = passo_riga * (altezza - 1) + larghezza * canali
+    if byte_fotogramma < ingombro:
+        raise ValueError(f"Byte per fotogramma troppo pochi: {byte_fotogramma}, un fotogramma ne occupa {ingombro}")
+    disponibili = os.path.getsize(percorso) - offset
+    numero = (disponibili - ingombro) // byte_fotogramma + 1 if disponibili >= ingombro else 0
+
+    # Il formato è controllato subito, non al primo fotogramma richiesto
+    def viste():
+        if numero == 0:
+            return
+        mappa = np.memmap(percorso, dtype=np.uint8, mode='r')
+        for i in range(numero):
+            yield pixel_da_buffer(mappa, larghezza, altezza, ordine, passo_riga, offset + i * byte_fotogramma)
+    return viste()
+
+
+def analizza_raw(pixel, soglia=5, area_di_interesse=None, classificatore=None):
+    """Come analizza_pixel (solo i conteggi), ma percorrendo l'array per bande di PIXEL_PER_BANDA pixel.
+
+    Pensata per le viste di pixel_da_buffer e fotogrammi_raw, anche con righe o canali non contigui:
+    i pixel non vengono copiati, i valori intermedi di ogni banda restano in cache e la memoria usata
+    non dipende dalle dimensioni del fotogramma. Richiede NumPy.
+    """
+    regione, riquadri = ritaglia(pixel, area_di_interesse)
+    altezza, larghezza = regione.shape[:2]
+    if riquadri is None:
+        riquadri = [(0, 0, larghezza, altezza)]
+    altezza_banda = max(1, PIXEL_PER_BANDA // max(larghezza, 1))
+    pixel_verdi = pixel_totali = 0
+    for y in range(0, altezza, altezza_banda):
+        y2 = min(y + altezza_banda, altezza)
+        riquadri_banda = [(x1, max(ry1, y) - y, x2, min(ry2, y2) - y)
+                          for x1, ry1, x2, ry2 in riquadri if ry1 < y2 and ry2 > y]
+        if riquadri_banda:
+            verdi, totali, _, _ = analizza_rgb(regione[y:y2], soglia, False, 'numpy', riquadri_banda,
+                                               classificatore=classificatore)
+            pixel_verdi += verdi
+            pixel_totali += totali
+    return RisultatoVerde(percentuale_pixel(pixel_verdi, pixel_totali), pixel_verdi, pixel_totali)
+
+
+def main_raw(args):
+    """Fotogrammi grezzi dalla riga di comando di green_detector.py: una riga CSV per fotogramma"""
+    try:
+        fotogrammi = fotogrammi_raw(args.raw, args.larghezza, args.altezza, args.ordine, args.passo_riga,
+                                    args.offset, args.byte_fotogramma)
+        print("fotogramma,percentuale,pixel_verdi,pixel_totali")
+        numero = byte_letti = 0
+        inizio = time.perf_counter()
+        for numero, pixel in enumerate(fotogrammi, start=1):
+            risultato = analizza_raw(pixel, args.soglia, classificatore=args.classificatore)
+            print(f"{numero - 1},{risultato.percentuale},{risultato.pixel_verdi},{risultato.pixel_totali}")
+            byte_letti += pixel.shape[0] * pixel.strides[0]
+    except ValueError as e:
+        print(f"Errore: {e}", file=sys.stderr)
+        return 1
+    durata = time.perf_counter() - inizio
+    if numero == 0:
+        print("Nessun fotogramma completo nel file", file=sys.stderr)
+        return 1
+    print(f"{numero} fotogrammi ({byte_letti / 1e9:.2f} GB) analizzati in {durata:.2f} s "
+          f"({byte_letti / 1e9 / max(durata, 1e-9):.2f} GB/s)", file=sys.stderr)
+    return 0
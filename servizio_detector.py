@@ -0,0 +1,348 @@
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import time
+import traceback
+from http import HTTPStatus
+from urllib.parse import parse_qsl, urlsplit
+
+from batch_detector import analizza_file, nomi_overlay
+from green_detector import MOTORI_DISPONIBILI, SCALE, ClassificatoreStandard, np
+
+PORTA = 8765
+
+# Immagini al massimo in un lotto inviato a un processo
+DIMENSIONE_LOTTO = 16
+
+# Valori accettati per il parametro overlay
+_SI = (True, 1, '1', 'true', 'si', 'sì')
+_NO = (None, False, 0, '', '0', 'false', 'no')
+
+
+class _ErroreRichiesta(Exception):
+    def __init__(self, stato, messaggio):
+        super().__init__(messaggio)
+        self.stato = stato
+
+
+def _prepara_processo():
+    """Eseguita all'avvio di ogni processo del pool: importa subito tutto ciò che serve all'analisi"""
+    import vegetation_detector  # noqa: F401
+    if np is not None:
+        np.zeros(1)  # NumPy viene importato al primo uso
+
+
+def _analizza_lotto(compiti):
+    """Eseguita nei processi del pool: analizza un lotto di immagini, da percorso o dal contenuto caricato"""
+    risultati = []
+    for compito in compiti:
+        if isinstance(compito[0], bytes):
+            risultato = analizza_file((io.BytesIO(compito[0]),) + compito[1:])
+            risultato['percorso'] = None
+        else:
+            risultato = analizza_file(compito)
+        risultati.append(risultato)
+    return risultati
+
+
+class ServizioAnalisi:
+    """Servizio HTTP locale che analizza immagini con un pool di processi già avviati.
+
+    Le richieste arrivate mentre tutti i processi sono occupati si accodano e vengono inviate al
+    primo processo libero in un unico lotto (fino a dimensione_lotto immagini): sotto carico si
+    ammortizza la comunicazione tra processi, mentre una richiesta isolata parte subito. Le
+    connessioni restano aperte tra una richiesta e l'altra (keep-alive).
+    Gli overlay si salvano solo in output_dir, scelta all'avvio: i client non indicano mai percorsi di scrittura.
+    """
+
+    def __init__(self, workers=None, cache_db=None, cache_limite_byte=1024 * 1024 * 1024,
+                 dimensione_lotto=DIMENSIONE_LOTTO, dimensione_massima=256 * 1024 * 1024, output_dir=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.output_dir = output_dir
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+        self.cache = (cache_db, cache_limite_byte) if cache_db is not None else None
+        self.dimensione_lotto = dimensione_lotto
+        self.dimensione_massima = dimensione_massima
+        self.richieste = 0
+        self.immagini = 0
+        self.lotti = 0
+        self.errori = 0
+        self._inizio = time.monotonic()
+        # Il pool va creato prima del ciclo asyncio: i processi partono (e si preparano) subito
+        self._pool = multiprocessing.Pool(self.workers, initializer=_prepara_processo)
+        self._coda = None
+        self._liberi = None
+
+    async def avvia(self, host='127.0.0.1', porta=PORTA, percorso_socket=None):
+        """Apre il socket (TCP o, con percorso_socket, Unix) e restituisce l'asyncio.Server"""
+        self._coda = asyncio.Queue()
+        self._liberi = asyncio.Semaphore(self.workers)
+        asyncio.get_running_loop().create_task(self._distribuisci())
+        if percorso_socket is not None:
+            return await asyncio.start_unix_server(self._gestisci_connessione, percorso_socket)
+        return await asyncio.start_server(self._gestisci_connessione, host, porta)
+
+    def chiudi(self):
+        self._pool.terminate()
+        self._pool.join()
+
+    async def analizza(self, compiti):
+        """Accoda i compiti (vedi batch_detector.analizza_file) e restituisce i risultati nello stesso ordine"""
+        loop = asyncio.get_running_loop()
+        futuri = []
+        for compito in compiti:
+            futuro = loop.create_future()
+            self._coda.put_nowait((compito, futuro))
+            futuri.append(futuro)
+        return await asyncio.gather(*futuri)
+
+    async def _distribuisci(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            lotto = [await self._coda.get()]
+            await self._liberi.acquire()
+            # Nel frattempo possono essere arrivate altre richieste: partono insieme
+            while len(lotto) < self.dimensione_lotto and not self._coda.empty():
+                lotto.append(self._coda.get_nowait())
+            self.lotti += 1
+            futuri = [futuro for _, futuro in lotto]
+
+            def completato(risultati, futuri=futuri):
+                loop.call_soon_threadsafe(self._consegna, futuri, risultati, None)
+
+            def fallito(errore, futuri=futuri):
+                loop.call_soon_threadsafe(self._consegna, futuri, None, errore)
+
+            self._pool.apply_async(_analizza_lotto, ([compito for compito, _ in lotto],),
+                                   callback=completato, error_callback=fallito)
+
+    def _consegna(self, futuri, risultati, errore):
+        self._liberi.release()
+        for i, futuro in enumerate(futuri):
+            if futuro.done():
+                continue
+            if errore is not None:
+                futuro.set_exception(errore)
+            else:
+                futuro.set_result(risultati[i])
+
+    def stato(self):
+        return {
+            'workers': self.workers,
+            'richieste': self.richieste,
+            'immagini': self.immagini,
+            'lotti': self.lotti,
+            'in_coda': self._coda.qsize() if self._coda is not None else 0,
+            'errori': self.errori,
+            'secondi_attivo': round(time.monotonic() - self._inizio, 1),
+        }
+
+    async def _gestisci_connessione(self, reader, writer):
+        try:
+            while True:
+                try:
+                    richiesta = await _leggi_richiesta(reader, self.dimensione_massima)
+                    if richiesta is None:
+                        break
+                    metodo, destinazione, versione, intestazioni, corpo = richiesta
+                    chiudi = (intestazioni.get('connection', '').lower() == 'close' or
+                              (versione == 'HTTP/1.0' and intestazioni.get('connection', '').lower() != 'keep-alive'))
+                    stato, risposta = await self._rispondi(metodo, destinazione, intestazioni, corpo)
+                except _ErroreRichiesta as e:
+                    stato, risposta, chiudi = e.stato, {'errore': str(e)}, True
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    raise
+                except Exception as e:
+                    # Un errore imprevisto non deve chiudere la connessione senza risposta
+                    traceback.print_exc()
+                    stato, risposta, chiudi = HTTPStatus.INTERNAL_SERVER_ERROR, {'errore': f"{type(e).__name__}: {e}"}, True
+                writer.write(_risposta_http(stato, risposta, chiudi))
+                await writer.drain()
+                if chiudi:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _rispondi(self, metodo, destinazione, intestazioni, corpo):
+        indirizzo = urlsplit(destinazione)
+        parametri = dict(parse_qsl(indirizzo.query))
+        if indirizzo.path == '/stato' and metodo == 'GET':
+            return HTTPStatus.OK, self.stato()
+        if indirizzo.path != '/analizza':
+            raise _ErroreRichiesta(HTTPStatus.NOT_FOUND, f"Percorso sconosciuto: {indirizzo.path}")
+        if metodo not in ('GET', 'POST'):
+            raise _ErroreRichiesta(HTTPStatus.METHOD_NOT_ALLOWED, f"Metodo non supportato: {metodo}")
+
+        self.richieste += 1
+        if intestazioni.get('content-type', '').split(';')[0].strip() == 'application/json':
+            try:
+                dati = json.loads(corpo)
+            except (ValueError, TypeError) as e:
+                raise _ErroreRichiesta(HTTPStatus.BAD_REQUEST, f"JSON non valido: {e}")
+            if not isinstance(dati, dict):
+                raise _ErroreRichiesta(HTTPStatus.BAD_REQUEST,
+                                       f"Il corpo JSON deve essere un oggetto con i parametri, non {type(dati).__name__}")
+            parametri.update(dati)
+            corpo = b''
+
+        if corpo:
+            # Il corpo è il contenuto dell'immagine; l'eventuale cache vale solo per i file
+            nome = f"caricata_{hashlib.sha1(corpo).hexdigest()[:12]}"
+            compiti = [self._compito(corpo, parametri, self._overlay([nome], parametri, impronta=False)[0], cache=False)]
+        elif 'percorsi' in parametri:
+            if not isinstance(parametri['percorsi'], list):
+                raise _ErroreRichiesta(HTTPStatus.BAD_REQUEST, "percorsi deve essere una lista")
+            percorsi = [str(percorso) for percorso in parametri['percorsi']]
+            compiti = [self._compito(percorso, parametri, overlay)
+                       for percorso, overlay in zip(percorsi, self._overlay(percorsi, parametri))]
+        elif 'percorso' in parametri:
+            percorso = str(parametri['percorso'])
+            compiti = [self._compito(percorso, parametri, self._overlay([percorso], parametri)[0])]
+        else:
+            raise _ErroreRichiesta(HTTPStatus.BAD_REQUEST, "Indicare percorso, percorsi o inviare l'immagine nel corpo")
+
+        risultati = await self.analizza(compiti)
+        self.immagini += len(risultati)
+        errori = sum(risultato['errore'] is not None for risultato in risultati)
+        self.errori += errori
+        if 'percorsi' in parametri and not corpo:
+            return HTTPStatus.OK, {'risultati': risultati}
+        return (HTTPStatus.UNPROCESSABLE_ENTITY if errori else HTTPStatus.OK), risultati[0]
+
+    def _overlay(self, percorsi, parametri, impronta=True):
+        """Percorsi degli overlay in output_dir se la richiesta li chiede (overlay=1), altrimenti None"""
+        valore = parametri.get('overlay')
+        if isinstance(valore, str):
+            valore = valore.lower()
+        if valore in _NO:
+            return [None] * len(percorsi)
+        if valore not in _SI:
+            raise _ErroreRichiesta(HTTPStatus.BAD_REQUEST, f"overlay vale 1 o 0, non {parametri.get('overlay')}")
+        if self.output_dir is None:
+            raise _ErroreRichiesta(HTTPStatus.BAD_REQUEST, "Overlay non disponibili: il servizio è avviato senza --output-dir")
+        # Con l'hash del percorso nel nome richieste diverse non si sovrascrivono gli overlay;
+        # il nome dei file caricati contiene già l'hash del contenuto
+        return nomi_overlay(percorsi, self.output_dir, impronta)
+
+    def _compito(self, sorgente, parametri, percorso_overlay=None, cache=True):
+        """Compito per batch_detector.analizza_file dai parametri della richiesta"""
+        try:
+            soglia = int(parametri.get('soglia', 2))
+        except (ValueError, TypeError):
+            raise _ErroreRichiesta(HTTPStatus.BAD_REQUEST, f"Soglia non valida: {parametri.get('soglia')}")
+        motore = parametri.get('motore')
+        if motore is not None and motore not in MOTORI_DISPONIBILI:
+            raise _ErroreRichiesta(HTTPStatus.BAD_REQUEST,
+                                   f"Motore non disponibile: {motore} (disponibili: {', '.join(MOTORI_DISPONIBILI)})")
+        try:
+            scala = int(parametri.get('scala', 1))
+        except (ValueError, TypeError):
+            scala = None
+        if scala not in SCALE:
+            raise _ErroreRichiesta(HTTPStatus.BAD_REQUEST,
+                                   f"Scala non valida: {parametri.get('scala')} (ammesse: {', '.join(map(str, SCALE))})")
+        classificatore = None
+        if parametri.get('indice'):
+            import vegetation_detector
+            try:
+                classificatore = vegetation_detector.crea_classificatore(str(parametri['indice']), soglia)
+            except ValueError as e:
+                raise _ErroreRichiesta(HTTPStatus.BAD_REQUEST, str(e))
+            if isinstance(classificatore, ClassificatoreStandard):
+                soglia, classificatore = classificatore.soglia, None
+        # La cache dei risultati vale solo per la regola standard a piena risoluzione
+        cache_db = self.cache if cache and classificatore is None and scala == 1 else None
+        return sorgente, soglia, motore, percorso_overlay, cache_db, classificatore, scala
+
+
+async def _leggi_richiesta(reader, dimensione_massima):
+    """Legge una richiesta HTTP/1.x: (metodo, destinazione, versione, intestazioni, corpo), None a connessione chiusa"""
+    riga = await reader.readline()
+    if not riga:
+        return None
+    try:
+        metodo, destinazione, versione = riga.decode('latin-1').split()
+    except ValueError:
+        raise _ErroreRichiesta(HTTPStatus.BAD_REQUEST, "Riga di richiesta non valida")
+    intestazioni = {}
+    while True:
+        riga = await reader.readline()
+        if riga in (b'\r\n', b'\n', b''):
+            break
+        nome, _, valore = riga.decode('latin-1').partition(':')
+        intestazioni[nome.strip().lower()] = valore.strip()
+    if 'chunked' in intestazioni.get('transfer-encoding', '').lower():
+        raise _ErroreRichiesta(HTTPStatus.LENGTH_REQUIRED, "Indicare Content-Length invece di inviare a blocchi")
+    try:
+        lunghezza = int(intestazioni.get('content-length', 0))
+    except ValueError:
+        lunghezza = -1
+    if lunghezza < 0:
+        raise _ErroreRichiesta(HTTPStatus.BAD_REQUEST, "Content-Length non valido")
+    if lunghezza > dimensione_massima:
+        raise _ErroreRichiesta(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"Corpo oltre il limite di {dimensione_massima} byte")
+    corpo = await reader.readexactly(lunghezza) if lunghezza else b''
+    return metodo.upper(), destinazione, versione.upper(), intestazioni, corpo
+
+
+def _risposta_http(stato, dati, chiudi):
+    corpo = json.dumps(dati, ensure_ascii=False).encode('utf-8')
+    intestazioni = (f"HTTP/1.1 {stato.value} {stato.phrase}\r\n"
+                    f"Content-Type: application/json; charset=utf-8\r\n"
+                    f"Content-Length: {len(corpo)}\r\n"
+                    f"Connection: {'close' if chiudi else 'keep-alive'}\r\n\r\n")
+    return intestazioni.encode('latin-1') + corpo
+
+
+async def _servi(servizio, args):
+    server = await servizio.avvia(args.host, args.porta, args.socket)
+    indirizzo = args.socket if args.socket else f"http://{args.host}:{args.porta}"
+    print(f"Servizio in ascolto su {indirizzo} con {servizio.workers} processi", file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Servizio HTTP locale per l\'analisi del verde, con processi già avviati')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Indirizzo su cui ascoltare (default: 127.0.0.1)')
+    parser.add_argument('--porta', type=int, default=PORTA, help=f'Porta TCP (default: {PORTA})')
+    parser.add_argument('--socket', type=str, default=None, metavar='PERCORSO', help='Ascolta su un socket Unix invece che su TCP')
+    parser.add_argument('--workers', type=int, default=None, help='Numero di processi (default: uno per core)')
+    parser.add_argument('--lotto', type=int, default=DIMENSIONE_LOTTO,
+                        help=f'Immagini al massimo inviate insieme a un processo (default: {DIMENSIONE_LOTTO})')
+    parser.add_argument('--dimensione-massima', type=int, default=256, metavar='MB',
+                        help='Dimensione massima di un\'immagine caricata (default: 256 MB)')
+    parser.add_argument('--cache-db', type=str, default=None, metavar='FILE',
+                        help='Database SQLite in cui conservare i risultati (solo regola standard e immagini da percorso)')
+    parser.add_argument('--cache-limite', type=int, default=1024, metavar='MB',
+                        help='Dimensione massima della cache dei risultati (default: 1024 MB)')
+    parser.add_argument('--output-dir', type=str, default=None, metavar='CARTELLA',
+                        help='Cartella in cui salvare gli overlay chiesti con overlay=1 (default: overlay disattivati)')
+    args = parser.parse_args(argv)
+    if args.socket and not hasattr(socket, 'AF_UNIX'):
+        parser.error("I socket Unix non sono disponibili su questo sistema")
+    if args.lotto < 1:
+        parser.error("--lotto deve essere almeno 1")
+
+    servizio = ServizioAnalisi(args.workers, args.cache_db, args.cache_limite * 1024 * 1024, args.lotto,
+                               args.dimensione_massima * 1024 * 1024, args.output_dir)
+    try:
+        asyncio.run(_servi(servizio, args))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servizio.chiudi()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
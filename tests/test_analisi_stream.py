@@ -0,0 +1,116 @@
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+import green_detector
+import video_detector
+
+np = green_detector.np
+
+
+class _CatturaFinta:
+    """Sostituto di cv2.VideoCapture che restituisce fotogrammi BGR già pronti"""
+
+    def __init__(self, fotogrammi, attesa_grab=0.0):
+        self.fotogrammi = fotogrammi
+        self.attesa_grab = attesa_grab
+        self.posizione = -1
+        self.decodificati = 0
+        self.rilasciata = threading.Event()
+
+    def isOpened(self):
+        return True
+
+    def get(self, proprieta):
+        return 25.0
+
+    def grab(self):
+        time.sleep(self.attesa_grab)
+        self.posizione += 1
+        return self.posizione < len(self.fotogrammi)
+
+    def retrieve(self):
+        self.decodificati += 1
+        return True, self.fotogrammi[self.posizione]
+
+    def release(self):
+        self.rilasciata.set()
+
+
+def _fotogrammi_bgr(numero, altezza=24, larghezza=32):
+    generatore = np.random.default_rng(11)
+    return [generatore.integers(0, 256, (altezza, larghezza, 3), dtype=np.uint8) for _ in range(numero)]
+
+
+@unittest.skipIf(np is None, "richiede NumPy")
+class TestAnalisiStream(unittest.TestCase):
+    """AnalisiStream su una sorgente OpenCV simulata: ordine, conteggi e fotogrammi saltati"""
+
+    def _sorgente(self, cattura, sorgente='video.mp4', fps=None):
+        cv2 = types.SimpleNamespace(VideoCapture=lambda _: cattura, CAP_PROP_FPS=5)
+        with mock.patch.object(video_detector, 'cv2', cv2):
+            return video_detector.SorgenteOpenCV(sorgente, fps)
+
+    def test_conteggi_come_analizza_pixel(self):
+        fotogrammi = _fotogrammi_bgr(12)
+        analisi = video_detector.AnalisiStream(self._sorgente(_CatturaFinta(fotogrammi)), soglia=2, workers=3)
+        risultati = list(analisi)
+        self.assertEqual([r.indice for r in risultati], list(range(12)))
+        self.assertEqual([r.tempo for r in risultati], [round(i / 25.0, 4) for i in range(12)])
+        for risultato, bgr in zip(risultati, fotogrammi):
+            atteso = green_detector.analizza_pixel(np.ascontiguousarray(bgr[..., ::-1]), 2)
+            self.assertEqual((risultato.pixel_verdi, risultato.pixel_totali),
+                             (atteso.pixel_verdi, atteso.pixel_totali))
+            self.assertEqual(risultato.percentuale, atteso.percentuale)
+        self.assertEqual((analisi.analizzati, analisi.saltati), (12, 0))
+
+    def test_riordino(self):
+        # I primi fotogrammi finiscono per ultimi: i risultati devono comunque uscire in ordine
+        originale = video_detector.analizza_pixel
+
+        def analizza_lenta(pixel, soglia, **opzioni):
+            time.sleep(0.02 * max(0, 4 - int(pixel[0, 0, 0])))
+            return originale(pixel, soglia, **opzioni)
+
+        fotogrammi = [np.full((4, 4, 3), i, dtype=np.uint8) for i in range(10)]
+        with mock.patch.object(video_detector, 'analizza_pixel', analizza_lenta):
+            analisi = video_detector.AnalisiStream(self._sorgente(_CatturaFinta(fotogrammi)), workers=4)
+            indici = [r.indice for r in analisi]
+        self.assertEqual(indici, list(range(10)))
+
+    def test_tempo_reale_coda_piena(self):
+        # Telecamera con analisi ferma: a coda piena i fotogrammi si saltano senza decodificarli
+        cattura = _CatturaFinta(_fotogrammi_bgr(20))
+        sblocca = threading.Event()
+        originale = video_detector.analizza_pixel
+
+        def analizza_bloccata(pixel, soglia, **opzioni):
+            sblocca.wait(5)
+            return originale(pixel, soglia, **opzioni)
+
+        with mock.patch.object(video_detector, 'analizza_pixel', analizza_bloccata):
+            analisi = video_detector.AnalisiStream(self._sorgente(cattura, sorgente=0), workers=1, ritardo_massimo=60)
+            self.assertTrue(analisi.tempo_reale)
+            threading.Thread(target=lambda: (cattura.rilasciata.wait(5), sblocca.set()), daemon=True).start()
+            risultati = list(analisi)
+        self.assertEqual(analisi.analizzati + analisi.saltati, 20)
+        self.assertGreaterEqual(analisi.saltati, 20 - 3)
+        self.assertEqual(cattura.decodificati, analisi.analizzati)
+        self.assertEqual(len(risultati), analisi.analizzati)
+        indici = [r.indice for r in risultati]
+        self.assertEqual(indici, sorted(indici))
+
+    def test_tempo_reale_ritardo(self):
+        # File riprodotto in tempo reale con lettura più lenta dei fotogrammi: si salta tutto ciò che è in ritardo
+        cattura = _CatturaFinta(_fotogrammi_bgr(5), attesa_grab=0.02)
+        analisi = video_detector.AnalisiStream(self._sorgente(cattura, fps=1000), workers=2, tempo_reale=True,
+                                               ritardo_massimo=0.01)
+        self.assertEqual(list(analisi), [])
+        self.assertEqual((analisi.analizzati, analisi.saltati), (0, 5))
+        self.assertEqual(cattura.decodificati, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
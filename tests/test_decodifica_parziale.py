@@ -0,0 +1,85 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from PIL import Image
+
+import green_detector
+
+
+def _immagine(larghezza, altezza):
+    """Immagine RGB in cui ogni riga e ogni colonna hanno colori diversi"""
+    img = Image.new('RGB', (larghezza, altezza))
+    img.putdata([(x % 256, (y * 7) % 256, (x + y) % 256) for y in range(altezza) for x in range(larghezza)])
+    return img
+
+
+class TestDecodificaParziale(unittest.TestCase):
+    """La decodifica delle sole righe dell'area di interesse deve dare gli stessi pixel di crop"""
+
+    AREE = [(0, 0, 5, 5), (10, 37, 90, 61), (3, 0, 97, 80), (50, 79, 51, 80)]
+
+    def setUp(self):
+        self.cartella = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cartella.cleanup)
+
+    def _salva(self, formato, **opzioni):
+        percorso = os.path.join(self.cartella.name, f"prova.{formato.lower()}")
+        _immagine(100, 80).save(percorso, formato, **opzioni)
+        return percorso
+
+    def _controlla(self, percorso):
+        with Image.open(percorso) as img:
+            completa = img.convert('RGB')
+        for area in self.AREE:
+            with self.subTest(area=area):
+                regione, _ = green_detector.apri_regione(percorso, area)
+                self.assertEqual(regione.size, (area[2] - area[0], area[3] - area[1]))
+                self.assertEqual(regione.tobytes(), completa.crop(area).tobytes())
+
+    def test_verifica_pillow(self):
+        self.assertTrue(green_detector._decodifica_parziale_verificata())
+
+    def test_png(self):
+        self._controlla(self._salva('PNG'))
+
+    def test_png_interlacciato(self):
+        self._controlla(self._salva('PNG', interlace=1))
+
+    def test_jpeg(self):
+        self._controlla(self._salva('JPEG', quality=95))
+
+    def test_bmp(self):
+        self._controlla(self._salva('BMP'))
+
+    def test_tiff(self):
+        self._controlla(self._salva('TIFF'))
+
+    def test_strisce(self):
+        percorso = self._salva('BMP')
+        with Image.open(percorso) as img:
+            completa = img.convert('RGB')
+        for y, striscia in green_detector._strisce_rgb(percorso, 30):
+            self.assertEqual(striscia.tobytes(), completa.crop((0, y, 100, y + striscia.height)).tobytes())
+
+    def test_disposizione_inattesa(self):
+        # Una tile che non ha la forma attesa fa ripiegare sulla decodifica completa
+        percorso = self._salva('PNG')
+        with Image.open(percorso) as img:
+            img.tile = [tuple(img.tile[0])]
+            self.assertEqual(green_detector._limita_decodifica(img, 10, 20), 0)
+            self.assertEqual(img.size, (100, 80))
+
+    def test_verifica_fallita(self):
+        # Se la verifica con la versione di Pillow in uso fallisce non si modifica mai l'immagine
+        with mock.patch.object(green_detector, '_decodifica_parziale_verificata', return_value=False):
+            for formato in ('PNG', 'BMP'):
+                self._controlla(self._salva(formato))
+                with Image.open(self._salva(formato)) as img:
+                    self.assertEqual(green_detector._limita_decodifica(img, 10, 20), 0)
+                    self.assertEqual(img.size, (100, 80))
+
+
+if __name__ == '__main__':
+    unittest.main()
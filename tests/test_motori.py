@@ -0,0 +1,94 @@
+import os
+import random
+import tempfile
+import unittest
+
+from PIL import Image
+
+import green_detector
+
+SOGLIE = (-256, -3, 0, 2, 5, 254, 255)
+
+
+def _riferimento(image_path, soglia):
+    """Il ciclo pixel per pixel originale: (percentuale, pixel verdi, overlay RGBA)"""
+    img_rgb = Image.open(image_path).convert('RGB')
+    width, height = img_rgb.size
+    output_img = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    output_pixels = output_img.load()
+    pixel_verdi = 0
+    dati = img_rgb.tobytes()
+    for i in range(width * height):
+        r, g, b = dati[3 * i:3 * i + 3]
+        if g > r + soglia and g > b + soglia:
+            pixel_verdi += 1
+            output_pixels[i % width, i // width] = (r, g, b, 255)
+    data = width * height
+    percentuale = round((pixel_verdi / data) * 100, 2) if data > 0 else 0
+    return percentuale, pixel_verdi, output_img
+
+
+def _immagine_ai_bordi(larghezza, altezza, soglie, seme=7):
+    """Pixel casuali più, per ogni soglia, pixel con g - r e g - b pari a soglia - 1, soglia e soglia + 1"""
+    generatore = random.Random(seme)
+    pixel = [tuple(generatore.randrange(256) for _ in range(3)) for _ in range(larghezza * altezza)]
+    bordi = []
+    for soglia in soglie:
+        for dr in (soglia - 1, soglia, soglia + 1):
+            for db in (soglia - 1, soglia, soglia + 1):
+                g = generatore.randrange(256)
+                r, b = g - dr, g - db
+                if 0 <= r <= 255 and 0 <= b <= 255:
+                    bordi.append((r, g, b))
+    # Valori estremi dei canali, dove un'aritmetica a 8 bit andrebbe in overflow
+    bordi += [(0, 255, 0), (255, 0, 255), (0, 0, 0), (255, 255, 255), (0, 255, 255), (255, 255, 0)]
+    posizioni = generatore.sample(range(len(pixel)), len(bordi))
+    for posizione, valore in zip(posizioni, bordi):
+        pixel[posizione] = valore
+    img = Image.new('RGB', (larghezza, altezza))
+    img.putdata(pixel)
+    return img
+
+
+class TestMotori(unittest.TestCase):
+    """I motori numpy e pil devono dare gli stessi risultati del ciclo pixel per pixel originale"""
+
+    def setUp(self):
+        cartella = tempfile.TemporaryDirectory()
+        self.addCleanup(cartella.cleanup)
+        self.percorso = os.path.join(cartella.name, 'prova.png')
+        _immagine_ai_bordi(61, 47, SOGLIE).save(self.percorso)
+        self.percorso_grigio = os.path.join(cartella.name, 'grigio.png')
+        _immagine_ai_bordi(13, 9, ()).convert('L').save(self.percorso_grigio)
+
+    def _confronta(self, percorso):
+        for soglia in SOGLIE:
+            percentuale, pixel_verdi, overlay = _riferimento(percorso, soglia)
+            for motore in green_detector.MOTORI_DISPONIBILI:
+                with self.subTest(soglia=soglia, motore=motore):
+                    risultato = green_detector.analizza_verde(percorso, soglia, True, motore)
+                    self.assertEqual(risultato.percentuale, percentuale)
+                    self.assertEqual(risultato.pixel_verdi, pixel_verdi)
+                    self.assertEqual(risultato.pixel_totali, overlay.width * overlay.height)
+                    self.assertEqual(risultato.immagine_output.mode, 'RGBA')
+                    self.assertEqual(risultato.immagine_output.tobytes(), overlay.tobytes())
+                    self.assertEqual(green_detector.calcola_percentuale_verde(percorso, soglia, motore=motore),
+                                     percentuale)
+
+    def test_come_riferimento(self):
+        self._confronta(self.percorso)
+
+    def test_immagine_non_rgb(self):
+        self._confronta(self.percorso_grigio)
+
+    def test_strisce(self):
+        for soglia in (0, 5):
+            _, pixel_verdi, _ = _riferimento(self.percorso, soglia)
+            for motore in green_detector.MOTORI_DISPONIBILI:
+                with self.subTest(soglia=soglia, motore=motore):
+                    risultato = green_detector.analizza_verde_a_strisce(self.percorso, soglia, motore, altezza_striscia=10)
+                    self.assertEqual(risultato.pixel_verdi, pixel_verdi)
+
+
+if __name__ == '__main__':
+    unittest.main()
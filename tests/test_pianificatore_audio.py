@@ -0,0 +1,107 @@
+import time
+import unittest
+from unittest import mock
+
+import audio_lifemeter
+from audio_lifemeter import NOTA_OFF, NOTA_ON, BackendNullo, PianificatoreAudio
+
+
+class _BackendInaffidabile(BackendNullo):
+    """BackendNullo che conta aperture e chiusure e fa fallire le prime `errori` scritture"""
+
+    def __init__(self, errori=0):
+        super().__init__()
+        self.errori = errori
+        self.aperture = 0
+        self.chiusure = 0
+
+    def apri(self):
+        self.aperture += 1
+
+    def scrivi(self, messaggi):
+        if self.errori:
+            self.errori -= 1
+            raise OSError("uscita MIDI scollegata")
+        super().scrivi(messaggi)
+
+    def chiudi(self):
+        self.chiusure += 1
+
+
+class _BackendConTimestamp(BackendNullo):
+    usa_timestamp = True
+
+
+def _note(backend):
+    return [(stato, nota) for _, (stato, nota, _) in backend.messaggi]
+
+
+class TestPianificatoreAudio(unittest.TestCase):
+
+    def _pianificatore(self, backend):
+        pianificatore = PianificatoreAudio(backend)
+        self.addCleanup(pianificatore.chiudi)
+        return pianificatore
+
+    def _attendi(self, pianificatore):
+        # Gli eventi dovuti adesso vengono eseguiti prima di questa funzione
+        pianificatore.esegui(lambda: None).result(2)
+
+    def _attendi_messaggi(self, backend, numero, limite=2.0):
+        scadenza = time.monotonic() + limite
+        while len(backend.messaggi) < numero and time.monotonic() < scadenza:
+            time.sleep(0.005)
+
+    def test_nuovo_accordo_sostituisce_il_precedente(self):
+        backend = BackendNullo()
+        pianificatore = self._pianificatore(backend)
+        pianificatore.suona_accordo([60, 64, 67], sfasamento=0.2, durata=5)
+        # Dopo 0.3 s sono accese 60 e 64, la 67 è ancora in coda
+        time.sleep(0.3)
+        pianificatore.suona_accordo([72, 76, 79], sfasamento=0, durata=5)
+        self._attendi(pianificatore)
+        self.assertEqual(_note(backend), [(NOTA_ON, 60), (NOTA_ON, 64),
+                                          (NOTA_OFF, 60), (NOTA_OFF, 64),
+                                          (NOTA_ON, 72), (NOTA_ON, 76), (NOTA_ON, 79)])
+        pianificatore.chiudi()
+        # Alla chiusura si spengono solo le note accese; della 67 e degli spegnimenti del primo accordo non resta nulla
+        self.assertEqual(_note(backend)[7:], [(NOTA_OFF, 72), (NOTA_OFF, 76), (NOTA_OFF, 79)])
+
+    def test_ordine_temporale(self):
+        for backend in (BackendNullo(), _BackendConTimestamp()):
+            with self.subTest(usa_timestamp=backend.usa_timestamp):
+                pianificatore = self._pianificatore(backend)
+                inizio = time.monotonic()
+                for ritardo, valore in ((0.09, 3), (0.03, 1), (0.06, 2), (0.0, 0)):
+                    pianificatore.genera(lambda istante, valore=valore: [(NOTA_ON, 40 + valore, 1)], inizio + ritardo)
+                pianificatore.suona_accordo([50, 51], sfasamento=0.05, durata=0.02, sostituisci=False)
+                self._attendi_messaggi(backend, 8)
+                istanti = [istante for istante, _ in backend.messaggi]
+                self.assertEqual(istanti, sorted(istanti))
+                self.assertEqual(sorted(_note(backend)), sorted([(NOTA_ON, 40), (NOTA_ON, 41), (NOTA_ON, 42), (NOTA_ON, 43),
+                                                                 (NOTA_ON, 50), (NOTA_ON, 51),
+                                                                 (NOTA_OFF, 50), (NOTA_OFF, 51)]))
+                self.assertEqual([n for s, n in _note(backend) if n < 50], [40, 41, 42, 43])
+
+    def test_scrittura_fallita_riapre_l_uscita(self):
+        backend = _BackendInaffidabile(errori=1)
+        pianificatore = self._pianificatore(backend)
+        with mock.patch.object(audio_lifemeter, 'print', create=True) as stampa:
+            pianificatore.suona_accordo([60, 64, 67], sfasamento=0, durata=5)
+            self._attendi(pianificatore)
+            self.assertEqual((backend.aperture, backend.chiusure), (1, 1))
+            self.assertEqual(backend.messaggi, [])
+            stampa.assert_called_once()
+
+            pianificatore.suona_accordo([72], sfasamento=0, durata=5)
+            self._attendi(pianificatore)
+        self.assertEqual(backend.aperture, 2)
+        # Le note del primo accordo sono andate perse con l'uscita: non ci sono spegnimenti da inviare
+        self.assertEqual(_note(backend), [(NOTA_ON, 72)])
+        pianificatore.chiudi()
+        self.assertEqual(_note(backend), [(NOTA_ON, 72), (NOTA_OFF, 72)])
+        self.assertEqual(backend.chiusure, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
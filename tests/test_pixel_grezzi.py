@@ -0,0 +1,100 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from PIL import Image
+
+import green_detector
+import raw_detector
+
+np = green_detector.np
+
+SOGLIA = 2
+AREE = [None, (5, 3, 40, 29), [(0, 0, 10, 10), (30, 20, 47, 31)]]
+
+# Posizione di R, G e B nei byte di ogni pixel
+POSIZIONI = {'rgb': (0, 1, 2), 'bgr': (2, 1, 0), 'rgba': (0, 1, 2), 'bgra': (2, 1, 0), 'argb': (1, 2, 3),
+             'abgr': (3, 2, 1)}
+
+
+def _buffer(rgb, ordine, passo_riga, offset, generatore):
+    """Byte grezzi di rgb nell'ordine dei canali indicato, con byte casuali per alfa, padding e offset"""
+    altezza, larghezza = rgb.shape[:2]
+    canali = len(ordine)
+    dati = generatore.integers(0, 256, offset + passo_riga * altezza, dtype=np.uint8)
+    righe = dati[offset:].reshape(altezza, passo_riga)[:, :larghezza * canali].reshape(altezza, larghezza, canali)
+    for canale, posizione in enumerate(POSIZIONI[ordine]):
+        righe[..., posizione] = rgb[..., canale]
+    return dati.tobytes()
+
+
+@unittest.skipIf(np is None, "richiede NumPy")
+class TestPixelGrezzi(unittest.TestCase):
+    """Le viste sui pixel grezzi devono dare gli stessi risultati dell'immagine RGB equivalente"""
+
+    def setUp(self):
+        cartella = tempfile.TemporaryDirectory()
+        self.addCleanup(cartella.cleanup)
+        self.cartella = cartella.name
+        self.generatore = np.random.default_rng(3)
+        self.rgb = self.generatore.integers(0, 256, (31, 47, 3), dtype=np.uint8)
+        self.percorso = os.path.join(self.cartella, 'prova.png')
+        Image.fromarray(self.rgb).save(self.percorso)
+        # Bande piccole, così l'analisi percorre la vista in più passi
+        patch = mock.patch.object(raw_detector, 'PIXEL_PER_BANDA', 200)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def _controlla(self, pixel):
+        np.testing.assert_array_equal(pixel, self.rgb)
+        for area in AREE:
+            with self.subTest(area=area):
+                atteso = green_detector.analizza_verde(self.percorso, SOGLIA, area_di_interesse=area)
+                risultato = raw_detector.analizza_raw(pixel, SOGLIA, area_di_interesse=area)
+                self.assertEqual((risultato.percentuale, risultato.pixel_verdi, risultato.pixel_totali),
+                                 (atteso.percentuale, atteso.pixel_verdi, atteso.pixel_totali))
+
+    def test_ordini_e_passo_riga(self):
+        for ordine in raw_detector.ORDINI_CANALI:
+            for padding, offset in ((0, 0), (13, 7)):
+                with self.subTest(ordine=ordine, padding=padding):
+                    passo_riga = self.rgb.shape[1] * len(ordine) + padding
+                    dati = _buffer(self.rgb, ordine, passo_riga, offset, self.generatore)
+                    pixel = raw_detector.pixel_da_buffer(dati, 47, 31, ordine, passo_riga if padding else None, offset)
+                    self.assertFalse(pixel.flags.writeable)
+                    self.assertTrue(np.shares_memory(pixel, np.frombuffer(dati, dtype=np.uint8)))
+                    self._controlla(pixel)
+
+    def test_fotogrammi_raw(self):
+        passo_riga = 47 * 4 + 9
+        fotogrammi = [self.rgb, 255 - self.rgb, self.rgb[::-1]]
+        percorso = os.path.join(self.cartella, 'fotogrammi.raw')
+        byte_fotogramma = passo_riga * 31 + 20
+        with open(percorso, 'wb') as f:
+            f.write(b'\x00' * 11)
+            for rgb in fotogrammi:
+                f.write(_buffer(rgb, 'bgra', passo_riga, 0, self.generatore).ljust(byte_fotogramma, b'\x00'))
+            # Fotogramma incompleto alla fine del file: ignorato
+            f.write(b'\x00' * passo_riga)
+        letti = list(raw_detector.fotogrammi_raw(percorso, 47, 31, 'bgra', passo_riga, 11, byte_fotogramma))
+        self.assertEqual(len(letti), 3)
+        for pixel, rgb in zip(letti, fotogrammi):
+            np.testing.assert_array_equal(pixel, rgb)
+            self.assertEqual(raw_detector.analizza_raw(pixel, SOGLIA).pixel_verdi,
+                             green_detector.analizza_pixel(np.ascontiguousarray(rgb), SOGLIA).pixel_verdi)
+
+    def test_formati_non_validi(self):
+        dati = bytes(47 * 31 * 3)
+        with self.assertRaises(ValueError):
+            raw_detector.pixel_da_buffer(dati, 47, 31, 'rgbx')
+        with self.assertRaises(ValueError):
+            raw_detector.pixel_da_buffer(dati, 47, 31, 'rgb', passo_riga=47 * 3 - 1)
+        with self.assertRaises(ValueError):
+            raw_detector.pixel_da_buffer(dati, 47, 31, 'rgb', offset=1)
+        with self.assertRaises(ValueError):
+            raw_detector.pixel_da_buffer(dati, 0, 31)
+
+
+if __name__ == '__main__':
+    unittest.main()
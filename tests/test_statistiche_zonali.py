@@ -0,0 +1,97 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from PIL import Image
+
+import green_detector
+import zonal_detector
+
+np = green_detector.np
+
+SOGLIA = 3
+
+
+@unittest.skipIf(np is None, "richiede NumPy")
+class TestStatisticheZonali(unittest.TestCase):
+    """I conteggi per zona devono sommarsi a quelli globali di analizza_verde"""
+
+    def setUp(self):
+        cartella = tempfile.TemporaryDirectory()
+        self.addCleanup(cartella.cleanup)
+        generatore = np.random.default_rng(5)
+        self.altezza, self.larghezza = 67, 93
+        pixel = generatore.integers(0, 256, (self.altezza, self.larghezza, 3), dtype=np.uint8)
+        self.percorso = os.path.join(cartella.name, 'prova.png')
+        Image.fromarray(pixel).save(self.percorso)
+        risultato = green_detector.analizza_verde(self.percorso, SOGLIA, genera_maschera=True)
+        self.verdi = risultato.pixel_verdi
+        self.maschera = risultato.maschera.come_array()
+        self.etichette = generatore.integers(0, 6, (self.altezza, self.larghezza), dtype=np.uint8)
+        # Bande piccole, così ogni cella e ogni etichetta sono contate su più bande
+        patch = mock.patch.object(zonal_detector, 'PIXEL_PER_BANDA', 500)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_griglia(self):
+        statistiche = zonal_detector.statistiche_zonali(self.percorso, griglia=(4, 7), soglia=SOGLIA)
+        self.assertEqual(statistiche.pixel_verdi.shape, (4, 7))
+        self.assertEqual(int(statistiche.pixel_verdi.sum()), self.verdi)
+        self.assertEqual(int(statistiche.pixel_totali.sum()), self.larghezza * self.altezza)
+        bordi_y = zonal_detector._bordi(self.altezza, 4)
+        bordi_x = zonal_detector._bordi(self.larghezza, 7)
+        for r, c in np.ndindex(4, 7):
+            area = (int(bordi_x[c]), int(bordi_y[r]), int(bordi_x[c + 1]), int(bordi_y[r + 1]))
+            cella = green_detector.analizza_verde(self.percorso, SOGLIA, area_di_interesse=area)
+            self.assertEqual(int(statistiche.pixel_verdi[r, c]), cella.pixel_verdi)
+            self.assertEqual(int(statistiche.pixel_totali[r, c]), cella.pixel_totali)
+
+    def test_griglia_da_maschera(self):
+        attese = zonal_detector.statistiche_zonali(self.percorso, griglia=(3, 5), soglia=SOGLIA)
+        for maschera in (self.maschera, green_detector.MascheraVerde.da_array(self.maschera)):
+            statistiche = zonal_detector.griglia_da_maschera(maschera, (3, 5))
+            np.testing.assert_array_equal(statistiche.pixel_verdi, attese.pixel_verdi)
+            np.testing.assert_array_equal(statistiche.pixel_totali, attese.pixel_totali)
+
+    def _controlla_etichette(self, statistiche, mappa, sfondo):
+        verdi_sfondo = int(np.count_nonzero(self.maschera & (mappa == sfondo))) if sfondo is not None else 0
+        self.assertEqual(int(statistiche.pixel_verdi.sum()) + verdi_sfondo, self.verdi)
+        for etichetta, verdi, totali in zip(statistiche.etichette, statistiche.pixel_verdi, statistiche.pixel_totali):
+            zona = mappa == etichetta
+            self.assertEqual(int(verdi), int(np.count_nonzero(self.maschera & zona)))
+            self.assertEqual(int(totali), int(np.count_nonzero(zona)))
+
+    def test_etichette(self):
+        statistiche = zonal_detector.statistiche_zonali(self.percorso, etichette=self.etichette, soglia=SOGLIA)
+        self.assertEqual(statistiche.etichette.tolist(), [1, 2, 3, 4, 5])
+        self._controlla_etichette(statistiche, self.etichette, 0)
+
+    def test_etichette_sparse(self):
+        dense = zonal_detector.statistiche_zonali(self.percorso, etichette=self.etichette, soglia=SOGLIA)
+        casi = {
+            'con sfondo': np.array([0, 7, 65536, 10 ** 6, 2 ** 31 - 1, 10 ** 12], dtype=np.uint64),
+            'senza sfondo': np.array([3, 7, 65536, 10 ** 6, 2 ** 31 - 1, 10 ** 12], dtype=np.uint64),
+        }
+        for caso, valori in casi.items():
+            with self.subTest(caso=caso):
+                mappa = valori[self.etichette]
+                statistiche = zonal_detector.statistiche_zonali(self.percorso, etichette=mappa, soglia=SOGLIA)
+                presenti = valori[valori != 0]
+                self.assertEqual(statistiche.etichette.tolist(), presenti.tolist())
+                self._controlla_etichette(statistiche, mappa, 0 if valori[0] == 0 else None)
+                if valori[0] == 0:
+                    np.testing.assert_array_equal(statistiche.pixel_verdi, dense.pixel_verdi)
+                    self.assertEqual(statistiche.mappa_di_calore().tobytes(), dense.mappa_di_calore().tobytes())
+                # Conteggi e colori hanno una voce per etichetta presente, non per ogni valore fino al massimo
+                self.assertLessEqual(statistiche._mappa_etichette.max(), len(valori))
+
+    def test_etichette_non_valide(self):
+        with self.assertRaises(ValueError):
+            zonal_detector.statistiche_zonali(self.percorso, etichette=-self.etichette.astype(np.int16) - 1)
+        with self.assertRaises(ValueError):
+            zonal_detector.statistiche_zonali(self.percorso, etichette=self.etichette[1:])
+
+
+if __name__ == '__main__':
+    unittest.main()
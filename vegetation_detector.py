@@ -0,0 +1,150 @@
+from green_detector import (CanaliRGB, Classificatore, ClassificatoreStandard, RisultatoVerde, apri_regione,
+                            percentuale_pixel, np)
+
+
+class ExcessGreen(Classificatore):
+    """Excess Green sulle coordinate cromatiche: 2g - r - b, con r = R / (R + G + B) e così via"""
+    nome = 'exg'
+
+    def __init__(self, soglia=0.1):
+        self.soglia = soglia
+
+    def maschera(self, canali):
+        # 2g - r - b > soglia equivale a 2G - R - B > soglia * (R + G + B): nessuna divisione, il nero è escluso
+        return (2 * canali.g - canali.r - canali.b > self.soglia * canali.somma) & (canali.somma > 0)
+
+
+class VARI(Classificatore):
+    """Visible Atmospherically Resistant Index: (G - R) / (G + R - B)"""
+    nome = 'vari'
+
+    def __init__(self, soglia=0.0):
+        self.soglia = soglia
+
+    def maschera(self, canali):
+        denominatore = canali.g + canali.r - canali.b
+        # Il segno del denominatore può cambiare: la divisione non si può evitare. Con denominatore nullo
+        # l'indice non è definito e il pixel non è verde
+        indice = np.divide(canali.g - canali.r, denominatore, out=np.full_like(denominatore, -np.inf),
+                           where=denominatore != 0)
+        return indice > self.soglia
+
+
+class GLI(Classificatore):
+    """Green Leaf Index: (2G - R - B) / (2G + R + B)"""
+    nome = 'gli'
+
+    def __init__(self, soglia=0.0):
+        self.soglia = soglia
+
+    def maschera(self, canali):
+        # Il denominatore non è mai negativo: si moltiplica invece di dividere
+        denominatore = canali.somma + canali.g
+        return (2 * canali.g - canali.r - canali.b > self.soglia * denominatore) & (denominatore > 0)
+
+
+class ClassificatoreHSV(Classificatore):
+    """Pixel con tonalità (in gradi) nell'intervallo indicato, abbastanza saturi e luminosi"""
+    nome = 'hsv'
+
+    def __init__(self, tonalita_min=60, tonalita_max=180, saturazione_min=0.2, valore_min=0.15):
+        self.tonalita_min = tonalita_min
+        self.tonalita_max = tonalita_max
+        self.saturazione_min = saturazione_min
+        self.valore_min = valore_min
+
+    @classmethod
+    def da_parametro(cls, testo):
+        tonalita_min, _, tonalita_max = testo.partition('-')
+        return cls(float(tonalita_min), float(tonalita_max))
+
+    def maschera(self, canali):
+        tonalita, saturazione, valore = canali.hsv
+        if self.tonalita_min <= self.tonalita_max:
+            maschera = (tonalita >= self.tonalita_min) & (tonalita <= self.tonalita_max)
+        else:
+            # Intervallo a cavallo dello zero, es. 330-30
+            maschera = (tonalita >= self.tonalita_min) | (tonalita <= self.tonalita_max)
+        maschera &= saturazione >= self.saturazione_min
+        maschera &= valore >= self.valore_min
+        return maschera
+
+
+# Classificatori disponibili per nome, nell'ordine in cui compaiono in CLI e interfaccia grafica
+CLASSIFICATORI = {classe.nome: classe for classe in (ClassificatoreStandard, ExcessGreen, VARI, GLI, ClassificatoreHSV)}
+
+
+def registra_classificatore(classe):
+    """Aggiunge un classificatore (sottoclasse di Classificatore con un nome); si può usare come decoratore"""
+    if not classe.nome:
+        raise ValueError("Il classificatore deve avere un nome")
+    CLASSIFICATORI[classe.nome] = classe
+    return classe
+
+
+def crea_classificatore(specifica, soglia_standard=None):
+    """Crea un classificatore da "nome" o "nome:parametro", es. "exg:0.05" o "hsv:70-160".
+
+    Senza parametro si usano i valori predefiniti; per "standard" la soglia è soglia_standard, se indicata.
+    """
+    nome, _, parametro = specifica.partition(':')
+    classe = CLASSIFICATORI.get(nome.lower())
+    if classe is None:
+        raise ValueError(f"Classificatore sconosciuto: {nome} (disponibili: {', '.join(CLASSIFICATORI)})")
+    if parametro:
+        try:
+            return classe.da_parametro(parametro)
+        except ValueError:
+            raise ValueError(f"Parametro non valido per il classificatore {nome}: {parametro}") from None
+    if classe is ClassificatoreStandard and soglia_standard is not None:
+        return classe(soglia_standard)
+    return classe()
+
+
+# Pixel per banda nella passata unica: abbastanza pochi perché i canali in virgola mobile
+# di una banda restino in cache mentre si applicano i classificatori
+PIXEL_PER_BANDA = 1 << 18
+
+
+def analizza_indici(image_path, classificatori, area_di_interesse=None, cache=None):
+    """Applica più classificatori alla stessa immagine e restituisce un RisultatoVerde per ognuno, nello stesso ordine.
+
+    L'immagine viene decodificata una volta sola e percorsa per bande: su ogni banda i canali in
+    virgola mobile (e HSV, se serve) sono calcolati una volta e usati da tutti i classificatori.
+    Richiede NumPy.
+    """
+    if np is None:
+        raise ImportError("analizza_indici richiede NumPy (pip install numpy)")
+    if cache is not None:
+        regione, riquadri = cache.regione(image_path, area_di_interesse, come_array=True)
+    else:
+        regione, riquadri = apri_regione(image_path, area_di_interesse)
+        regione = np.asarray(regione)
+
+    altezza, larghezza = regione.shape[:2]
+    altezza_banda = max(1, PIXEL_PER_BANDA // max(larghezza, 1))
+    pixel_verdi = [0] * len(classificatori)
+    pixel_totali = 0
+    for y in range(0, altezza, altezza_banda):
+        y2 = min(y + altezza_banda, altezza)
+        area_banda = None
+        if riquadri is not None:
+            area_banda = np.zeros((y2 - y, larghezza), dtype=bool)
+            for x1, ry1, x2, ry2 in riquadri:
+                if ry1 < y2 and ry2 > y:
+                    area_banda[max(ry1, y) - y:min(ry2, y2) - y, x1:x2] = True
+            totali_banda = int(np.count_nonzero(area_banda))
+            if not totali_banda:
+                continue
+            pixel_totali += totali_banda
+        else:
+            pixel_totali += (y2 - y) * larghezza
+
+        canali = CanaliRGB(regione[y:y2])
+        for i, classificatore in enumerate(classificatori):
+            maschera = classificatore.maschera(canali)
+            if area_banda is not None:
+                maschera &= area_banda
+            pixel_verdi[i] += int(np.count_nonzero(maschera))
+
+    return [RisultatoVerde(percentuale_pixel(verdi, pixel_totali), verdi, pixel_totali) for verdi in pixel_verdi]
@@ -0,0 +1,305 @@
+import argparse
+import csv
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass
+
+from PIL import Image
+
+from batch_detector import trova_immagini
+from green_detector import MOTORI_DISPONIBILI, analizza_pixel
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None  # Senza OpenCV si leggono solo sequenze di immagini e animazioni (GIF, APNG, WebP, TIFF)
+
+# Formati multi-fotogramma che Pillow sa leggere da solo
+ESTENSIONI_ANIMAZIONI = ('.gif', '.png', '.apng', '.webp', '.tif', '.tiff')
+
+
+@dataclass
+class RisultatoFotogramma:
+    """Percentuale di verde di un fotogramma; tempo è in secondi dall'inizio dello stream"""
+    indice: int
+    tempo: float
+    percentuale: float
+    pixel_verdi: int
+    pixel_totali: int
+    latenza: float  # secondi tra la lettura del fotogramma e la fine dell'analisi
+
+
+class SorgenteSequenza:
+    """Sequenza di file immagine, un fotogramma per file, a `fps` fotogrammi al secondo"""
+    tempo_reale = False
+
+    def __init__(self, percorsi, fps=1.0):
+        self.percorsi = list(percorsi)
+        self.fps = fps
+
+    def fotogrammi(self):
+        """Genera (indice, tempo, carica): carica() decodifica il fotogramma solo se serve"""
+        for indice, percorso in enumerate(self.percorsi):
+            yield indice, indice / self.fps, lambda percorso=percorso: Image.open(percorso).convert('RGB')
+
+    def chiudi(self):
+        pass
+
+
+class SorgenteAnimazione:
+    """Fotogrammi di un file animato letto con Pillow; i tempi vengono dalla durata dei fotogrammi"""
+    tempo_reale = False
+
+    def __init__(self, percorso, fps=None):
+        self.percorso = percorso
+        self.fps = fps
+        self._img = None
+
+    def fotogrammi(self):
+        self._img = Image.open(self.percorso)
+        tempo = 0.0
+        for indice in range(getattr(self._img, 'n_frames', 1)):
+            self._img.seek(indice)
+            yield indice, tempo, lambda: self._img.convert('RGB')
+            durata = self._img.info.get('duration')
+            tempo += 1 / self.fps if self.fps else (durata or 100) / 1000
+
+    def chiudi(self):
+        if self._img is not None:
+            self._img.close()
+
+
+class SorgenteOpenCV:
+    """File video o telecamera letti con OpenCV.
+
+    Con una telecamera (indice intero) i fotogrammi arrivano al ritmo di cattura e il tempo è quello
+    di lettura. grab() e retrieve() sono separati, così un fotogramma saltato non viene decodificato.
+    """
+
+    def __init__(self, sorgente, fps=None):
+        if cv2 is None:
+            raise ImportError("Per video e telecamere serve OpenCV (pip install opencv-python)")
+        self.tempo_reale = isinstance(sorgente, int)
+        self._cattura = cv2.VideoCapture(sorgente)
+        if not self._cattura.isOpened():
+            raise OSError(f"Impossibile aprire la sorgente video: {sorgente}")
+        self.fps = fps or self._cattura.get(cv2.CAP_PROP_FPS) or 30.0
+
+    def _rgb(self):
+        ok, fotogramma = self._cattura.retrieve()
+        if not ok:
+            raise OSError("Fotogramma video non decodificabile")
+        # OpenCV restituisce BGR: la vista invertita sui canali non copia i pixel
+        return fotogramma[..., ::-1]
+
+    def fotogrammi(self):
+        inizio = time.monotonic()
+        indice = 0
+        while self._cattura.grab():
+            tempo = time.monotonic() - inizio if self.tempo_reale else indice / self.fps
+            yield indice, tempo, self._rgb
+            indice += 1
+
+    def chiudi(self):
+        self._cattura.release()
+
+
+def apri_sorgente(sorgente, fps=None):
+    """Sceglie la sorgente adatta: indice di telecamera, cartella/glob/elenco di immagini, animazione o video"""
+    if isinstance(sorgente, int) or (isinstance(sorgente, str) and sorgente.isdigit()):
+        return SorgenteOpenCV(int(sorgente), fps)
+    if isinstance(sorgente, (list, tuple)):
+        return SorgenteSequenza(trova_immagini(sorgente), fps or 1.0)
+    if os.path.isfile(sorgente):
+        if os.path.splitext(sorgente)[1].lower() in ESTENSIONI_ANIMAZIONI:
+            return SorgenteAnimazione(sorgente, fps)
+        return SorgenteOpenCV(sorgente, fps)
+    return SorgenteSequenza(trova_immagini([sorgente]), fps or 1.0)
+
+
+class AnalisiStream:
+    """Analizza una sorgente di fotogrammi con un pool di thread e restituisce i risultati in ordine.
+
+    Un thread produttore legge i fotogrammi e li mette in una coda limitata, da cui i thread di
+    analisi li prelevano; i fotogrammi non vengono conservati dopo l'analisi. Per le sorgenti non in
+    tempo reale la coda piena blocca il produttore (contropressione). In tempo reale (telecamere, o
+    file con tempo_reale=True, riprodotti al loro ritmo) i fotogrammi vengono invece saltati senza
+    decodificarli quando la coda è piena o quando il ritardo supera ritardo_massimo secondi.
+    """
+
+    def __init__(self, sorgente, soglia=2, motore=None, area_di_interesse=None, workers=None,
+                 tempo_reale=None, ritardo_massimo=0.5):
+        self.sorgente = sorgente
+        self.soglia = soglia
+        self.motore = motore
+        self.area_di_interesse = area_di_interesse
+        # NumPy e Pillow rilasciano il GIL durante i calcoli sui pixel: bastano i thread
+        self.workers = workers or os.cpu_count() or 1
+        self.tempo_reale = sorgente.tempo_reale if tempo_reale is None else tempo_reale
+        self.ritardo_massimo = ritardo_massimo
+        self.analizzati = 0
+        self.saltati = 0
+        self._ferma = threading.Event()
+
+    def ferma(self):
+        """Interrompe la lettura: i fotogrammi già in coda vengono comunque completati"""
+        self._ferma.set()
+
+    def _metti(self, coda, elemento):
+        # put bloccante ma interrompibile da ferma()
+        while not self._ferma.is_set():
+            try:
+                coda.put(elemento, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produci(self, coda_fotogrammi, coda_risultati):
+        inizio = time.monotonic()
+        numero = 0
+        try:
+            for indice, tempo, carica in self.sorgente.fotogrammi():
+                if self._ferma.is_set():
+                    break
+                if self.tempo_reale:
+                    ritardo = time.monotonic() - inizio - tempo
+                    if ritardo < 0:
+                        # File riprodotto in tempo reale: si aspetta l'istante del fotogramma
+                        if self._ferma.wait(-ritardo):
+                            break
+                    elif ritardo > self.ritardo_massimo or coda_fotogrammi.full():
+                        # L'analisi è in ritardo: il fotogramma viene saltato senza decodificarlo
+                        self.saltati += 1
+                        continue
+                    coda_fotogrammi.put((numero, indice, tempo, time.monotonic(), carica()))
+                else:
+                    letto = time.monotonic()
+                    if not self._metti(coda_fotogrammi, (numero, indice, tempo, letto, carica())):
+                        break
+                numero += 1
+        except Exception as e:
+            coda_risultati.put(e)
+        finally:
+            self.sorgente.chiudi()
+            for _ in range(self.workers):
+                if not self._metti(coda_fotogrammi, None):
+                    break
+
+    def _lavora(self, coda_fotogrammi, coda_risultati):
+        try:
+            while not self._ferma.is_set() or not coda_fotogrammi.empty():
+                try:
+                    elemento = coda_fotogrammi.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if elemento is None:
+                    break
+                numero, indice, tempo, letto, pixel = elemento
+                risultato = analizza_pixel(pixel, self.soglia, motore=self.motore,
+                                           area_di_interesse=self.area_di_interesse)
+                del pixel, elemento
+                coda_risultati.put((numero, RisultatoFotogramma(
+                    indice, round(tempo, 4), risultato.percentuale, risultato.pixel_verdi, risultato.pixel_totali,
+                    round(time.monotonic() - letto, 4))))
+        except Exception as e:
+            coda_risultati.put(e)
+        finally:
+            coda_risultati.put(None)
+
+    def __iter__(self):
+        coda_fotogrammi = queue.Queue(maxsize=self.workers * 2)
+        coda_risultati = queue.Queue()
+        threading.Thread(target=self._produci, args=(coda_fotogrammi, coda_risultati), daemon=True).start()
+        for _ in range(self.workers):
+            threading.Thread(target=self._lavora, args=(coda_fotogrammi, coda_risultati), daemon=True).start()
+
+        # I thread finiscono in ordine sparso: i risultati attendono qui il loro turno
+        in_attesa = {}
+        prossimo = 0
+        attivi = self.workers
+        try:
+            while attivi:
+                elemento = coda_risultati.get()
+                if elemento is None:
+                    attivi -= 1
+                    continue
+                if isinstance(elemento, Exception):
+                    raise elemento
+                numero, risultato = elemento
+                in_attesa[numero] = risultato
+                while prossimo in in_attesa:
+                    self.analizzati += 1
+                    yield in_attesa.pop(prossimo)
+                    prossimo += 1
+        finally:
+            self._ferma.set()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Percentuale di verde fotogramma per fotogramma da video, telecamere o sequenze di immagini')
+    sorgente = parser.add_mutually_exclusive_group(required=True)
+    sorgente.add_argument('--video', type=str, help='File video (OpenCV) o animazione (GIF, APNG, WebP, TIFF)')
+    sorgente.add_argument('--camera', type=int, help='Indice della telecamera (OpenCV)')
+    sorgente.add_argument('--sequenza', nargs='+', metavar='PERCORSO', help='Cartelle, file o pattern glob di immagini')
+    parser.add_argument('--fps', type=float, default=None, help='Fotogrammi al secondo della sorgente (default: quelli del video, 1 per le sequenze)')
+    parser.add_argument('--tempo-reale', action='store_true', help='Riproduce i file al loro ritmo, saltando fotogrammi se l\'analisi è in ritardo')
+    parser.add_argument('--ritardo-massimo', type=float, default=0.5, help='Ritardo in secondi oltre cui si saltano fotogrammi (default: 0.5)')
+    parser.add_argument('--soglia', type=int, default=2, help='Soglia di rilevamento verde (default: 2)')
+    parser.add_argument('--motore', choices=MOTORI_DISPONIBILI, default=None, help='Motore di calcolo (default: il più veloce disponibile)')
+    parser.add_argument('--workers', type=int, default=None, help='Thread di analisi (default: uno per core)')
+    parser.add_argument('--formato', choices=('csv', 'jsonl'), default='csv', help='Formato dei risultati (default: csv)')
+    parser.add_argument('--risultati', type=str, default=None, help='File in cui scrivere i risultati (default: standard output)')
+    parser.add_argument('--sonifica', action='store_true', help='Suono MIDI continuo che segue la percentuale di verde')
+    parser.add_argument('--file-midi', type=str, default=None, help='Registra la sonificazione in un file MIDI (implica --sonifica)')
+    args = parser.parse_args(argv)
+
+    if args.camera is not None:
+        sorgente = apri_sorgente(args.camera, args.fps)
+    elif args.video:
+        sorgente = apri_sorgente(args.video, args.fps)
+    else:
+        sorgente = apri_sorgente(args.sequenza, args.fps)
+
+    analisi = AnalisiStream(sorgente, args.soglia, args.motore, workers=args.workers,
+                            tempo_reale=True if args.tempo_reale else None, ritardo_massimo=args.ritardo_massimo)
+    sonificazione = None
+    if args.sonifica or args.file_midi:
+        from audio_lifemeter import apri_sonificazione
+        sonificazione = apri_sonificazione(args.file_midi)
+    file_risultati = open(args.risultati, 'w', newline='', encoding='utf-8') if args.risultati else sys.stdout
+    campi = list(RisultatoFotogramma.__dataclass_fields__)
+    inizio = time.monotonic()
+    try:
+        if args.formato == 'csv':
+            scrittore = csv.DictWriter(file_risultati, fieldnames=campi)
+            scrittore.writeheader()
+        for risultato in analisi:
+            if sonificazione is not None:
+                sonificazione.aggiorna(risultato.percentuale)
+            if args.formato == 'csv':
+                scrittore.writerow(asdict(risultato))
+            else:
+                file_risultati.write(json.dumps(asdict(risultato), ensure_ascii=False) + '\n')
+            file_risultati.flush()
+    except KeyboardInterrupt:
+        analisi.ferma()
+    finally:
+        if file_risultati is not sys.stdout:
+            file_risultati.close()
+        if sonificazione is not None:
+            sonificazione.chiudi()
+
+    durata = time.monotonic() - inizio
+    print(f"{analisi.analizzati} fotogrammi analizzati in {durata:.2f} s, {analisi.saltati} saltati", file=sys.stderr)
+    if sonificazione is not None:
+        print(sonificazione.riepilogo(), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,231 @@
+import argparse
+import math
+import os
+import sys
+import threading
+import time
+
+from PIL import Image, ImageChops
+
+from batch_detector import ScrittoreRisultati, trova_immagini
+from green_detector import (MOTORI_DISPONIBILI, RisultatoVerde, maschera_numpy, maschera_pil, normalizza_soglia,
+                            percentuale_pixel, converti_rgb, scegli_motore, np)
+
+LATO_TESSERA = 64
+
+CAMPI_OSSERVAZIONE = ('percorso', 'percentuale', 'pixel_verdi', 'pixel_totali', 'tessere_ricalcolate',
+                      'tessere_totali', 'secondi', 'errore')
+
+
+class ConteggioATessere:
+    """Conteggio dei pixel verdi di una sequenza di fotogrammi della stessa scena.
+
+    L'immagine è divisa in tessere quadrate di lato_tessera pixel e per ognuna si conserva il numero
+    di pixel verdi. A ogni nuovo fotogramma si confrontano i pixel con quelli del fotogramma precedente
+    e la maschera verde viene ricalcolata solo nelle tessere cambiate: con una scena quasi statica
+    l'aggiornamento costa poco più del confronto. Se le dimensioni cambiano si ricalcola tutto.
+    """
+
+    def __init__(self, soglia=2, motore=None, lato_tessera=LATO_TESSERA):
+        if lato_tessera < 1:
+            raise ValueError("Il lato delle tessere deve essere almeno 1 pixel")
+        self.soglia = normalizza_soglia(soglia)
+        self.motore = scegli_motore(motore)
+        self.lato_tessera = lato_tessera
+        self.pixel_verdi = 0
+        self.pixel_totali = 0
+        self.tessere_ricalcolate = 0
+        self._conteggi = None
+        self._precedente = None
+
+    @property
+    def tessere_totali(self):
+        if self._conteggi is None:
+            return 0
+        if self.motore == 'numpy':
+            return self._conteggi.size
+        return len(self._conteggi) * len(self._conteggi[0])
+
+    def percentuale(self):
+        return percentuale_pixel(self.pixel_verdi, self.pixel_totali)
+
+    def aggiorna(self, pixel):
+        """Aggiorna i conteggi con un nuovo fotogramma (immagine Pillow o array RGB) e restituisce un RisultatoVerde"""
+        if self.motore == 'numpy':
+            self._aggiorna_numpy(np.asarray(converti_rgb(pixel) if isinstance(pixel, Image.Image) else pixel))
+        else:
+            # Image.fromarray può condividere la memoria dell'array: si copia, perché l'immagine
+            # viene conservata come fotogramma precedente
+            self._aggiorna_pil(converti_rgb(pixel) if isinstance(pixel, Image.Image) else Image.fromarray(pixel).copy())
+        return RisultatoVerde(self.percentuale(), self.pixel_verdi, self.pixel_totali)
+
+    def _aggiorna_numpy(self, arr):
+        lato = self.lato_tessera
+        altezza, larghezza = arr.shape[:2]
+        inizi_x = np.arange(0, larghezza, lato)
+        nuovo = self._precedente is None or self._precedente.shape != arr.shape
+        if nuovo:
+            self._conteggi = np.zeros((math.ceil(altezza / lato), len(inizi_x)), dtype=np.int64)
+            cambiate = np.ones(self._conteggi.shape, dtype=bool)
+            # Copia: l'array ricevuto potrebbe essere un buffer riusato dal chiamante (es. OpenCV)
+            self._precedente = np.array(arr)
+            self.pixel_verdi = 0
+            self.pixel_totali = altezza * larghezza
+        else:
+            cambiate = np.empty(self._conteggi.shape, dtype=bool)
+            for riga, y in enumerate(range(0, altezza, lato)):
+                # OR delle righe della fascia (riduzione sull'asse contiguo, molto più veloce di
+                # any(axis=(0, 2))), poi dei canali e infine per gruppi di lato colonne
+                diversi = (arr[y:y + lato] != self._precedente[y:y + lato]).reshape(-1, larghezza * 3)
+                colonne_diverse = np.logical_or.reduce(diversi, axis=0).reshape(larghezza, 3).any(axis=1)
+                cambiate[riga] = np.logical_or.reduceat(colonne_diverse, inizi_x)
+
+        self.tessere_ricalcolate = int(np.count_nonzero(cambiate))
+        for riga in np.flatnonzero(cambiate.any(axis=1)):
+            colonne = np.flatnonzero(cambiate[riga])
+            c1, c2 = colonne[0], colonne[-1] + 1
+            y1, y2 = riga * lato, min((riga + 1) * lato, altezza)
+            x1, x2 = c1 * lato, min(c2 * lato, larghezza)
+            # Una sola maschera per la fascia di tessere cambiate della riga
+            verdi_per_colonna = np.count_nonzero(maschera_numpy(arr[y1:y2, x1:x2], self.soglia), axis=0)
+            conteggi = np.add.reduceat(verdi_per_colonna, inizi_x[c1:c2] - x1)
+            self.pixel_verdi += int(conteggi.sum() - self._conteggi[riga, c1:c2].sum())
+            self._conteggi[riga, c1:c2] = conteggi
+            if not nuovo:
+                self._precedente[y1:y2, x1:x2] = arr[y1:y2, x1:x2]
+
+    def _aggiorna_pil(self, img):
+        lato = self.lato_tessera
+        larghezza, altezza = img.size
+        righe, colonne = math.ceil(altezza / lato), math.ceil(larghezza / lato)
+        if self._precedente is None or self._precedente.size != img.size:
+            self._conteggi = [[0] * colonne for _ in range(righe)]
+            cambiate = [list(range(colonne)) for _ in range(righe)]
+            self.pixel_verdi = 0
+            self.pixel_totali = larghezza * altezza
+        else:
+            differenza = ImageChops.difference(img, self._precedente)
+            cambiate = [[] for _ in range(righe)]
+            area_cambiata = differenza.getbbox()
+            if area_cambiata is not None:
+                ax1, ay1, ax2, ay2 = area_cambiata
+                for riga in range(ay1 // lato, math.ceil(ay2 / lato)):
+                    for colonna in range(ax1 // lato, math.ceil(ax2 / lato)):
+                        tessera = (colonna * lato, riga * lato, (colonna + 1) * lato, (riga + 1) * lato)
+                        if differenza.crop(tessera).getbbox() is not None:
+                            cambiate[riga].append(colonna)
+
+        self.tessere_ricalcolate = 0
+        for riga, colonne_cambiate in enumerate(cambiate):
+            if not colonne_cambiate:
+                continue
+            # Una sola maschera per la fascia di tessere cambiate della riga
+            y1, y2 = riga * lato, min((riga + 1) * lato, altezza)
+            x1 = colonne_cambiate[0] * lato
+            fascia = (x1, y1, min((colonne_cambiate[-1] + 1) * lato, larghezza), y2)
+            maschera = maschera_pil(img.crop(fascia), self.soglia)
+            for colonna in colonne_cambiate:
+                x = colonna * lato - x1
+                verdi = maschera.crop((x, 0, x + lato, y2 - y1)).histogram()[255]
+                self.pixel_verdi += verdi - self._conteggi[riga][colonna]
+                self._conteggi[riga][colonna] = verdi
+            self.tessere_ricalcolate += len(colonne_cambiate)
+        self._precedente = img
+
+
+def osserva_cartella(percorsi, soglia=2, motore=None, lato_tessera=LATO_TESSERA, intervallo=1.0,
+                     una_volta=False, ferma=None):
+    """Controlla periodicamente cartelle, file o pattern glob e analizza le immagini nuove o sovrascritte.
+
+    Le immagini sono trattate come fotogrammi successivi della stessa scena, in ordine di modifica,
+    e analizzate in modo incrementale con ConteggioATessere. Restituisce un dizionario per fotogramma.
+    Un file che non si riesce a leggere viene ritentato al controllo successivo (potrebbe essere
+    ancora in scrittura) e segnalato come errore solo se nel frattempo non è cambiato.
+    Con una_volta=True analizza le immagini presenti e termina; altrimenti continua finché
+    ferma (un threading.Event) non viene impostato.
+    """
+    conteggio = ConteggioATessere(soglia, motore, lato_tessera)
+    ferma = ferma or threading.Event()
+    visti = {}
+    falliti = {}
+    while not ferma.is_set():
+        da_analizzare = []
+        for percorso in trova_immagini(percorsi):
+            try:
+                stato = os.stat(percorso)
+            except OSError:
+                continue
+            firma = (stato.st_mtime_ns, stato.st_size)
+            if visti.get(percorso) != firma:
+                da_analizzare.append((stato.st_mtime_ns, percorso, firma))
+
+        for _, percorso, firma in sorted(da_analizzare):
+            inizio = time.perf_counter()
+            try:
+                with Image.open(percorso) as img:
+                    risultato = conteggio.aggiorna(converti_rgb(img))
+            except (OSError, ValueError) as e:
+                if not una_volta and falliti.get(percorso) != firma:
+                    falliti[percorso] = firma
+                    continue
+                visti[percorso] = firma
+                yield dict(dict.fromkeys(CAMPI_OSSERVAZIONE), percorso=percorso,
+                           secondi=round(time.perf_counter() - inizio, 4), errore=f"{type(e).__name__}: {e}")
+                continue
+            visti[percorso] = firma
+            falliti.pop(percorso, None)
+            yield {
+                'percorso': percorso,
+                'percentuale': risultato.percentuale,
+                'pixel_verdi': risultato.pixel_verdi,
+                'pixel_totali': risultato.pixel_totali,
+                'tessere_ricalcolate': conteggio.tessere_ricalcolate,
+                'tessere_totali': conteggio.tessere_totali,
+                'secondi': round(time.perf_counter() - inizio, 4),
+                'errore': None,
+            }
+
+        if una_volta:
+            break
+        ferma.wait(intervallo)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Analisi incrementale di cartelle osservate e time-lapse')
+    parser.add_argument('percorsi', nargs='+', metavar='PERCORSO', help='Cartelle, file o pattern glob da osservare')
+    parser.add_argument('--soglia', type=int, default=2, help='Soglia di rilevamento verde (default: 2)')
+    parser.add_argument('--motore', choices=MOTORI_DISPONIBILI, default=None, help='Motore di calcolo (default: il più veloce disponibile)')
+    parser.add_argument('--tessera', type=int, default=LATO_TESSERA, help=f'Lato delle tessere in pixel (default: {LATO_TESSERA})')
+    parser.add_argument('--intervallo', type=float, default=1.0, help='Secondi tra due controlli della cartella (default: 1)')
+    parser.add_argument('--una-volta', action='store_true', help='Analizza le immagini presenti e termina')
+    parser.add_argument('--formato', choices=('csv', 'jsonl'), default='csv', help='Formato dei risultati (default: csv)')
+    parser.add_argument('--risultati', type=str, default=None, help='File in cui scrivere i risultati (default: standard output)')
+    parser.add_argument('--sonifica', action='store_true', help='Suono MIDI continuo che segue la percentuale di verde')
+    parser.add_argument('--file-midi', type=str, default=None, help='Registra la sonificazione in un file MIDI (implica --sonifica)')
+    args = parser.parse_args(argv)
+
+    sonificazione = None
+    if args.sonifica or args.file_midi:
+        from audio_lifemeter import apri_sonificazione
+        sonificazione = apri_sonificazione(args.file_midi)
+    file_risultati = open(args.risultati, 'w', newline='', encoding='utf-8') if args.risultati else sys.stdout
+    try:
+        scrittore = ScrittoreRisultati(file_risultati, args.formato, CAMPI_OSSERVAZIONE)
+        for risultato in osserva_cartella(args.percorsi, args.soglia, args.motore, args.tessera,
+                                          args.intervallo, args.una_volta):
+            if sonificazione is not None and risultato['percentuale'] is not None:
+                sonificazione.aggiorna(risultato['percentuale'])
+            scrittore.scrivi(risultato)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if file_risultati is not sys.stdout:
+            file_risultati.close()
+        if sonificazione is not None:
+            sonificazione.chiudi()
+            print(sonificazione.riepilogo(), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
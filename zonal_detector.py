@@ -0,0 +1,247 @@
+import csv
+import json
+import sys
+
+from PIL import Image, ImageDraw
+
+from green_detector import ClassificatoreStandard, MascheraVerde, maschera_numpy, normalizza_soglia, carica_regione, np
+from vegetation_detector import PIXEL_PER_BANDA
+
+# Colori della mappa di calore: dallo 0% (rosso) al 100% (verde) passando per il giallo
+_PERCENTUALI_COLORI = (0, 50, 100)
+_COLORI = ((215, 48, 39), (255, 255, 191), (26, 152, 80))
+
+# Oltre questo valore massimo le etichette vengono rinumerate prima del conteggio
+ETICHETTE_DIRETTE = 1 << 16
+
+
+def _bordi(lunghezza, parti):
+    """Bordi di parti celle quasi uguali su lunghezza pixel"""
+    if parti > lunghezza:
+        raise ValueError(f"Griglia troppo fitta: {parti} celle su {lunghezza} pixel")
+    return np.linspace(0, lunghezza, parti + 1).round().astype(np.int64)
+
+
+def _colori(percentuali):
+    """Array (..., 3) uint8 con il colore della mappa di calore per ogni percentuale"""
+    canali = [np.interp(percentuali, _PERCENTUALI_COLORI, [colore[i] for colore in _COLORI]) for i in range(3)]
+    return np.stack(canali, axis=-1).round().astype(np.uint8)
+
+
+class StatisticheZonali:
+    """Pixel verdi e totali per zona di un'immagine di dimensioni (larghezza, altezza).
+
+    Per una griglia pixel_verdi e pixel_totali sono matrici (righe, colonne); per una maschera di
+    etichette sono vettori con una voce per ogni etichetta in etichette (lo sfondo, 0, è escluso).
+    mappa_etichette è la maschera usata per la mappa di calore, in cui l'etichetta etichette[i] vale
+    indici_mappa[i] (diverso se le etichette sono state rinumerate).
+    """
+
+    def __init__(self, pixel_verdi, pixel_totali, dimensioni, etichette=None, mappa_etichette=None,
+                 indici_mappa=None):
+        self.pixel_verdi = pixel_verdi
+        self.pixel_totali = pixel_totali
+        self.dimensioni = dimensioni
+        self.etichette = etichette
+        self._mappa_etichette = mappa_etichette
+        self._indici_mappa = indici_mappa if indici_mappa is not None else etichette
+
+    @property
+    def griglia(self):
+        return self.etichette is None
+
+    @property
+    def percentuali(self):
+        """Percentuale di verde di ogni zona, arrotondata come calcola_percentuale_verde (0 per le zone vuote)"""
+        totali = np.maximum(self.pixel_totali, 1)
+        return np.where(self.pixel_totali > 0, np.round(self.pixel_verdi / totali * 100, 2), 0.0)
+
+    def tabella(self):
+        """Righe (zona, percentuale, pixel_verdi, pixel_totali); la zona è (riga, colonna) o l'etichetta"""
+        percentuali = self.percentuali
+        if self.griglia:
+            return [((r, c), float(percentuali[r, c]), int(self.pixel_verdi[r, c]), int(self.pixel_totali[r, c]))
+                    for r, c in np.ndindex(*percentuali.shape)]
+        return [(int(e), float(p), int(v), int(t))
+                for e, p, v, t in zip(self.etichette, percentuali, self.pixel_verdi, self.pixel_totali)]
+
+    def salva(self, percorso):
+        """Salva le percentuali in CSV o, con estensione .npy, come array NumPy.
+
+        Per una griglia si salva la matrice delle percentuali; per le etichette una riga per
+        etichetta con etichetta, percentuale, pixel verdi e pixel totali.
+        """
+        if percorso.lower().endswith('.npy'):
+            if self.griglia:
+                np.save(percorso, self.percentuali)
+            else:
+                np.save(percorso, np.column_stack((self.etichette, self.percentuali, self.pixel_verdi,
+                                                   self.pixel_totali)))
+            return
+        with open(percorso, 'w', newline='', encoding='utf-8') as file:
+            self.scrivi_csv(file)
+
+    def scrivi_csv(self, file):
+        scrittore = csv.writer(file)
+        if self.griglia:
+            scrittore.writerows(self.percentuali.tolist())
+        else:
+            scrittore.writerow(('etichetta', 'percentuale', 'pixel_verdi', 'pixel_totali'))
+            scrittore.writerows(self.tabella())
+
+    def mappa_di_calore(self, dimensioni=None):
+        """Immagine RGBA con il colore di ogni zona, dal rosso (0%) al verde (100%).
+
+        dimensioni (larghezza, altezza) è quella dell'immagine analizzata se None; per le etichette
+        lo sfondo è trasparente.
+        """
+        dimensioni = dimensioni or self.dimensioni
+        if self.griglia:
+            img = Image.fromarray(_colori(self.percentuali)).convert('RGBA')
+            return img.resize(dimensioni, Image.Resampling.NEAREST)
+
+        # Come per le anteprime, prima si prende un pixel ogni passo e poi si ridimensiona
+        mappa = self._mappa_etichette
+        passo = max(1, min(self.dimensioni[0] // dimensioni[0], self.dimensioni[1] // dimensioni[1]))
+        mappa = mappa[::passo, ::passo]
+        colori = np.zeros((int(self._indici_mappa.max(initial=0)) + 1, 4), dtype=np.uint8)
+        colori[self._indici_mappa, :3] = _colori(self.percentuali)
+        colori[self._indici_mappa, 3] = 255
+        img = Image.fromarray(colori[np.minimum(mappa, len(colori) - 1)], 'RGBA')
+        if img.size != dimensioni:
+            img = img.resize(dimensioni, Image.Resampling.NEAREST)
+        return img
+
+
+def _conta_griglia(dimensioni, griglia, maschera_righe):
+    """Conta i pixel verdi per cella percorrendo l'immagine per bande; maschera_righe(y1, y2) è la maschera delle righe y1:y2"""
+    larghezza, altezza = dimensioni
+    righe, colonne = griglia
+    bordi_y = _bordi(altezza, righe)
+    bordi_x = _bordi(larghezza, colonne)
+    altezza_banda = max(1, PIXEL_PER_BANDA // larghezza)
+    pixel_verdi = np.zeros((righe, colonne), dtype=np.int64)
+    for r in range(righe):
+        # Le bande non attraversano i bordi delle celle: ogni banda contribuisce a una sola riga della griglia
+        for y in range(bordi_y[r], bordi_y[r + 1], altezza_banda):
+            y2 = min(y + altezza_banda, bordi_y[r + 1])
+            verdi_colonne = np.count_nonzero(maschera_righe(y, y2), axis=0)
+            pixel_verdi[r] += np.add.reduceat(verdi_colonne, bordi_x[:-1])
+    pixel_totali = np.outer(np.diff(bordi_y), np.diff(bordi_x))
+    return StatisticheZonali(pixel_verdi, pixel_totali, dimensioni)
+
+
+def griglia_da_maschera(maschera, griglia):
+    """Statistiche per le celle di una griglia (righe, colonne) da una maschera già calcolata:
+    una MascheraVerde o un array booleano (altezza, larghezza)"""
+    if np is None:
+        raise ImportError("Le statistiche zonali richiedono NumPy (pip install numpy)")
+    if isinstance(maschera, MascheraVerde):
+        return _conta_griglia(maschera.dimensioni, griglia, lambda y1, y2: maschera.righe_array(slice(y1, y2)))
+    altezza, larghezza = maschera.shape
+    return _conta_griglia((larghezza, altezza), griglia, lambda y1, y2: maschera[y1:y2])
+
+
+def etichette_da_poligoni(poligoni, dimensioni):
+    """Maschera di etichette (altezza, larghezza) in cui il poligono i-esimo, lista di punti (x, y) in pixel, ha etichetta i + 1.
+
+    Dove i poligoni si sovrappongono vale l'ultimo; i pixel fuori da tutti i poligoni hanno etichetta 0.
+    """
+    mappa = Image.new('I', dimensioni, 0)
+    disegno = ImageDraw.Draw(mappa)
+    for i, poligono in enumerate(poligoni, start=1):
+        disegno.polygon([tuple(punto) for punto in poligono], fill=i)
+    return np.asarray(mappa)
+
+
+def carica_etichette(percorso, dimensioni):
+    """Maschera di etichette da un'immagine a un canale (L, P, I;16, I) o da un file JSON con una lista di poligoni"""
+    if percorso.lower().endswith('.json'):
+        with open(percorso, encoding='utf-8') as file:
+            return etichette_da_poligoni(json.load(file), dimensioni)
+    with Image.open(percorso) as img:
+        if img.mode not in ('L', 'P', 'I;16', 'I'):
+            raise ValueError(f"La maschera di etichette deve avere un solo canale intero (modo {img.mode})")
+        return np.asarray(img)
+
+
+def statistiche_zonali(image_path, griglia=None, etichette=None, soglia=5, cache=None, classificatore=None):
+    """Pixel verdi per ogni cella di una griglia (righe, colonne) o per ogni regione di una maschera di etichette.
+
+    etichette è un array (altezza, larghezza) di interi non negativi, un'immagine Pillow o un percorso
+    (vedi carica_etichette), delle stesse dimensioni dell'immagine; l'etichetta 0 è lo sfondo.
+    Tutte le zone sono contate in una sola passata: l'immagine è percorsa per bande e su ogni banda
+    la maschera verde viene calcolata una volta. Richiede NumPy.
+    """
+    if np is None:
+        raise ImportError("Le statistiche zonali richiedono NumPy (pip install numpy)")
+    if (griglia is None) == (etichette is None):
+        raise ValueError("Indicare una griglia oppure una maschera di etichette")
+    if isinstance(classificatore, ClassificatoreStandard):
+        soglia, classificatore = classificatore.soglia, None
+    soglia = normalizza_soglia(soglia)
+
+    regione, _ = carica_regione(image_path, None, 'numpy', cache)
+    regione = np.asarray(regione)
+    altezza, larghezza = regione.shape[:2]
+
+    def maschera_righe(y1, y2):
+        if classificatore is not None:
+            return classificatore.maschera_array(regione[y1:y2])
+        return maschera_numpy(regione[y1:y2], soglia)
+
+    if griglia is not None:
+        return _conta_griglia((larghezza, altezza), griglia, maschera_righe)
+
+    if isinstance(etichette, str):
+        etichette = carica_etichette(etichette, (larghezza, altezza))
+    mappa = np.asarray(etichette)
+    if mappa.shape != (altezza, larghezza):
+        raise ValueError(f"La maschera di etichette ({mappa.shape[1]}x{mappa.shape[0]}) "
+                         f"non ha le dimensioni dell'immagine ({larghezza}x{altezza})")
+    if mappa.dtype.kind not in 'ui' or (mappa.dtype.kind == 'i' and mappa.min(initial=0) < 0):
+        raise ValueError("Le etichette devono essere interi non negativi")
+    valori = None
+    if mappa.max(initial=0) >= ETICHETTE_DIRETTE:
+        # Etichette sparse (es. identificativi a milioni): rinumerate da 0, così conteggi e colori
+        # hanno una voce per etichetta presente invece che per ogni valore fino al massimo
+        valori, mappa = np.unique(mappa, return_inverse=True)
+        mappa = mappa.reshape(altezza, larghezza).astype(np.uint32)
+        if valori[0] != 0:
+            # L'indice 0 resta allo sfondo anche se non compare
+            valori = np.concatenate(([0], valori))
+            mappa += 1
+    numero = int(mappa.max(initial=0)) + 1
+    pixel_verdi = np.zeros(numero, dtype=np.int64)
+    pixel_totali = np.zeros(numero, dtype=np.int64)
+    altezza_banda = max(1, PIXEL_PER_BANDA // larghezza)
+    for y in range(0, altezza, altezza_banda):
+        y2 = min(y + altezza_banda, altezza)
+        banda = mappa[y:y2].astype(np.intp, copy=False)
+        pixel_totali += np.bincount(banda.ravel(), minlength=numero)
+        pixel_verdi += np.bincount(banda[maschera_righe(y, y2)], minlength=numero)
+    presenti = np.flatnonzero(pixel_totali)
+    presenti = presenti[presenti != 0]
+    etichette = valori[presenti] if valori is not None else presenti
+    return StatisticheZonali(pixel_verdi[presenti], pixel_totali[presenti], (larghezza, altezza), etichette, mappa,
+                             presenti)
+
+
+def main_zone(args):
+    """Statistiche zonali dalla riga di comando di green_detector.py"""
+    try:
+        statistiche = statistiche_zonali(args.image, args.zone, args.etichette, args.soglia,
+                                         classificatore=args.classificatore)
+    except ValueError as e:
+        print(f"Errore: {e}", file=sys.stderr)
+        return 1
+
+    if args.zone_output:
+        statistiche.salva(args.zone_output)
+        print(f"Statistiche zonali salvate in: {args.zone_output}", file=sys.stderr)
+    else:
+        statistiche.scrivi_csv(sys.stdout)
+    if args.mappa:
+        statistiche.mappa_di_calore().save(args.mappa)
+        print(f"Mappa di calore salvata in: {args.mappa}", file=sys.stderr)
+    return 0